@@ -0,0 +1,641 @@
+"""
+Behaviour checks of the server on the fake MicroWebSrv, run under CPython.
+
+Usage:
+    python bench/checks.py [NAME ...]
+
+Each check drives the server the way MicroWebSrv would, through the fakes,
+and asserts what a client would see. It covers the code paths which the
+asyncio benchmarks never reach. Exits with status 1 if a check fails.
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+
+import fakes
+
+fakes.install()
+
+from action import Action  # noqa: E402
+import eventstream  # noqa: E402
+from executor import AsyncExecutor, ThreadedExecutor  # noqa: E402
+from flusher import Flusher  # noqa: E402
+import flusher as flusher_module  # noqa: E402
+from scheduler import Scheduler  # noqa: E402
+from subscriber import Subscriber  # noqa: E402
+import server  # noqa: E402
+import single_thing  # noqa: E402
+from utils import start_thread  # noqa: E402
+
+server.WS_messages = False
+
+CHECKS = []
+
+
+def check(name):
+    """Register a check, a function taking no arguments."""
+    def decorator(func):
+        CHECKS.append((name, func))
+        return func
+
+    return decorator
+
+
+def make_server(port=8888, **kwargs):
+    """Make a server for the single_thing example on the fake MicroWebSrv."""
+    return server.WebThingServer(
+        server.SingleThing(single_thing.make_thing()), port=port, **kwargs)
+
+
+# Every listening server gets its own port, so none waits for the last one to
+# let go of its port.
+_ports = [18800]
+
+
+def make_listening_server(stream_sockets=False, **kwargs):
+    """
+    Start a server listening on the fake MicroWebSrv.
+
+    stream_sockets -- whether to serve on sockets which are their own
+                      streams, as on MicroPython
+    """
+    _ports[0] += 1
+    srv = make_server(port=_ports[0], **kwargs)
+    srv.server.StreamSockets = stream_sockets
+    srv.start()
+    return srv
+
+
+def start_async_server():
+    """
+    Start a server on the asyncio backend, on its own thread.
+
+    Returns the server and a function which stops it.
+    """
+    _ports[0] += 1
+    srv = make_server(port=_ports[0], use_asyncio=True)
+    loop = []
+    done = []
+
+    async def main():
+        loop.append(asyncio.get_running_loop())
+        await srv.serve()
+
+    def run():
+        try:
+            asyncio.run(main())
+        finally:
+            done.append(True)
+
+    start_thread('check_server', run)
+    wait_for(lambda: loop and srv.server.IsStarted())
+
+    def stop():
+        loop[0].call_soon_threadsafe(srv.stop)
+        wait_for(lambda: done)
+
+    return srv, stop
+
+
+def connect(srv, path):
+    """Send a GET request to a listening server and read the headers."""
+    sock = socket.create_connection(('127.0.0.1', srv.port), timeout=5)
+    sock.sendall('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(
+        path).encode())
+
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        assert chunk, 'Connection closed'
+        data += chunk
+
+    head, _, rest = data.partition(b'\r\n\r\n')
+    return sock, head.decode(), rest
+
+
+def read_until(sock, data, end):
+    """Read from a socket until data holds end."""
+    while end not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+
+    return data
+
+
+@check('websocket_protocol_on_microwebsrv')
+def check_websocket_protocol_on_microwebsrv():
+    # MicroWebSrv's handshake selects no subprotocol, so its clients must
+    # get the default, whatever they offered.
+    srv = make_server()
+    for offer in ('webthing+cbor', 'webthing+cbor, webthing',
+                  'webthing, webthing+cbor'):
+        ws = srv.server.Connect('/', {'Host': 'localhost:8888',
+                                      'Sec-WebSocket-Protocol': offer})
+        assert ws.subscriber.protocol.name == 'webthing', offer
+
+    ws = srv.server.Connect('/', {'Host': 'localhost:8888'})
+    assert ws.subscriber.protocol.name == 'webthing'
+
+
+@check('websocket_event_subscriptions')
+def check_websocket_event_subscriptions():
+    srv = make_server()
+    thing = srv.things.get_thing()
+    ws = srv.server.Connect('/', {'Host': 'localhost'})
+    subscriber = ws.subscriber
+
+    ws.RecvTextCallback(ws, json.dumps({
+        'messageType': 'addEventSubscription',
+        'data': {'overheated': {}, 'melted': {}},
+    }))
+    assert subscriber in thing.available_events['overheated']['subscribers']
+    error = json.loads(subscriber.pop())
+    assert error['messageType'] == 'error', error
+    assert error['data']['status'] == '400 Bad Request', error
+    assert error['data']['message'] == 'Invalid event subscription', error
+    assert error['data']['request']['data'] == {'overheated': {},
+                                                'melted': {}}, error
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        ws.Close()
+    assert not output.getvalue(), output.getvalue()
+    assert subscriber not in thing.subscribers
+    assert not thing.available_events['overheated']['subscribers']
+
+
+@check('rejected_websocket_callbacks')
+def check_rejected_websocket_callbacks():
+    srv = make_server()
+    ws = fakes.FakeWebSocket()
+    del ws.subscriber
+    srv._acceptWebSocketCallback(
+        ws, fakes.FakeHttpClient('GET', '/nothing', {'Host': 'localhost'}))
+    assert ws.closed
+    # print_exc() makes a callback return False if it raised.
+    assert ws.RecvTextCallback(ws, '{}') is not False
+    assert ws.RecvBinaryCallback(ws, b'\xa0') is not False
+    assert ws.ClosedCallback(ws) is not False
+
+
+@check('batched_notifications_rate_limited')
+def check_batched_notifications_rate_limited():
+    # set_properties() is held to a property's maxRate like single updates.
+    thing = single_thing.make_thing()
+    thing.find_property('brightness').metadata['maxRate'] = 5
+    Flusher([thing])
+    subscriber = Subscriber(fakes.FakeWebSocket())
+    thing.add_subscriber(subscriber)
+
+    thing.set_properties({'brightness': 10, 'on': False})
+    thing.set_properties({'brightness': 20, 'on': True})
+    messages = [json.loads(subscriber.pop())['data']
+                for _ in range(len(subscriber.queue))]
+    assert messages == [{'brightness': 10, 'on': False}, {'on': True}], \
+        messages
+
+    # The deferred update is sent once the interval is over.
+    wait_for(lambda: subscriber.queue, timeout=1)
+    message = json.loads(subscriber.pop())['data']
+    assert message == {'brightness': 20}, message
+
+
+@check('flusher_thread_reused')
+def check_flusher_thread_reused():
+    # Bursts of deferred notifications share one flusher thread.
+    thing = single_thing.make_thing()
+    thing.find_property('brightness').metadata['maxRate'] = 20
+    flusher = Flusher([thing])
+    subscriber = Subscriber(fakes.FakeWebSocket())
+    thing.add_subscriber(subscriber)
+
+    started = []
+    start_thread = flusher_module.start_thread
+
+    def record(*args):
+        started.append(args)
+        start_thread(*args)
+
+    flusher_module.start_thread = record
+    try:
+        value = thing.find_property('brightness').value
+        for burst in range(3):
+            value.notify_of_external_update(10 + burst)
+            value.notify_of_external_update(20 + burst)
+            wait_for(lambda: not flusher.running, timeout=1)
+    finally:
+        flusher_module.start_thread = start_thread
+
+    assert len(started) == 1, started
+    messages = [json.loads(subscriber.pop())['data']
+                for _ in range(len(subscriber.queue))]
+    assert messages[-1] == {'brightness': 22}, messages
+
+
+@check('property_description_copy')
+def check_property_description_copy():
+    thing = single_thing.make_thing()
+    prop = thing.find_property('brightness')
+    description = prop.as_property_description()
+    description['links'].append({'rel': 'alternate', 'href': '/x'})
+    description['forms'] = []
+
+    description = prop.as_property_description()
+    assert 'forms' not in description, description
+    assert len(description['links']) == 1, description
+    assert 'forms' not in thing.as_thing_description()['properties'][
+        'brightness']
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+@check('coroutine_action_on_worker_thread')
+def check_coroutine_action_on_worker_thread():
+    # The example's fade action is a coroutine, which the threaded executor
+    # runs to the end on its worker, sleeping there.
+    srv = make_server()
+    thing = srv.things.get_thing()
+    headers = {'Host': 'localhost:8888'}
+    fade = {'fade': {'input': {'brightness': 20, 'duration': 50}}}
+
+    response = srv.server.Dispatch(
+        fakes.FakeHttpClient('POST', '/actions', headers, fade))
+    assert response.code == 201, response.code
+    action = next(iter(thing.actions.actions()))
+    wait_for(lambda: action.status == 'completed')
+    assert thing.get_property('brightness') == 20
+
+    fade['fade']['input']['duration'] = 5000
+    srv.server.Dispatch(
+        fakes.FakeHttpClient('POST', '/actions', headers, fade))
+    action = [a for a in thing.actions.actions()
+              if a.status != 'completed'][0]
+    wait_for(lambda: action.status == 'pending')
+    response = srv.server.Dispatch(
+        fakes.FakeHttpClient('DELETE', action.get_href(), headers))
+    assert response.code == 204, response.code
+    wait_for(lambda: action.status == 'cancelled', timeout=1)
+
+
+class FailingAction(Action):
+
+    def __init__(self, thing, input_):
+        Action.__init__(self, str(id(self)), thing, 'fail', input_)
+
+    def perform_action(self):
+        raise ValueError('failed')
+
+
+def failing_actions(executor, count):
+    """Submit actions which raise, and get them."""
+    thing = single_thing.make_thing()
+    thing.add_available_action('fail', {}, FailingAction)
+    actions = []
+    for _ in range(count):
+        action = thing.perform_action('fail')
+        executor.submit(action)
+        actions.append(action)
+
+    return thing, actions
+
+
+@check('failing_actions_finish')
+def check_failing_actions_finish():
+    # A failing action is finished, so it is retired and evicted.
+    logging.getLogger('executor').setLevel(logging.CRITICAL)
+    thing, actions = failing_actions(ThreadedExecutor(), 20)
+    wait_for(lambda: all(a.status == 'completed' for a in actions))
+    assert len(thing.actions) == 16, len(thing.actions)
+
+    async def run():
+        executor = AsyncExecutor()
+        thing, actions = failing_actions(executor, 20)
+        while executor.tasks or executor.queue:
+            await asyncio.sleep(0.01)
+        assert all(a.status == 'completed' for a in actions)
+        assert len(thing.actions) == 16, len(thing.actions)
+
+    asyncio.run(run())
+
+
+@check('action_cancelled_once_dequeued')
+def check_action_cancelled_once_dequeued():
+    thing, (action,) = failing_actions(ThreadedExecutor(workers=0), 1)
+    action.cancelled = True
+    action.start()
+    assert action.status == 'cancelled', action.status
+    assert action.get_time_completed() is not None
+
+
+@check('websocket_invalid_utf8')
+def check_websocket_invalid_utf8():
+    # A text frame which isn't UTF-8 closes the connection with 1007.
+    srv, stop = start_async_server()
+    try:
+        thing = srv.things.get_thing()
+        sock = socket.create_connection(('127.0.0.1', srv.port), timeout=5)
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n'
+                     b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                     b'Sec-WebSocket-Version: 13\r\n\r\n')
+        data = read_until(sock, b'', b'\r\n\r\n')
+        assert data.startswith(b'HTTP/1.1 101'), data
+        wait_for(lambda: thing.subscribers)
+
+        # A masked text frame, with a zero mask.
+        sock.sendall(b'\x81\x82\x00\x00\x00\x00\xff\xfe')
+        frame = data.partition(b'\r\n\r\n')[2]
+        while len(frame) < 4:
+            chunk = sock.recv(4096)
+            assert chunk, 'Connection closed'
+            frame += chunk
+        assert frame[:2] == b'\x88\x02', frame
+        assert struct.unpack('>H', frame[2:4])[0] == 1007, frame
+        wait_for(lambda: not thing.subscribers)
+        sock.close()
+    finally:
+        stop()
+
+
+@check('if_none_match_any_case')
+def check_if_none_match_any_case():
+    srv = make_server()
+    response = srv.server.Dispatch(
+        fakes.FakeHttpClient('GET', '/properties', {'Host': 'localhost'}))
+    etag = response.headers['ETag']
+    for name in ('If-None-Match', 'if-none-match', 'IF-NONE-MATCH'):
+        response = srv.server.Dispatch(fakes.FakeHttpClient(
+            'GET', '/properties', {'Host': 'localhost', name: etag}))
+        assert response.code == 304, name
+
+
+@check('root_route')
+def check_root_route():
+    # MicroWebSrv strips the trailing slash before matching routes.
+    for base_path in ('', '/base'):
+        srv = make_server(base_path=base_path)
+        for path in (base_path or '/', base_path + '/'):
+            response = srv.server.Dispatch(
+                fakes.FakeHttpClient('GET', path, {'Host': 'localhost'}))
+            assert response.code == 200, (path, response.code)
+            assert json.loads(response.content)['id'], path
+
+
+@check('base_path_segments')
+def check_base_path_segments():
+    srv = make_server(base_path='/base')
+    handler, _ = srv.router.resolve('/base/properties', 'GET')
+    assert handler is not None
+    handler, _ = srv.router.resolve('/baseproperties', 'GET')
+    assert handler is None, handler
+
+
+@check('description_etag_per_host')
+def check_description_etag_per_host():
+    # The description's links are built from the Host header, so a copy
+    # fetched through another host name is not current.
+    srv = make_server()
+    response = srv.server.Dispatch(
+        fakes.FakeHttpClient('GET', '/', {'Host': 'localhost'}))
+    etag = response.headers['ETag']
+    response = srv.server.Dispatch(fakes.FakeHttpClient(
+        'GET', '/', {'Host': 'localhost:8888', 'If-None-Match': etag}))
+    assert response.code == 200, response.code
+    assert 'ws://localhost:8888/' in response.content.decode()
+
+
+@check('unknown_action_and_event_names')
+def check_unknown_action_and_event_names():
+    srv = make_server()
+    headers = {'Host': 'localhost'}
+    for path, code in (('/actions/fade', 200), ('/actions/melt', 404),
+                       ('/events/overheated', 200), ('/events/melted', 404)):
+        response = srv.server.Dispatch(
+            fakes.FakeHttpClient('GET', path, headers))
+        assert response.code == code, (path, response.code)
+
+
+@check('reserved_event_name')
+def check_reserved_event_name():
+    # /events/stream is the thing's event stream, not an event's list.
+    thing = single_thing.make_thing()
+    try:
+        thing.add_available_event('stream', {})
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Event named stream was added')
+    assert 'stream' not in thing.available_events
+
+
+@check('scheduler_phase_per_period')
+def check_scheduler_phase_per_period():
+    # Timers are spread over their period by the number of timers with the
+    # same period, whatever other periods were scheduled before.
+    scheduler = Scheduler(tick_ms=10)
+    scheduler.schedule(lambda: None, 5000)
+    first = scheduler.schedule(lambda: None, 100)
+    second = scheduler.schedule(lambda: None, 100)
+    assert first.nominal == 1, first.nominal
+    assert second.nominal == 7, second.nominal
+
+
+def check_event_stream(stream_sockets):
+    srv = make_listening_server(stream_sockets)
+    try:
+        thing = srv.things.get_thing()
+        sock, head, data = connect(srv, '/events/stream')
+        assert head.startswith('HTTP/1.1 200'), head
+        assert 'Transfer-Encoding: chunked' in head, head
+        wait_for(lambda: thing.subscribers)
+        stream = next(iter(thing.subscribers)).ws
+
+        # The stream doesn't hold up MicroWebSrv's thread.
+        other, head, _ = connect(srv, '/properties/on')
+        assert head.startswith('HTTP/1.1 200'), head
+        other.close()
+
+        value = thing.find_property('brightness').value
+        value.notify_of_external_update(7)
+        data = read_until(sock, data, b'\n\n\r\n')
+        assert b'data: {"messageType": "propertyStatus", ' \
+            b'"data": {"brightness": 7}}' in data, data
+
+        # Once the client goes away, a send fails and the stream closes its
+        # socket file and socket.
+        sock.close()
+        deadline = time.time() + 5
+        while thing.subscribers:
+            assert time.time() < deadline, 'Timed out'
+            value.notify_of_external_update(value.get() + 1)
+            time.sleep(0.01)
+
+        assert stream.closed
+        assert stream.sock.sock.fileno() == -1
+        if not stream_sockets:
+            assert stream.sock.file.closed
+    finally:
+        srv.stop()
+
+
+for _stream_sockets in (False, True):
+    check('event_stream_on_microwebsrv{}'.format(
+        '_stream_sockets' if _stream_sockets else ''))(
+        lambda s=_stream_sockets: check_event_stream(s))
+
+
+def read_response(sock, data):
+    """Read the rest of a response, until the server closes the socket."""
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def check_long_poll(stream_sockets):
+    srv = make_listening_server(stream_sockets)
+    try:
+        thing = srv.things.get_thing()
+        value = thing.find_property('brightness').value
+        # Version 0 gets every property right away.
+        value.notify_of_external_update(8)
+        version = thing.get_value_version()
+        path = '/properties?since={}&wait={}'
+
+        # A waiter which never fires is answered with the current version,
+        # and nothing changed, once the wait is over.
+        start = time.time()
+        sock, head, data = connect(srv, path.format(version, 300))
+        elapsed = time.time() - start
+        assert 0.25 < elapsed < 1, elapsed
+        assert head.startswith('HTTP/1.1 200'), head
+        body = read_response(sock, data)
+        assert json.loads(body) == {'version': version, 'properties': {}}, \
+            body
+        sock.close()
+
+        # A change answers right away, and waiting doesn't hold up
+        # MicroWebSrv's thread.
+        sock = socket.create_connection(('127.0.0.1', srv.port), timeout=5)
+        sock.sendall('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(
+            path.format(version, 5000)).encode())
+        wait_for(lambda: thing.version_waiters)
+
+        other, head, _ = connect(srv, '/properties/on')
+        assert head.startswith('HTTP/1.1 200'), head
+        other.close()
+
+        start = time.time()
+        value.notify_of_external_update(9)
+        body = read_response(sock, b'').partition(b'\r\n\r\n')[2]
+        assert time.time() - start < 1
+        assert json.loads(body) == {'version': version + 1,
+                                    'properties': {'brightness': 9}}, body
+        sock.close()
+        assert not thing.version_waiters
+    finally:
+        srv.stop()
+
+
+@check('long_poll_answered_on_sender')
+def check_long_poll_answered_on_sender():
+    # The thread changing a value doesn't write the waiting responses.
+    srv = make_listening_server()
+    reattach = eventstream.DetachedSocket.reattach
+    threads = []
+
+    def record(sock):
+        threads.append(threading.get_ident())
+        reattach(sock)
+
+    eventstream.DetachedSocket.reattach = record
+    try:
+        thing = srv.things.get_thing()
+        value = thing.find_property('brightness').value
+        value.notify_of_external_update(8)
+
+        sock = socket.create_connection(('127.0.0.1', srv.port), timeout=5)
+        sock.sendall('GET /properties?since={}&wait=5000 HTTP/1.1\r\n'
+                     'Host: localhost\r\n\r\n'.format(
+                         thing.get_value_version()).encode())
+        wait_for(lambda: thing.version_waiters)
+        value.notify_of_external_update(9)
+        assert b'"brightness": 9' in read_response(sock, b'')
+        sock.close()
+        assert threads and threads[0] != threading.get_ident(), threads
+    finally:
+        eventstream.DetachedSocket.reattach = reattach
+        srv.stop()
+
+
+@check('long_poll_metrics_on_microwebsrv')
+def check_long_poll_metrics():
+    # A long-poll is counted once its response is written, with its status.
+    srv = make_listening_server(metrics=True)
+    try:
+        thing = srv.things.get_thing()
+        thing.find_property('brightness').value.notify_of_external_update(8)
+        stats = srv.metrics.routes['GET /properties']
+
+        sock = socket.create_connection(('127.0.0.1', srv.port), timeout=5)
+        sock.sendall('GET /properties?since={}&wait=300 HTTP/1.1\r\n'
+                     'Host: localhost\r\n\r\n'.format(
+                         thing.get_value_version()).encode())
+        wait_for(lambda: thing.version_waiters)
+        time.sleep(0.05)
+        assert stats.latency.count == 0, stats.latency.count
+
+        read_response(sock, b'')
+        sock.close()
+        assert stats.latency.count == 1, stats.latency.count
+        # The time spent in the handler, not the wait.
+        assert stats.latency.total < 250000, stats.latency.total
+    finally:
+        srv.stop()
+
+
+for _stream_sockets in (False, True):
+    check('long_poll_on_microwebsrv{}'.format(
+        '_stream_sockets' if _stream_sockets else ''))(
+        lambda s=_stream_sockets: check_long_poll(s))
+
+
+def main():
+    names = sys.argv[1:]
+    failed = []
+    for name, func in CHECKS:
+        if names and not any(n in name for n in names):
+            continue
+
+        try:
+            func()
+        except Exception:
+            failed.append(name)
+            print('{:<48} FAIL'.format(name))
+            traceback.print_exc()
+        else:
+            print('{:<48} ok'.format(name))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
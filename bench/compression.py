@@ -0,0 +1,183 @@
+"""
+Wire size and time-to-last-byte of Thing Descriptions, with and without
+compression, under CPython.
+
+Usage:
+    python bench/compression.py [--requests N] [--link-kbps KBPS] [--json FILE]
+
+The server runs on the asyncio backend, on its own thread, and serves the two
+things of the multiple_things example over localhost. The list of things and
+one thing's description are fetched over a keep-alive connection, once with
+no Accept-Encoding header and once for each supported content coding.
+
+For each, reports the bytes on the wire (headers included), the time to the
+last byte of the first response -- which builds, and compresses, the cached
+description -- and the median over the following requests. Localhost is far
+faster than a board's WiFi, so the time the response would take to transmit
+at --link-kbps is reported as well.
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import statistics
+import time
+
+import fakes
+
+fakes.install()
+
+import multiple_things  # noqa: E402
+import server  # noqa: E402
+from utils import start_thread  # noqa: E402
+
+server.WS_messages = False
+
+ENCODINGS = (None, 'gzip', 'deflate')
+
+
+def start_server(port):
+    """
+    Start the server on its own thread.
+
+    Returns the server and a function which stops it.
+    """
+    srv = server.WebThingServer(
+        server.MultipleThings([multiple_things.FakeGpioHumiditySensor(),
+                               multiple_things.ExampleDimmableLight()],
+                              'LightAndTempDevice'),
+        port=port,
+        use_asyncio=True,
+    )
+
+    loop = []
+    done = []
+
+    async def main():
+        loop.append(asyncio.get_running_loop())
+        await srv.serve()
+
+    def run():
+        try:
+            asyncio.run(main())
+        finally:
+            done.append(True)
+
+    start_thread('compression_server', run)
+    while not loop or not srv.server.IsStarted():
+        time.sleep(0.01)
+
+    def stop():
+        loop[0].call_soon_threadsafe(srv.stop)
+        while not done:
+            time.sleep(0.01)
+
+    return srv, stop
+
+
+def read_response(sock):
+    """
+    Read one response from a socket.
+
+    Returns the number of bytes read and the response headers.
+    """
+    data = b''
+    while b'\r\n\r\n' not in data:
+        data += sock.recv(4096)
+
+    head, _, body = data.partition(b'\r\n\r\n')
+    headers = {}
+    for line in head.decode().split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding') == 'chunked':
+        while not body.endswith(b'0\r\n\r\n'):
+            body += sock.recv(4096)
+    else:
+        length = int(headers.get('content-length', 0))
+        while len(body) < length:
+            body += sock.recv(4096)
+
+    return len(head) + 4 + len(body), headers
+
+
+def fetch(sock, port, path, encoding):
+    """
+    Fetch a path.
+
+    Returns the bytes on the wire, the time to the last byte in seconds, and
+    the response headers.
+    """
+    request = 'GET {} HTTP/1.1\r\nHost: localhost:{}\r\n'.format(path, port)
+    if encoding is not None:
+        request += 'Accept-Encoding: {}\r\n'.format(encoding)
+    request += '\r\n'
+
+    start = time.perf_counter()
+    sock.sendall(request.encode())
+    size, headers = read_response(sock)
+    return size, time.perf_counter() - start, headers
+
+
+def measure(port, path, encoding, requests):
+    """Measure the responses to a number of requests for one path."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    try:
+        size, first, headers = fetch(sock, port, path, encoding)
+        times = []
+        for _ in range(requests):
+            times.append(fetch(sock, port, path, encoding)[1])
+    finally:
+        sock.close()
+
+    assert headers.get('content-encoding') == encoding, headers
+    return {
+        'wire_bytes': size,
+        'first_ms': first * 1000,
+        'p50_ms': statistics.median(times) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per path and encoding')
+    parser.add_argument('--link-kbps', type=float, default=1000,
+                        help='link rate to estimate the transmit time at')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also save the report as JSON')
+    args = parser.parse_args()
+
+    srv, stop = start_server(args.port)
+    report = {}
+    try:
+        for path in ('/', '/0'):
+            for encoding in ENCODINGS:
+                # Every path and encoding starts with a cold cache.
+                srv.description_cache.clear()
+                result = measure(args.port, path, encoding, args.requests)
+                result['link_ms'] = \
+                    result['wire_bytes'] * 8 / args.link_kbps
+                report['GET {} {}'.format(path, encoding or 'identity')] = \
+                    result
+    finally:
+        stop()
+
+    print('{:<24} {:>10} {:>10} {:>10} {:>10}'.format(
+        'request', 'wire bytes', 'first ms', 'p50 ms',
+        '@{:g}kbps'.format(args.link_kbps)))
+    for name, result in report.items():
+        print('{:<24} {:>10} {:>10.3f} {:>10.3f} {:>10.2f}'.format(
+            name, result['wire_bytes'], result['first_ms'],
+            result['p50_ms'], result['link_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
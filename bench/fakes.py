@@ -0,0 +1,811 @@
+"""
+Stand-ins for the MicroPython modules used by webthing-upy.
+
+They let the server and the examples run under CPython, so that hot paths can
+be measured without flashing a board. Call install() before importing
+anything from webthing/ or example/.
+"""
+
+import _thread as _cpython_thread
+import base64
+import hashlib
+import json
+import os
+import re
+import socket
+import struct
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeWebSocket:
+    """A MicroWebSocket which only counts what is sent on it."""
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.last = None
+        self.closed = False
+        self.thing = None
+        self.subscriber = None
+        self.RecvTextCallback = None
+        self.RecvBinaryCallback = None
+        self.ClosedCallback = None
+
+    def SendText(self, msg):
+        if self.closed:
+            return False
+
+        self.sent += 1
+        self.sent_bytes += len(msg)
+        self.last = msg
+        return True
+
+    def SendBinary(self, data):
+        return self.SendText(data)
+
+    def IsClosed(self):
+        return self.closed
+
+    def Close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        if self.ClosedCallback is not None:
+            self.ClosedCallback(self)
+
+
+class FakeHttpClient:
+    """A MicroWebSrv client for a request which is already parsed."""
+
+    def __init__(self, method='GET', path='/', headers=None, content=None,
+                 query=None):
+        """
+        Initialize the object.
+
+        method -- HTTP method
+        path -- request path, without query string
+        headers -- dict of request headers
+        content -- request body, as an object to encode as JSON
+        query -- dict of query parameters
+        """
+        self.method = method
+        self.path = path
+        self.headers = headers if headers is not None else {}
+        self.content = content
+        self.query = query if query is not None else {}
+
+    def GetRequestMethod(self):
+        return self.method
+
+    def GetRequestPath(self):
+        return self.path
+
+    def GetRequestTotalPath(self):
+        if not self.query:
+            return self.path
+
+        return self.path + '?' + '&'.join(
+            '{}={}'.format(k, v) for k, v in self.query.items())
+
+    def GetRequestQueryParams(self):
+        return self.query
+
+    def GetRequestHeaders(self):
+        return self.headers
+
+    def ReadRequestContent(self, size=None):
+        if self.content is None:
+            return b''
+
+        return json.dumps(self.content).encode()
+
+    def ReadRequestContentAsJSON(self):
+        return self.content
+
+
+class FakeHttpResponse:
+    """A MicroWebSrv response which keeps the status and the content."""
+
+    def __init__(self):
+        self.code = None
+        self.headers = None
+        self.content = None
+
+    def WriteResponse(self, code, headers, contentType, contentCharset,
+                      content):
+        self.code = code
+        self.headers = headers
+        self.content = content
+        return True
+
+    def WriteResponseChunks(self, code, headers, contentType, contentCharset,
+                            chunks, contentLength=None):
+        return self.WriteResponse(code, headers, contentType, contentCharset,
+                                  b''.join(chunks))
+
+    def WriteResponseOk(self, headers=None, contentType=None,
+                        contentCharset=None, content=None):
+        return self.WriteResponse(200, headers, contentType, contentCharset,
+                                  content)
+
+    def WriteResponseJSONOk(self, obj=None, headers=None):
+        return self.WriteResponse(200, headers, 'application/json', 'UTF-8',
+                                  json.dumps(obj))
+
+    def WriteResponseError(self, code):
+        return self.WriteResponse(code, None, 'text/html', 'UTF-8', None)
+
+    def WriteResponseBadRequest(self):
+        return self.WriteResponseError(400)
+
+    def WriteResponseForbidden(self):
+        return self.WriteResponseError(403)
+
+    def WriteResponseNotFound(self):
+        return self.WriteResponseError(404)
+
+    def WriteResponseFile(self, filepath, contentType=None, headers=None):
+        return self.WriteResponseError(404)
+
+
+class StreamSocket:
+    """
+    A socket which is its own stream, like MicroPython's.
+
+    MicroWebSrv uses such a socket as its own _socketfile.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def readline(self):
+        line = b''
+        while not line.endswith(b'\n'):
+            char = self._sock.recv(1)
+            if not char:
+                break
+            line += char
+
+        return line
+
+    def read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+
+        return data
+
+    def write(self, data):
+        self._sock.sendall(data)
+        return len(data)
+
+    def recv(self, size):
+        return self._sock.recv(size)
+
+    def sendall(self, data):
+        self._sock.sendall(data)
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+
+class SocketHttpClient:
+    """
+    A MicroWebSrv client for a request read from a socket.
+
+    Like MicroWebSrv's, it reads the request and writes the response through
+    _socketfile -- the socket itself on MicroPython, a file made from it
+    under CPython -- and closes both once the route handler returns.
+    """
+
+    def __init__(self, microWebSrv, sock, addr):
+        sock.settimeout(2)
+        self._microWebSrv = microWebSrv
+        if microWebSrv.StreamSockets:
+            sock = StreamSocket(sock)
+            self._socketfile = sock
+        else:
+            self._socketfile = sock.makefile('rwb')
+        self._socket = sock
+        self._addr = addr
+        self._method = None
+        self._path = None
+        self._query = {}
+        self._headers = {}
+
+    def GetRequestMethod(self):
+        return self._method
+
+    def GetRequestPath(self):
+        return self._path
+
+    def GetRequestQueryParams(self):
+        return self._query
+
+    def GetRequestHeaders(self):
+        return self._headers
+
+    def ReadRequestContent(self, size=None):
+        if size is None:
+            size = int(self._headers.get('Content-Length', 0))
+
+        return self._socketfile.read(size) if size else b''
+
+    def ReadRequestContentAsJSON(self):
+        try:
+            return json.loads(self.ReadRequestContent())
+        except ValueError:
+            return None
+
+    def _parseRequest(self):
+        line = self._socketfile.readline().decode().strip().split()
+        if len(line) != 3:
+            return False
+
+        self._method = line[0].upper()
+        self._path, _, query = line[1].partition('?')
+        for param in query.split('&'):
+            name, sep, value = param.partition('=')
+            if sep:
+                self._query[name] = value
+
+        while True:
+            line = self._socketfile.readline().decode().strip()
+            if not line:
+                return True
+
+            name, sep, value = line.partition(':')
+            if sep:
+                self._headers[name.strip()] = value.strip()
+
+    def _processRequest(self):
+        response = SocketHttpResponse(self)
+        try:
+            if not self._parseRequest():
+                response.WriteResponseBadRequest()
+            elif self._headers.get('Upgrade', '').lower() == 'websocket':
+                if self._microWebSrv.AcceptWebSocketCallback is not None:
+                    SocketWebSocket(self._socket, self, response,
+                                    self._microWebSrv)
+                    return
+                response.WriteResponseError(501)
+            else:
+                handler, args = self._microWebSrv.GetRouteHandler(
+                    self._path, self._method)
+                if handler is None:
+                    response.WriteResponseNotFound()
+                elif args is None:
+                    handler(self, response)
+                else:
+                    handler(self, response, args)
+        except Exception:
+            response.WriteResponseError(500)
+
+        try:
+            if self._socketfile is not self._socket:
+                self._socketfile.close()
+            self._socket.close()
+        except Exception:
+            pass
+
+
+class SocketHttpResponse:
+    """A MicroWebSrv response written to a client's _socketfile."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def _write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+
+        return self._client._socketfile.write(data)
+
+    def _writeFirstLine(self, code):
+        self._write('HTTP/1.1 {} {}\r\n'.format(
+            code, _REASONS.get(code, 'Unknown')))
+
+    def _writeHeader(self, name, value):
+        self._write('{}: {}\r\n'.format(name, value))
+
+    def _writeContentTypeHeader(self, contentType, charset=None):
+        if charset:
+            contentType = '{}; charset={}'.format(contentType, charset)
+
+        self._writeHeader('Content-Type', contentType)
+
+    def _writeServerHeader(self):
+        self._writeHeader('Server', 'MicroWebSrv fake')
+
+    def _writeEndHeader(self):
+        self._write('\r\n')
+        self._flush()
+
+    def _flush(self):
+        # MicroPython writes straight to the socket.
+        if hasattr(self._client._socketfile, 'flush'):
+            self._client._socketfile.flush()
+
+    def WriteSwitchProto(self, upgrade, headers=None):
+        self._writeFirstLine(101)
+        self._writeHeader('Connection', 'Upgrade')
+        self._writeHeader('Upgrade', upgrade)
+        for name, value in (headers or {}).items():
+            self._writeHeader(name, value)
+        self._writeServerHeader()
+        self._writeEndHeader()
+
+    def WriteResponse(self, code, headers, contentType, contentCharset,
+                      content):
+        try:
+            if isinstance(content, str):
+                content = content.encode()
+
+            self._writeFirstLine(code)
+            for name, value in (headers or {}).items():
+                self._writeHeader(name, value)
+            if contentType:
+                self._writeContentTypeHeader(contentType, contentCharset)
+            self._writeHeader('Content-Length', len(content) if content else 0)
+            self._writeServerHeader()
+            self._writeHeader('Connection', 'close')
+            self._writeEndHeader()
+            if content:
+                self._write(content)
+                self._flush()
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def WriteResponseOk(self, headers=None, contentType=None,
+                        contentCharset=None, content=None):
+        return self.WriteResponse(200, headers, contentType, contentCharset,
+                                  content)
+
+    def WriteResponseJSONOk(self, obj=None, headers=None):
+        return self.WriteResponse(200, headers, 'application/json', 'UTF-8',
+                                  json.dumps(obj))
+
+    def WriteResponseError(self, code):
+        return self.WriteResponse(code, None, 'text/html', 'UTF-8',
+                                  '{} {}'.format(code, _REASONS.get(code)))
+
+    def WriteResponseBadRequest(self):
+        return self.WriteResponseError(400)
+
+    def WriteResponseForbidden(self):
+        return self.WriteResponseError(403)
+
+    def WriteResponseNotFound(self):
+        return self.WriteResponseError(404)
+
+    def WriteResponseFile(self, filepath, contentType=None, headers=None):
+        return self.WriteResponseError(404)
+
+
+_REASONS = {
+    101: 'Switching Protocols',
+    200: 'OK',
+    201: 'Created',
+    204: 'No Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+}
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class SocketWebSocket:
+    """
+    A MicroWebSocket on a socket.
+
+    Like MicroWebSocket, its handshake never sends Sec-WebSocket-Protocol,
+    and it receives on a thread of its own when WebSocketThreaded is set,
+    else on the server's thread.
+    """
+
+    def __init__(self, sock, httpClient, httpResponse, microWebSrv):
+        self._socket = sock
+        self._lock = _cpython_thread.allocate_lock()
+        self._closed = False
+        self._maxRecvLen = microWebSrv.MaxWebSocketRecvLen
+        self.RecvTextCallback = None
+        self.RecvBinaryCallback = None
+        self.ClosedCallback = None
+
+        key = httpClient.GetRequestHeaders().get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(
+            hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+        httpResponse.WriteSwitchProto('websocket',
+                                      {'Sec-WebSocket-Accept': accept})
+        sock.settimeout(None)
+
+        microWebSrv.AcceptWebSocketCallback(self, httpClient)
+        if microWebSrv.WebSocketThreaded:
+            _cpython_thread.start_new_thread(self._wsProcess, ())
+        else:
+            self._wsProcess()
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise OSError('Connection closed')
+            data += chunk
+
+        return data
+
+    def _wsProcess(self):
+        try:
+            while not self._closed:
+                head = self._recv(2)
+                opcode = head[0] & 0x0f
+                length = head[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack('>H', self._recv(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', self._recv(8))[0]
+
+                mask = self._recv(4) if head[1] & 0x80 else None
+                if length > self._maxRecvLen:
+                    break
+
+                data = self._recv(length)
+                if mask is not None:
+                    data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+                if opcode == 0x1 and self.RecvTextCallback is not None:
+                    self.RecvTextCallback(self, data.decode())
+                elif opcode == 0x2 and self.RecvBinaryCallback is not None:
+                    self.RecvBinaryCallback(self, data)
+                elif opcode == 0x8:
+                    break
+                elif opcode == 0x9:
+                    self._sendFrame(0xa, data)
+        except (OSError, ValueError):
+            pass
+
+        self.Close()
+
+    def _sendFrame(self, opcode, data):
+        if len(data) < 126:
+            head = struct.pack('>BB', 0x80 | opcode, len(data))
+        elif len(data) < 0x10000:
+            head = struct.pack('>BBH', 0x80 | opcode, 126, len(data))
+        else:
+            head = struct.pack('>BBQ', 0x80 | opcode, 127, len(data))
+
+        self._lock.acquire()
+        try:
+            self._socket.sendall(head + data)
+            return True
+        except OSError:
+            return False
+        finally:
+            self._lock.release()
+
+    def SendText(self, msg):
+        if self._closed:
+            return False
+
+        if isinstance(msg, str):
+            msg = msg.encode()
+
+        return self._sendFrame(0x1, msg)
+
+    def SendBinary(self, data):
+        if self._closed:
+            return False
+
+        return self._sendFrame(0x2, data)
+
+    def IsClosed(self):
+        return self._closed
+
+    def Close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._sendFrame(0x8, b'')
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+
+        if self.ClosedCallback is not None:
+            self.ClosedCallback(self)
+
+
+class MicroWebSrv:
+    """
+    A MicroWebSrv which can serve requests over sockets, or have them
+    dispatched by hand.
+
+    Like MicroWebSrv, Start() serves one connection at a time, on one thread,
+    and closes each connection after one response. Set StreamSockets to
+    serve on sockets which are their own streams, as on MicroPython.
+    """
+
+    def __init__(self, routeHandlers=None, port=80, bindIP='0.0.0.0',
+                 webPath='/flash/www'):
+        self.routeHandlers = routeHandlers or []
+        self._routes = [self._compile(route) + (method.upper(), handler)
+                        for route, method, handler in self.routeHandlers]
+        self.port = port
+        self.webPath = webPath
+        self.started = False
+        self.MaxWebSocketRecvLen = 1024
+        self.WebSocketThreaded = True
+        self.WebSocketStackSize = 0
+        self.AcceptWebSocketCallback = None
+        self.StreamSockets = False
+        self._server = None
+
+    def Start(self, threaded=False, stackSize=0):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', self.port))
+        self._server.listen(16)
+        # Stop() is noticed within the accept timeout.
+        self._server.settimeout(0.2)
+        self.started = True
+
+        if threaded:
+            _cpython_thread.start_new_thread(self._serverProcess, ())
+        else:
+            self._serverProcess()
+
+    def _serverProcess(self):
+        while self.started:
+            try:
+                sock, addr = self._server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            SocketHttpClient(self, sock, addr)._processRequest()
+
+        self._server.close()
+
+    def Stop(self):
+        self.started = False
+
+    def IsStarted(self):
+        return self.started
+
+    @staticmethod
+    def _compile(route):
+        # MicroWebSrv drops empty segments, so '/' becomes '$', and matches
+        # the rest of the path as a regular expression.
+        regex = ''
+        arg_names = []
+        for segment in route.split('/'):
+            if segment.startswith('<') and segment.endswith('>'):
+                arg_names.append(segment[1:-1])
+                regex += '/(\\w*)'
+            elif segment:
+                regex += '/' + segment
+
+        return re.compile(regex + '$'), arg_names
+
+    def GetRouteHandler(self, path, method):
+        """
+        Find the route handler for a request, like MicroWebSrv does.
+
+        Returns a (handler, routeArgs) tuple, or (None, None). The route
+        arguments are None for a route without any.
+        """
+        if path.endswith('/'):
+            path = path[:-1]
+
+        method = method.upper()
+        for regex, arg_names, route_method, handler in self._routes:
+            if route_method != method:
+                continue
+
+            m = regex.match(path)
+            if m:
+                if not arg_names:
+                    return handler, None
+
+                return handler, {name: m.group(idx + 1)
+                                 for idx, name in enumerate(arg_names)}
+
+        return None, None
+
+    def Dispatch(self, httpClient, httpResponse=None):
+        """
+        Dispatch a request to its route handler.
+
+        httpClient -- a FakeHttpClient
+        httpResponse -- response to write to, or None to make one
+
+        Returns the response.
+        """
+        if httpResponse is None:
+            httpResponse = FakeHttpResponse()
+
+        handler, args = self.GetRouteHandler(httpClient.GetRequestPath(),
+                                             httpClient.GetRequestMethod())
+        if handler is None:
+            httpResponse.WriteResponseNotFound()
+        elif args is None:
+            handler(httpClient, httpResponse)
+        else:
+            handler(httpClient, httpResponse, args)
+
+        return httpResponse
+
+    def Connect(self, path, headers=None):
+        """
+        Open a WebSocket to the server, like a browser would.
+
+        path -- request path of the WebSocket
+        headers -- dict of request headers
+
+        Returns the FakeWebSocket.
+        """
+        ws = FakeWebSocket()
+        self.AcceptWebSocketCallback(
+            ws, FakeHttpClient('GET', path, headers))
+        return ws
+
+
+class _WLAN:
+
+    def __init__(self, interface=0):
+        self.interface = interface
+
+    def active(self, *args):
+        return True
+
+    def isconnected(self):
+        return True
+
+    def ifconfig(self):
+        return ('192.168.1.2', '255.255.255.0', '192.168.1.1', '192.168.1.1')
+
+    def config(self, name):
+        if name == 'mac':
+            return b'\x24\x0a\xc4\x12\x34\x56'
+
+        return None
+
+
+class _Pin:
+    IN = 1
+    OUT = 3
+
+    def __init__(self, pin, mode=IN, *args, **kwargs):
+        self.pin = pin
+        self.mode = mode
+        self.level = 0
+
+    def value(self, level=None):
+        if level is None:
+            return self.level
+
+        self.level = level
+
+    def irq(self, *args, **kwargs):
+        pass
+
+
+class _PWM:
+
+    def __init__(self, pin, freq=5000, duty=0):
+        self.pin = pin
+        self.frequency = freq
+        self.duty_cycle = duty
+
+    def freq(self, value=None):
+        if value is None:
+            return self.frequency
+
+        self.frequency = value
+
+    def duty(self, value=None):
+        if value is None:
+            return self.duty_cycle
+
+        self.duty_cycle = value
+
+    def deinit(self):
+        pass
+
+
+class _RTC:
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def ntp_sync(self, *args, **kwargs):
+        pass
+
+    def synced(self):
+        return True
+
+
+def _thread_start_new_thread(*args):
+    # The loboris port takes the thread's name as the first argument.
+    if args and isinstance(args[0], str):
+        args = args[1:]
+
+    return _cpython_thread.start_new_thread(*args)
+
+
+def make_modules():
+    """
+    Build the fake modules.
+
+    Returns a dict of module name -> module.
+    """
+    micro_web_srv = types.ModuleType('microWebSrv')
+    micro_web_srv.MicroWebSrv = MicroWebSrv
+
+    network = types.ModuleType('network')
+    network.STA_IF = 0
+    network.AP_IF = 1
+    network.WLAN = _WLAN
+
+    machine = types.ModuleType('machine')
+    machine.Pin = _Pin
+    machine.PWM = _PWM
+    machine.RTC = _RTC
+    machine.reset = lambda: None
+    machine.unique_id = lambda: b'\x24\x0a\xc4\x12\x34\x56'
+
+    # CPython's threading module uses the rest of _thread.
+    thread = types.ModuleType('_thread')
+    thread.__dict__.update(
+        (k, v) for k, v in vars(_cpython_thread).items()
+        if not k.startswith('__'))
+    thread.start_new_thread = _thread_start_new_thread
+    thread.stack_size = lambda *args: 0
+    thread.list = lambda *args: None
+
+    return {
+        'microWebSrv': micro_web_srv,
+        'network': network,
+        'machine': machine,
+        '_thread': thread,
+    }
+
+
+def install():
+    """
+    Install the fake modules and put the webthing-upy directories on the path.
+
+    The upy/ directory is appended rather than prepended, so CPython's own
+    modules take precedence over the micro implementations in it.
+    """
+    sys.modules.update(make_modules())
+
+    for name in ('webthing', 'example'):
+        path = os.path.join(ROOT, name)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    path = os.path.join(ROOT, 'upy')
+    if path not in sys.path:
+        sys.path.append(path)
@@ -0,0 +1,506 @@
+"""
+End-to-end load generator for the webthing-upy server, run under CPython.
+
+Usage:
+    python bench/loadgen.py [--duration S] [--dashboards N] [--sensor-hz HZ]
+                            [--gateway-interval S] [--gets RATE] [--puts RATE]
+                            [--backend asyncio|microwebsrv]
+
+The server listens on localhost. On the asyncio backend, it runs on its own
+thread and event loop, and a sensor task on the server's loop updates a
+property at a fixed rate. On the microwebsrv backend, the fake MicroWebSrv
+serves one connection at a time on its thread, with a thread per WebSocket,
+and the sensor runs on a thread of its own. On the client side, a gateway
+polls /properties, extra clients send GETs and PUTs at fixed rates, and
+dashboards hold WebSockets open and receive the sensor's updates.
+
+Reports p50/p95/p99 request latency per request type, notification delivery
+lag (from the sensor update to the dashboard receiving it), and how many
+notifications were dropped along the way.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+
+import fakes
+
+fakes.install()
+
+from property import Property  # noqa: E402
+from thing import Thing  # noqa: E402
+from value import Value  # noqa: E402
+from utils import start_thread  # noqa: E402
+import server  # noqa: E402
+import subscriber  # noqa: E402
+
+server.WS_messages = False
+
+
+def make_thing():
+    """Make the thing under load."""
+    thing = Thing('urn:dev:ops:loadgen', 'Load Sensor', ['MultiLevelSensor'],
+                  'A sensor under load')
+    thing.add_property(
+        Property(thing,
+                 'level',
+                 Value(0),
+                 metadata={
+                     '@type': 'LevelProperty',
+                     'title': 'Level',
+                     'type': 'integer',
+                     'readOnly': True,
+                 }))
+    thing.add_property(
+        Property(thing,
+                 'setpoint',
+                 Value(20),
+                 metadata={
+                     '@type': 'TargetTemperatureProperty',
+                     'title': 'Setpoint',
+                     'type': 'integer',
+                     'minimum': 0,
+                     'maximum': 100,
+                 }))
+    return thing
+
+
+def percentile(samples, pct):
+    """Get a percentile of a sorted list, by the nearest-rank method."""
+    if not samples:
+        return 0
+
+    idx = max(0, int(round(pct / 100 * len(samples) + 0.5)) - 1)
+    return samples[min(idx, len(samples) - 1)]
+
+
+def summarize(samples):
+    """Summarize latencies, in seconds, as a dict of milliseconds."""
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 2),
+        'p95_ms': round(percentile(samples, 95) * 1000, 2),
+        'p99_ms': round(percentile(samples, 99) * 1000, 2),
+        'max_ms': round(samples[-1] * 1000, 2) if samples else 0,
+    }
+
+
+class Sensor:
+    """Updates the level property at a fixed rate, on the server's loop."""
+
+    def __init__(self, thing, hz):
+        self.value = thing.find_property('level').value
+        self.period = 1 / hz
+        self.sent_at = {}
+        self.last_seq = 0
+        self.running = True
+
+    async def run(self):
+        next_time = time.perf_counter()
+        while self.running:
+            self.last_seq += 1
+            self.sent_at[self.last_seq] = time.perf_counter()
+            self.value.notify_of_external_update(self.last_seq)
+
+            next_time += self.period
+            delay = next_time - time.perf_counter()
+            await asyncio.sleep(max(0, delay))
+
+    def run_thread(self):
+        """Update the property from a thread, for the threaded backend."""
+        next_time = time.perf_counter()
+        while self.running:
+            self.last_seq += 1
+            self.sent_at[self.last_seq] = time.perf_counter()
+            self.value.notify_of_external_update(self.last_seq)
+
+            next_time += self.period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class HttpConnection:
+    """A keep-alive HTTP/1.1 client connection."""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        """
+        Send a request and read the response.
+
+        Returns the status code.
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                '127.0.0.1', self.port)
+
+        content = b'' if body is None else json.dumps(body).encode()
+        self.writer.write(
+            '{} {} HTTP/1.1\r\nHost: localhost:{}\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: {}\r\n\r\n'.format(
+                method, path, self.port, len(content)).encode() + content)
+
+        try:
+            await self.writer.drain()
+            return await self._read_response()
+        except (OSError, EOFError, asyncio.IncompleteReadError, ValueError):
+            self.close()
+            raise
+
+    async def _read_response(self):
+        status = int((await self.reader.readline()).split()[1])
+
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode().strip()
+            if not line:
+                break
+
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self.reader.readexactly(
+                int(headers.get('content-length', 0)))
+
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class Dashboard:
+    """A WebSocket client receiving the sensor's updates."""
+
+    def __init__(self, port, sensor, read_delay=0):
+        self.port = port
+        self.sensor = sensor
+        self.read_delay = read_delay
+        self.lags = []
+        self.first_seq = None
+        self.received = 0
+        self.errors = 0
+
+    async def run(self, stop):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write(
+            'GET / HTTP/1.1\r\nHost: localhost:{}\r\n'
+            'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+            'Sec-WebSocket-Key: {}\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n'.format(
+                self.port, key).encode())
+        await writer.drain()
+
+        while (await reader.readline()).strip():
+            pass
+
+        try:
+            while not stop.is_set():
+                try:
+                    op, payload = await asyncio.wait_for(
+                        self._read_frame(reader), 0.5)
+                except asyncio.TimeoutError:
+                    continue
+
+                if op == 0x8:
+                    break
+                elif op == 0x1:
+                    self._received(payload)
+
+                if self.read_delay:
+                    await asyncio.sleep(self.read_delay)
+        except (OSError, EOFError, asyncio.IncompleteReadError):
+            self.errors += 1
+        finally:
+            writer.close()
+
+    async def _read_frame(self, reader):
+        # Frames from the server are never masked.
+        head = await reader.readexactly(2)
+        length = head[1] & 0x7f
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), 'big')
+
+        return head[0] & 0x0f, await reader.readexactly(length)
+
+    def _received(self, payload):
+        now = time.perf_counter()
+        message = json.loads(payload)
+        if message.get('messageType') != 'propertyStatus':
+            return
+
+        seq = message['data'].get('level')
+        if seq is None:
+            return
+
+        sent_at = self.sensor.sent_at.get(seq)
+        if sent_at is not None:
+            self.lags.append(now - sent_at)
+
+        if self.first_seq is None:
+            self.first_seq = seq
+
+        self.received += 1
+
+    def missed(self, last_seq):
+        """
+        Get the number of updates since connecting which never arrived.
+
+        This includes updates dropped from full queues and updates superseded
+        by a later value within a notify window.
+        """
+        if self.first_seq is None:
+            return 0
+
+        return last_seq - self.first_seq + 1 - self.received
+
+
+async def run_requests(port, method, path, body, rate, stop, latencies,
+                       errors):
+    """Send requests at a fixed rate, on one keep-alive connection."""
+    connection = HttpConnection(port)
+    period = 1 / rate
+    next_time = time.perf_counter()
+    count = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            status = await connection.request(
+                method, path, body(count) if callable(body) else body)
+            if status >= 400:
+                errors.append(status)
+            else:
+                latencies.append(time.perf_counter() - start)
+        except (OSError, EOFError, asyncio.IncompleteReadError, ValueError):
+            errors.append('connection')
+
+        count += 1
+        next_time += period
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            next_time = time.perf_counter()
+
+    connection.close()
+
+
+def start_server(args, thing, sensor):
+    """
+    Start the server and the sensor on their own thread.
+
+    Returns the server and a function which stops it and waits for its thread
+    to finish.
+    """
+    srv = server.WebThingServer(
+        server.SingleThing(thing),
+        port=args.port,
+        use_asyncio=args.backend == 'asyncio',
+        subscriber_queue_size=args.queue_size,
+        subscriber_policy=args.policy,
+    )
+
+    if args.notify_window:
+        thing.set_notify_window(args.notify_window)
+
+    if args.backend == 'microwebsrv':
+        # The server starts its own threads.
+        srv.start()
+        done = []
+
+        def run_sensor():
+            try:
+                sensor.run_thread()
+            finally:
+                done.append(True)
+
+        start_thread('loadgen_sensor', run_sensor)
+
+        def stop_threads():
+            sensor.running = False
+            srv.stop()
+            while not done:
+                time.sleep(0.01)
+
+        return srv, stop_threads
+
+    loop = []
+    done = []
+
+    async def main():
+        task = asyncio.create_task(sensor.run())
+        loop.append(asyncio.get_running_loop())
+        try:
+            await srv.serve()
+        finally:
+            sensor.running = False
+            await task
+
+    def run():
+        try:
+            asyncio.run(main())
+        finally:
+            done.append(True)
+
+    start_thread('loadgen_server', run)
+    while not loop or not srv.server.IsStarted():
+        time.sleep(0.01)
+
+    def stop():
+        loop[0].call_soon_threadsafe(srv.stop)
+        while not done:
+            time.sleep(0.01)
+
+    return srv, stop
+
+
+async def run_clients(args, srv, sensor):
+    stop = asyncio.Event()
+    results = {}
+    tasks = []
+
+    requests = [('gateway GET /properties', 'GET', '/properties', None,
+                 1 / args.gateway_interval if args.gateway_interval else 0)]
+    requests.append(('GET /properties/level', 'GET', '/properties/level',
+                     None, args.gets))
+    requests.append(('PUT /properties/setpoint', 'PUT',
+                     '/properties/setpoint',
+                     lambda n: {'setpoint': n % 101}, args.puts))
+
+    for name, method, path, body, rate in requests:
+        if rate <= 0:
+            continue
+
+        results[name] = ([], [])
+        tasks.append(asyncio.create_task(run_requests(
+            args.port, method, path, body, rate, stop, *results[name])))
+
+    dashboards = [Dashboard(args.port, sensor)
+                  for _ in range(args.dashboards - args.slow_dashboards)]
+    dashboards.extend(Dashboard(args.port, sensor, args.read_delay / 1000)
+                      for _ in range(args.slow_dashboards))
+    for dashboard in dashboards:
+        tasks.append(asyncio.create_task(dashboard.run(stop)))
+
+    await asyncio.sleep(args.duration)
+
+    # Stop the sensor and let its last updates arrive before counting what
+    # was dropped.
+    sensor.running = False
+    await asyncio.sleep(0.5)
+    last_seq = sensor.last_seq
+    stats = srv.getSubscriberStats()
+    stop.set()
+    await asyncio.gather(*tasks)
+
+    return results, dashboards, last_seq, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run for')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--dashboards', type=int, default=20,
+                        help='number of WebSocket clients')
+    parser.add_argument('--slow-dashboards', type=int, default=0,
+                        help='how many of the dashboards read slowly')
+    parser.add_argument('--read-delay', type=float, default=100,
+                        help='milliseconds a slow dashboard takes per message')
+    parser.add_argument('--sensor-hz', type=float, default=50,
+                        help='sensor updates per second')
+    parser.add_argument('--gateway-interval', type=float, default=1,
+                        help='seconds between gateway polls of /properties')
+    parser.add_argument('--gets', type=float, default=0,
+                        help='GET /properties/level requests per second')
+    parser.add_argument('--puts', type=float, default=0,
+                        help='PUT /properties/setpoint requests per second')
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='outbound queue size of each subscriber')
+    parser.add_argument('--policy', default=subscriber.DROP_OLDEST,
+                        choices=[subscriber.DROP_OLDEST, subscriber.COALESCE,
+                                 subscriber.DISCONNECT],
+                        help='overflow policy of the subscriber queues')
+    parser.add_argument('--notify-window', type=int, default=0,
+                        help='milliseconds to coalesce notifications for')
+    parser.add_argument('--backend', default='asyncio',
+                        choices=['asyncio', 'microwebsrv'],
+                        help='server backend to run')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the results as JSON')
+    args = parser.parse_args()
+
+    thing = make_thing()
+    sensor = Sensor(thing, args.sensor_hz)
+    srv, stop_server = start_server(args, thing, sensor)
+
+    try:
+        results, dashboards, last_seq, stats = asyncio.run(
+            run_clients(args, srv, sensor))
+    finally:
+        stop_server()
+
+    report = {'requests': {}}
+    print('{:<28} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'requests', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+        'max ms'))
+    for name, (latencies, errors) in results.items():
+        summary = summarize(latencies)
+        summary['errors'] = len(errors)
+        report['requests'][name] = summary
+        print('{:<28} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+            name, summary['count'], summary['errors'], summary['p50_ms'],
+            summary['p95_ms'], summary['p99_ms'], summary['max_ms']))
+
+    lags = summarize([lag for d in dashboards for lag in d.lags])
+    lags['updates'] = last_seq
+    lags['missed'] = sum(d.missed(last_seq) for d in dashboards)
+    lags['server_dropped'] = sum(s['dropped'] for s in stats)
+    lags['server_coalesced'] = sum(s['coalesced'] for s in stats)
+    lags['disconnected'] = sum(d.errors for d in dashboards)
+    report['notifications'] = lags
+
+    print()
+    print('notifications: {} updates to {} dashboards, {} delivered'.format(
+        last_seq, len(dashboards), lags['count']))
+    print('  lag p50 {p50_ms} ms, p95 {p95_ms} ms, p99 {p99_ms} ms, '
+          'max {max_ms} ms'.format(**lags))
+    print('  missed {} (server queues dropped {}, coalesced {}), '
+          '{} disconnected'.format(lags['missed'], lags['server_dropped'],
+                                   lags['server_coalesced'],
+                                   lags['disconnected']))
+
+    if args.json:
+        report['args'] = vars(args)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
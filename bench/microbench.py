@@ -0,0 +1,595 @@
+"""
+Micro-benchmarks of the webthing-upy hot paths, run under CPython.
+
+Usage:
+    python bench/microbench.py [--save FILE] [--compare FILE] [NAME ...]
+
+Every benchmark reports operations per second, the number of heap blocks
+still allocated per operation once it is done (anything above zero grows
+with uptime), and the peak number of bytes allocated while performing one
+operation. The cost of importing the core modules is measured too. Results
+can be saved as a JSON baseline and later compared against it.
+"""
+
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import fakes
+
+fakes.install()
+
+from errors import PropertyError  # noqa: E402
+from event import Event  # noqa: E402
+from property import Property  # noqa: E402
+from protocols import CBOR, JSON, SSE  # noqa: E402
+from scheduler import Scheduler  # noqa: E402
+from server import RequestContext, SingleThing, WebThingServer  # noqa: E402
+from subscriber import Subscriber  # noqa: E402
+from thing import Thing  # noqa: E402
+from value import Value  # noqa: E402
+import single_thing  # noqa: E402
+
+# Headers of a typical browser request
+HEADERS = {
+    'Host': 'localhost:8888',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Firefox/115.0',
+    'Accept': 'application/json',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+    'Content-Type': 'application/json',
+    'Origin': 'http://localhost:8080',
+}
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Register a benchmark.
+
+    The decorated function sets the benchmark up and returns the operation to
+    time, a function taking no arguments.
+    """
+    def decorator(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+
+    return decorator
+
+
+def make_wide_thing(count):
+    """Make a thing with many properties."""
+    thing = Thing('urn:dev:ops:wide', 'Wide', ['MultiLevelSensor'], 'Wide')
+    for idx in range(count):
+        thing.add_property(
+            Property(thing,
+                     'level{}'.format(idx),
+                     Value(0),
+                     metadata={
+                         '@type': 'LevelProperty',
+                         'title': 'Level {}'.format(idx),
+                         'type': 'integer',
+                         'minimum': 0,
+                         'maximum': 100,
+                         'unit': 'percent',
+                     }))
+    return thing
+
+
+def cycle(values):
+    """Get a function returning the given values over and over."""
+    state = [0]
+
+    def next_value():
+        state[0] = (state[0] + 1) % len(values)
+        return values[state[0]]
+
+    return next_value
+
+
+@benchmark('thing_description')
+def bench_thing_description():
+    return single_thing.make_thing().as_thing_description
+
+
+@benchmark('thing_description_32_properties')
+def bench_thing_description_wide():
+    return make_wide_thing(32).as_thing_description
+
+
+@benchmark('set_value')
+def bench_set_value():
+    prop = single_thing.make_thing().find_property('brightness')
+    next_value = cycle(list(range(101)))
+
+    def op():
+        prop.set_value(next_value())
+
+    return op
+
+
+def baseline_validate_value(metadata, value):
+    # Property.validate_value() before compile_validator(): every write
+    # looked the constraints up in the metadata and compared type names.
+    if 'type' in metadata:
+        t = metadata['type']
+
+        if t == 'boolean':
+            if type(value) is not bool:
+                raise PropertyError('Value must be a boolean')
+        elif t == 'object':
+            if type(value) is not dict:
+                raise PropertyError('Value must be an object')
+        elif t == 'array':
+            if type(value) is not list:
+                raise PropertyError('Value must be an array')
+        elif t == 'number':
+            if type(value) not in [float, int]:
+                raise PropertyError('Value must be a number')
+        elif t == 'integer':
+            if type(value) is not int:
+                raise PropertyError('Value must be an integer')
+        elif t == 'string':
+            if type(value) is not str:
+                raise PropertyError('Value must be a string')
+
+    if 'readOnly' in metadata and metadata['readOnly']:
+        raise PropertyError('Read-only property')
+
+    if 'minimum' in metadata and value < metadata['minimum']:
+        raise PropertyError('Value less than minimum: {}'
+                            .format(metadata['minimum']))
+
+    if 'maximum' in metadata and value > metadata['maximum']:
+        raise PropertyError('Value greater than maximum: {}'
+                            .format(metadata['maximum']))
+
+    if 'enum' in metadata and len(metadata['enum']) > 0 and \
+            value not in metadata['enum']:
+        raise PropertyError('Invalid enum value')
+
+
+@benchmark('validate_value_baseline')
+def bench_validate_value_baseline():
+    metadata = single_thing.make_thing().find_property(
+        'brightness').get_metadata()
+
+    def op():
+        baseline_validate_value(metadata, 50)
+
+    return op
+
+
+@benchmark('validate_value')
+def bench_validate_value():
+    prop = single_thing.make_thing().find_property('brightness')
+
+    def op():
+        prop.validate_value(50)
+
+    return op
+
+
+def make_fanout(count, protocol=JSON):
+    def setup():
+        thing = single_thing.make_thing()
+        prop = thing.find_property('brightness')
+        subscribers = []
+        for _ in range(count):
+            subscriber = Subscriber(fakes.FakeWebSocket(), protocol=protocol)
+            thing.add_subscriber(subscriber)
+            subscribers.append(subscriber)
+
+        send = 'SendBinary' if protocol.binary else 'SendText'
+
+        def op():
+            thing.property_notify(prop)
+            for subscriber in subscribers:
+                getattr(subscriber.ws, send)(subscriber.pop())
+
+        return op
+
+    return setup
+
+
+for _count in (1, 8, 32):
+    benchmark('property_notify_{}_sockets'.format(_count))(
+        make_fanout(_count))
+    benchmark('property_notify_{}_sockets_cbor'.format(_count))(
+        make_fanout(_count, CBOR))
+    benchmark('property_notify_{}_event_streams'.format(_count))(
+        make_fanout(_count, SSE))
+
+
+def make_action_status():
+    thing = single_thing.make_thing()
+    action = thing.perform_action('fade', {'brightness': 50, 'duration': 0})
+    return {
+        'messageType': 'actionStatus',
+        'data': action.as_action_description(),
+    }
+
+
+def make_encode(protocol):
+    def setup():
+        message = make_action_status()
+
+        def op():
+            protocol.dumps(message)
+
+        return op
+
+    return setup
+
+
+def make_decode(protocol):
+    def setup():
+        encoded = protocol.dumps({
+            'messageType': 'setProperty',
+            'data': {'brightness': 50, 'on': True},
+        })
+
+        def op():
+            protocol.loads(encoded)
+
+        return op
+
+    return setup
+
+
+for _protocol in (JSON, CBOR):
+    _suffix = 'cbor' if _protocol.binary else 'json'
+    benchmark('encode_action_status_' + _suffix)(make_encode(_protocol))
+    benchmark('decode_set_property_' + _suffix)(make_decode(_protocol))
+
+
+@benchmark('scheduler_tick_32_timers')
+def bench_scheduler_tick():
+    scheduler = Scheduler(tick_ms=10)
+    for idx in range(32):
+        scheduler.bind(Value(0), lambda: 1, 100 + idx * 10, jitter_ms=20)
+
+    def op():
+        for timer in scheduler.advance(scheduler.tick + 1):
+            timer.func()
+            scheduler.finish(timer, 0, 0)
+
+    return op
+
+
+def make_server():
+    return WebThingServer(SingleThing(single_thing.make_thing()), port=8888)
+
+
+@benchmark('validate_host')
+def bench_validate_host():
+    server = make_server()
+
+    def op():
+        server.validateHost(HEADERS)
+
+    return op
+
+
+@benchmark('get_header')
+def bench_get_header():
+    server = make_server()
+
+    def op():
+        server.getHeader(HEADERS, 'content-type')
+
+    return op
+
+
+@benchmark('request_context')
+def bench_request_context():
+    server = make_server()
+
+    def op():
+        ctx = RequestContext(server, fakes.FakeHttpClient(headers=HEADERS))
+        if ctx.host_valid:
+            ctx.get_header('content-type')
+
+    return op
+
+
+def baseline_validate_host(hosts, headers):
+    # validateHost() before RequestContext: a lowercased copy of the headers,
+    # then a scan of the list of hosts.
+    standardized = {k.lower(): v for k, v in headers.items()}
+    host = standardized.get('host')
+    return host is not None and host.lower() in hosts
+
+
+def baseline_get_header(headers, key, default=None):
+    # getHeader() before RequestContext.
+    standardized = {k.lower(): v for k, v in headers.items()}
+    return standardized.get(key, default)
+
+
+@benchmark('request_context_baseline')
+def bench_request_context_baseline():
+    hosts = list(make_server().hosts)
+
+    def op():
+        client = fakes.FakeHttpClient(headers=HEADERS)
+        headers = client.GetRequestHeaders()
+        if baseline_validate_host(hosts, headers):
+            baseline_get_header(client.GetRequestHeaders(), 'content-type')
+
+    return op
+
+
+@benchmark('thing_request_headers_baseline')
+def bench_thing_request_headers_baseline():
+    # The header work of GET / before RequestContext.
+    server = make_server()
+    hosts = list(server.hosts)
+
+    def op():
+        client = fakes.FakeHttpClient(headers=HEADERS)
+        if not baseline_validate_host(hosts, client.GetRequestHeaders()):
+            return
+
+        headers = client.GetRequestHeaders()
+        'http{}://{}'.format(server.ssl_suffix,
+                             baseline_get_header(headers, 'host', ''))
+        'ws{}://{}'.format(server.ssl_suffix,
+                           baseline_get_header(headers, 'host', ''))
+
+    return op
+
+
+@benchmark('thing_request_headers')
+def bench_thing_request_headers():
+    server = make_server()
+
+    def op():
+        ctx = RequestContext(server, fakes.FakeHttpClient(headers=HEADERS))
+        if ctx.host_valid:
+            ctx.get_base_hrefs()
+
+    return op
+
+
+@benchmark('get_property_request')
+def bench_get_property_request():
+    server = make_server()
+    response = fakes.FakeHttpResponse()
+
+    def op():
+        server.server.Dispatch(
+            fakes.FakeHttpClient('GET', '/properties/brightness', HEADERS),
+            response)
+
+    return op
+
+
+@benchmark('event_accumulation')
+def bench_event_accumulation():
+    thing = single_thing.make_thing()
+    thing.add_subscriber(Subscriber(fakes.FakeWebSocket()))
+
+    def op():
+        thing.add_event(Event(thing, 'overheated', 102))
+
+    return op
+
+
+@benchmark('action_accumulation')
+def bench_action_accumulation():
+    thing = single_thing.make_thing()
+    thing.add_subscriber(Subscriber(fakes.FakeWebSocket()))
+
+    def op():
+        action = thing.perform_action('fade',
+                                      {'brightness': 50, 'duration': 0})
+        action.finish()
+
+    return op
+
+
+# Modules whose import cost is measured
+IMPORTS = ('property', 'thing')
+
+# Imports a module the way the device does, with upy/ ahead of CPython's own
+# modules, and prints the time taken in seconds and the bytes retained.
+_IMPORT_SCRIPT = """
+import os, sys, time, tracemalloc
+root = {root!r}
+sys.path[:0] = [os.path.join(root, 'upy'), os.path.join(root, 'webthing')]
+for name in ('copy', 'types'):
+    sys.modules.pop(name, None)
+trace = {trace!r}
+if trace:
+    tracemalloc.start()
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, tracemalloc.get_traced_memory()[0] if trace else 0)
+"""
+
+
+def measure_import(module, repeat=5):
+    """
+    Measure the cost of importing a module, in fresh interpreters.
+
+    module -- name of the module
+    repeat -- number of timed imports, the fastest of which is reported
+
+    Returns a dict of results.
+    """
+    def run(trace):
+        script = _IMPORT_SCRIPT.format(root=fakes.ROOT, trace=trace,
+                                       module=module)
+        out = subprocess.check_output([sys.executable, '-c', script])
+        elapsed, retained = out.split()
+        return float(elapsed), int(retained)
+
+    best = min(run(False)[0] for _ in range(repeat))
+    return {
+        'import_ms': round(best * 1000, 3),
+        'retained_bytes': run(True)[1],
+    }
+
+
+def run_timed(op, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        op()
+    return time.perf_counter() - start
+
+
+def measure(op, min_time=0.2, repeat=3):
+    """
+    Measure an operation.
+
+    op -- the operation
+    min_time -- minimum duration of each timed run, in seconds
+    repeat -- number of timed runs, the fastest of which is reported
+
+    Returns a dict of results.
+    """
+    # Warm up, which also fills any bounded buffers, so that the allocation
+    # figures only show growth beyond them.
+    count = 1
+    while True:
+        elapsed = run_timed(op, count)
+        if elapsed >= min_time / 10:
+            break
+        count *= 4
+
+    count = max(1, int(count * min_time / elapsed))
+    best = min(run_timed(op, count) for _ in range(repeat))
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    run_timed(op, count)
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+
+    samples = min(count, 100)
+    tracemalloc.start()
+    peak = 0
+    for _ in range(samples):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        op()
+        peak += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+
+    return {
+        'ops_per_sec': round(count / best, 1),
+        'blocks_per_op': round(retained / count, 3),
+        'peak_bytes_per_op': round(peak / samples, 1),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print how results compare to a baseline.
+
+    Returns a list of the names of benchmarks which got slower by more than
+    threshold percent, or which retain more memory per operation.
+    """
+    regressions = []
+    print()
+    print('{:<36} {:>12} {:>12} {:>8}'.format(
+        'benchmark', 'baseline', 'now', 'change'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or 'ops_per_sec' not in result:
+            continue
+
+        change = (result['ops_per_sec'] / base['ops_per_sec'] - 1) * 100
+        flag = ''
+        if change < -threshold or \
+                result['blocks_per_op'] > max(base['blocks_per_op'], 0) + 0.5:
+            flag = '  REGRESSION'
+            regressions.append(name)
+
+        print('{:<36} {:>12.1f} {:>12.1f} {:>+7.1f}%{}'.format(
+            name, base['ops_per_sec'], result['ops_per_sec'], change, flag))
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or 'import_ms' not in result:
+            continue
+
+        for key, unit in (('import_ms', 'ms'), ('retained_bytes', 'bytes')):
+            change = (result[key] / base[key] - 1) * 100 if base[key] else 0
+            print('{:<36} {:>12} {:>12} {:>+7.1f}%'.format(
+                '{} ({})'.format(name, unit), base[key], result[key],
+                change))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('names', nargs='*',
+                        help='only run benchmarks containing these names')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='slowdown, in percent, reported as a regression')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of each timed run, in seconds')
+    parser.add_argument('--no-imports', action='store_true',
+                        help="don't measure the cost of imports")
+    args = parser.parse_args()
+
+    results = {}
+    print('{:<36} {:>12} {:>14} {:>18}'.format(
+        'benchmark', 'ops/sec', 'blocks/op', 'peak bytes/op'))
+    for name, setup in BENCHMARKS:
+        if args.names and not any(n in name for n in args.names):
+            continue
+
+        result = measure(setup(), args.min_time)
+        results[name] = result
+        print('{:<36} {:>12.1f} {:>14.3f} {:>18.1f}'.format(
+            name, result['ops_per_sec'], result['blocks_per_op'],
+            result['peak_bytes_per_op']))
+
+    if not args.no_imports:
+        print()
+        print('{:<36} {:>12} {:>14}'.format('import', 'ms', 'bytes'))
+        for module in IMPORTS:
+            name = 'import_' + module
+            if args.names and not any(n in name for n in args.names):
+                continue
+
+            result = measure_import(module)
+            results[name] = result
+            print('{:<36} {:>12.3f} {:>14}'.format(
+                name, result['import_ms'], result['retained_bytes']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_implementation() + ' ' +
+                platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
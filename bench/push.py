@@ -0,0 +1,242 @@
+"""
+Memory and throughput of Server-Sent Events clients against WebSocket
+clients, under CPython.
+
+Usage:
+    python bench/push.py [--clients N] [--updates N] [--json FILE]
+
+The server runs on the asyncio backend, on its own thread, with the load
+generator's sensor thing. For each transport, N clients connect over
+localhost and the server's heap growth per client is measured with
+tracemalloc. The sensor then updates a property N times as fast as the loop
+allows, and the rate at which the clients receive the updates is reported,
+along with how many were dropped on the way.
+
+On a board the difference is larger than here: with MicroWebSrv, every
+WebSocket gets a thread with its own stack, and an event stream does not.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import selectors
+import socket
+import time
+import tracemalloc
+
+import fakes
+
+fakes.install()
+
+import server  # noqa: E402
+from loadgen import make_thing  # noqa: E402
+from utils import start_thread  # noqa: E402
+
+server.WS_messages = False
+
+# Files whose allocations are the clients', not the server's
+_CLIENT_FILES = ('*/push.py', '*/socket.py', '*/selectors.py')
+
+
+def start_server(port, queue_size):
+    """
+    Start the server on its own thread.
+
+    Returns the server, its thing, its event loop and a function which stops
+    it.
+    """
+    thing = make_thing()
+    srv = server.WebThingServer(server.SingleThing(thing), port=port,
+                                use_asyncio=True,
+                                subscriber_queue_size=queue_size)
+
+    loop = []
+    done = []
+
+    async def main():
+        loop.append(asyncio.get_running_loop())
+        await srv.serve()
+
+    def run():
+        try:
+            asyncio.run(main())
+        finally:
+            done.append(True)
+
+    start_thread('push_server', run)
+    while not loop or not srv.server.IsStarted():
+        time.sleep(0.01)
+
+    def stop():
+        loop[0].call_soon_threadsafe(srv.stop)
+        while not done:
+            time.sleep(0.01)
+
+    return srv, thing, loop[0], stop
+
+
+class Client:
+    """A client counting the messages it receives, on a blocking socket."""
+
+    def __init__(self, port, transport):
+        self.transport = transport
+        self.received = 0
+        self.last = 0
+        self.sock = socket.create_connection(('127.0.0.1', port))
+
+        if transport == 'websocket':
+            request = ('GET / HTTP/1.1\r\nHost: localhost:{}\r\n'
+                       'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                       'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                       'Sec-WebSocket-Version: 13\r\n\r\n')
+        else:
+            request = ('GET /events/stream HTTP/1.1\r\n'
+                       'Host: localhost:{}\r\n\r\n')
+        self.sock.sendall(request.format(port).encode())
+
+        self.buf = b''
+        while b'\r\n\r\n' not in self.buf:
+            self.buf += self.sock.recv(4096)
+        self.buf = self.buf.partition(b'\r\n\r\n')[2]
+
+    def read(self):
+        """Read what is available and count the complete messages in it."""
+        data = self.sock.recv(65536)
+        if not data:
+            return False
+
+        self.buf += data
+        if self.transport == 'websocket':
+            self._parse_frames()
+        else:
+            self._parse_chunks()
+
+        return True
+
+    def _parse_frames(self):
+        # Frames from the server are never masked, and are short.
+        while len(self.buf) >= 2:
+            end = 2 + (self.buf[1] & 0x7f)
+            if len(self.buf) < end:
+                break
+            self.buf = self.buf[end:]
+            self._count()
+
+    def _parse_chunks(self):
+        # Every chunk holds one event.
+        while True:
+            line, sep, rest = self.buf.partition(b'\r\n')
+            if not sep:
+                break
+            end = int(line, 16) + 2
+            if len(rest) < end:
+                break
+            self.buf = rest[end:]
+            self._count()
+
+    def _count(self):
+        self.received += 1
+        self.last = time.perf_counter()
+
+    def close(self):
+        self.sock.close()
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise RuntimeError('Timed out')
+        time.sleep(0.01)
+
+
+def measure(port, transport, thing, loop, args):
+    """Measure one transport."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    clients = [Client(port, transport) for _ in range(args.clients)]
+    wait_for(lambda: len(thing.subscribers) == args.clients)
+    time.sleep(0.2)
+
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    exclude = [tracemalloc.Filter(False, f) for f in _CLIENT_FILES]
+    growth = sum(stat.size_diff for stat in
+                 after.filter_traces(exclude).compare_to(
+                     before.filter_traces(exclude), 'filename'))
+
+    value = thing.find_property('level').value
+
+    async def sensor():
+        for idx in range(args.updates):
+            # Two digits, so every message has the same size.
+            value.notify_of_external_update(10 + idx % 90)
+            await asyncio.sleep(0)
+
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.sock, selectors.EVENT_READ, client)
+
+    start = time.perf_counter()
+    asyncio.run_coroutine_threadsafe(sensor(), loop)
+    while True:
+        events = selector.select(1)
+        if not events:
+            break
+        for key, _ in events:
+            key.data.read()
+
+    received = sum(c.received for c in clients)
+    elapsed = max(c.last for c in clients) - start
+
+    for client in clients:
+        client.close()
+    wait_for(lambda: not thing.subscribers)
+
+    return {
+        'bytes_per_client': growth / args.clients,
+        'messages_per_sec': received / elapsed if elapsed > 0 else 0,
+        'dropped_pct': 100 - received * 100 / (args.updates * args.clients),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--updates', type=int, default=2000,
+                        help='property updates to push')
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='subscriber queue size')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also save the report as JSON')
+    args = parser.parse_args()
+
+    srv, thing, loop, stop = start_server(args.port, args.queue_size)
+    report = {}
+    try:
+        for transport in ('websocket', 'sse'):
+            report[transport] = measure(args.port, transport, thing, loop,
+                                        args)
+    finally:
+        stop()
+
+    print('{:<12} {:>16} {:>14} {:>10}'.format(
+        'transport', 'bytes/client', 'messages/sec', 'dropped'))
+    for transport, result in report.items():
+        print('{:<12} {:>16.0f} {:>14.0f} {:>9.1f}%'.format(
+            transport, result['bytes_per_client'],
+            result['messages_per_sec'], result['dropped_pct']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -51,6 +51,9 @@ class RGBLed(Thing):
                          'description': 'The color of the LED',
                      }))
 
+        # Apply changes to several properties with a single LED update.
+        self.set_group_forwarder(self.setProperties)
+
     def setOnOff(self, onOff):
         print('setOnOff: onOff =', onOff)
         self.on = onOff
@@ -58,10 +61,21 @@ class RGBLed(Thing):
 
     def setRGBColor(self, color):
         print('setRGBColor: color =', color)
+        self.parseColor(color)
+        self.updateLeds()
+
+    def setProperties(self, values):
+        print('setProperties: values =', values)
+        if 'on' in values:
+            self.on = values['on']
+        if 'color' in values:
+            self.parseColor(values['color'])
+        self.updateLeds()
+
+    def parseColor(self, color):
         self.redLevel = int(color[1:3], 16) / 256 * 100
         self.greenLevel = int(color[3:5], 16) / 256 * 100
         self.blueLevel = int(color[5:7], 16) / 256 * 100
-        self.updateLeds()
 
     def updateLeds(self):
         print('updateLeds: on =', self.on, 'r', self.redLevel,
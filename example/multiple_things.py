@@ -6,7 +6,6 @@ from value import Value
 from server import MultipleThings, WebThingServer
 import logging
 import random
-import time
 import uuid
 
 log = logging.getLogger(__name__)
@@ -23,8 +22,9 @@ class FadeAction(Action):
     def __init__(self, thing, input_):
         Action.__init__(self, uuid.uuid4().hex, thing, 'fade', input_=input_)
 
-    def perform_action(self):
-        time.sleep(self.input['duration'] / 1000)
+    async def perform_action(self):
+        if not await self.sleep_async(self.input['duration'] / 1000):
+            return
         self.thing.set_property('brightness', self.input['brightness'])
         self.thing.add_event(OverheatedEvent(self.thing, 102))
 
@@ -133,6 +133,7 @@ class FakeGpioHumiditySensor(Thing):
                      }))
 
         log.debug('starting the sensor update looping task')
+        self.add_sampler(self.level, self.read_from_gpio, 3000, jitter_ms=100)
 
     @staticmethod
     def read_from_gpio():
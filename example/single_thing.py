@@ -5,7 +5,6 @@ from thing import Thing
 from value import Value
 from server import SingleThing, WebThingServer
 import logging
-import time
 import uuid
 
 log = logging.getLogger(__name__)
@@ -22,8 +21,9 @@ class FadeAction(Action):
     def __init__(self, thing, input_):
         Action.__init__(self, uuid.uuid4().hex, thing, 'fade', input_=input_)
 
-    def perform_action(self):
-        time.sleep(self.input['duration'] / 1000)
+    async def perform_action(self):
+        if not await self.sleep_async(self.input['duration'] / 1000):
+            return
         self.thing.set_property('brightness', self.input['brightness'])
         self.thing.add_event(OverheatedEvent(self.thing, 102))
 
@@ -1,5 +1,7 @@
 """High-level Action base class implementation."""
 
+import time
+
 from utils import timestamp
 
 
@@ -24,6 +26,10 @@ class Action:
         self.status = 'created'
         self.time_requested = timestamp()
         self.time_completed = None
+        self.seq = None
+        self.executor = None
+        self.cancelled = False
+        self.on_event_loop = False
 
     def as_action_description(self):
         """
@@ -88,22 +94,135 @@ class Action:
         return self.input
 
     def start(self):
-        """Start performing the action."""
+        """
+        Start performing the action.
+
+        The action is finished even if perform_action() raises, or if it was
+        cancelled once its executor had taken it off the queue.
+        """
+        if self.cancelled:
+            self.finish()
+            return
+
         self.status = 'pending'
         self.thing.action_notify(self)
-        self.perform_action()
-        self.finish()
+        try:
+            result = self.perform_action()
+            if hasattr(result, 'send'):
+                _run_blocking(result)
+        finally:
+            self.finish()
+
+    async def start_async(self):
+        """
+        Start performing the action on a (u)asyncio event loop.
+
+        perform_action() may be a coroutine, in which case it is awaited.
+        The action is finished as start() finishes it, or when its task is
+        cancelled.
+        """
+        if self.cancelled:
+            self.finish()
+            return
+
+        self.on_event_loop = True
+        self.status = 'pending'
+        self.thing.action_notify(self)
+        try:
+            result = self.perform_action()
+            if hasattr(result, 'send'):
+                await result
+        finally:
+            self.finish()
 
     def perform_action(self):
-        """Override this with the code necessary to perform the action."""
+        """
+        Override this with the code necessary to perform the action.
+
+        Long-running actions should check is_cancelled(), or wait with
+        sleep(), so that they can be cancelled. It may be a coroutine, which
+        waits with sleep_async() -- with use_asyncio, a blocking sleep()
+        would hold up every request until the action is done.
+        """
         pass
 
     def cancel(self):
-        """Override this with the code necessary to cancel the action."""
-        pass
+        """
+        Cancel the action.
+
+        A queued action is dropped from its executor's queue, and a running
+        action is asked to stop. Subclasses which override this should call
+        Action.cancel() as well.
+        """
+        self.cancelled = True
+        if self.executor is not None and self.executor.cancel(self):
+            # Never started, so nothing else will finish it.
+            self.finish()
+
+    def is_cancelled(self):
+        """Determine whether or not the action has been cancelled."""
+        return self.cancelled
+
+    def sleep(self, seconds):
+        """
+        Sleep, waking up early if the action is cancelled.
+
+        seconds -- how long to sleep for
+
+        Returns False if the action was cancelled, else True.
+        """
+        while seconds > 0 and not self.cancelled:
+            step = min(seconds, 0.1)
+            time.sleep(step)
+            seconds -= step
+
+        return not self.cancelled
+
+    async def sleep_async(self, seconds):
+        """
+        Sleep without blocking the event loop, waking up early if the action
+        is cancelled.
+
+        Off the event loop, i.e. on MicroWebSrv's action workers, this sleeps
+        like sleep() does.
+
+        seconds -- how long to sleep for
+
+        Returns False if the action was cancelled, else True.
+        """
+        if not self.on_event_loop:
+            return self.sleep(seconds)
+
+        try:
+            import uasyncio as asyncio
+        except ImportError:
+            import asyncio
+
+        # Cancelling the action cancels its task, which ends the sleep.
+        if not self.cancelled:
+            await asyncio.sleep(seconds)
+
+        return not self.cancelled
 
     def finish(self):
         """Finish performing the action."""
-        self.status = 'completed'
+        self.status = 'cancelled' if self.cancelled else 'completed'
         self.time_completed = timestamp()
         self.thing.action_notify(self)
+
+
+def _run_blocking(coro):
+    """
+    Run a perform_action() coroutine off the event loop.
+
+    It may only wait with sleep_async(), which blocks there instead of
+    awaiting -- so the coroutine runs to the end in one step.
+    """
+    try:
+        coro.send(None)
+    except StopIteration:
+        return
+
+    coro.close()
+    raise RuntimeError('Actions can only await sleep_async() without '
+                       'use_asyncio')
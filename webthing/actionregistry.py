@@ -0,0 +1,162 @@
+"""Indexed registry of requested actions."""
+
+import time
+
+
+class ActionRegistry:
+    """
+    The actions requested on a thing, indexed by ID.
+
+    Completed actions are retired into a FIFO and evicted once there are more
+    than max_completed of them, or once they are older than max_age. Every
+    action gets a sequence number, which increases by one for every action
+    added.
+    """
+
+    def __init__(self, max_completed=16, max_age=None):
+        """
+        Initialize the object.
+
+        max_completed -- maximum number of completed actions to keep, or None
+                         to keep them all
+        max_age -- optional number of seconds to keep completed actions for
+        """
+        self.max_completed = max_completed
+        self.max_age = max_age
+        self.by_id = {}
+        self.by_name = {}
+        self.completed = []
+        self.retired = set()
+        self.next_seq = 0
+        self.evicted = 0
+
+    def __len__(self):
+        """Get the number of actions in the registry."""
+        return len(self.by_id)
+
+    def add_name(self, name):
+        """
+        Register an action name.
+
+        name -- the action name
+        """
+        if name not in self.by_name:
+            self.by_name[name] = {}
+
+    def add(self, action):
+        """
+        Add an action.
+
+        action -- the action to add
+
+        Returns the action's sequence number.
+        """
+        self.expire()
+
+        action.seq = self.next_seq
+        self.next_seq += 1
+
+        self.by_id[action.id] = action
+        self.add_name(action.name)
+        self.by_name[action.name][action.id] = action
+        return action.seq
+
+    def get(self, action_id, action_name=None):
+        """
+        Get an action by ID.
+
+        action_id -- ID of the action
+        action_name -- optional name the action must have
+
+        Returns the action, or None if not found.
+        """
+        action = self.by_id.get(action_id)
+        if action is None or \
+                (action_name is not None and action.name != action_name):
+            return None
+
+        return action
+
+    def remove(self, action_id):
+        """
+        Remove an action.
+
+        action_id -- ID of the action
+
+        Returns the removed action, or None if not found.
+        """
+        action = self.by_id.pop(action_id, None)
+        if action is not None:
+            del self.by_name[action.name][action_id]
+            self.retired.discard(action_id)
+
+        return action
+
+    def retire(self, action):
+        """
+        Mark an action completed, making it eligible for eviction.
+
+        action -- the action
+        """
+        if action.id not in self.by_id or action.id in self.retired:
+            return
+
+        self.retired.add(action.id)
+        self.completed.append((time.time(), action.id))
+        self.expire()
+
+    def expire(self):
+        """Evict completed actions beyond the retention limits."""
+        cutoff = None
+        if self.max_age is not None:
+            cutoff = time.time() - self.max_age
+
+        while self.completed:
+            completed_at, action_id = self.completed[0]
+            if action_id not in self.retired:
+                # Already removed by a client.
+                self.completed.pop(0)
+                continue
+
+            if (self.max_completed is not None and
+                    len(self.retired) > self.max_completed) or \
+                    (cutoff is not None and completed_at < cutoff):
+                self.completed.pop(0)
+                self.remove(action_id)
+                self.evicted += 1
+            else:
+                break
+
+    def actions(self, name=None, after=None):
+        """
+        Get the actions, oldest first.
+
+        name -- optional action name to filter by
+        after -- optional sequence number to only get later actions
+
+        Returns a list of actions.
+        """
+        self.expire()
+
+        if name is None:
+            actions = list(self.by_id.values())
+        else:
+            actions = list(self.by_name.get(name, {}).values())
+
+        if after is not None:
+            actions = [a for a in actions if a.seq > after]
+
+        actions.sort(key=lambda a: a.seq)
+        return actions
+
+    def set_retention(self, max_completed, max_age=None):
+        """
+        Change how many completed actions are kept.
+
+        max_completed -- maximum number of completed actions to keep, or None
+                         to keep them all
+        max_age -- optional number of seconds to keep completed actions for
+        """
+        self.max_completed = max_completed
+        self.max_age = max_age
+        self.expire()
@@ -0,0 +1,889 @@
+"""
+Cooperative HTTP and WebSocket server built on (u)asyncio streams.
+
+AsyncWebSrv is a drop-in replacement for the parts of MicroWebSrv used by
+WebThingServer: the same route handler format, the same httpClient,
+httpResponse and webSocket methods, and the same AcceptWebSocketCallback.
+Every connection is a task on a single event loop rather than a thread with
+its own stack, and the module runs unchanged under CPython's asyncio.
+
+Since all connections share one loop, route handlers and anything that sends
+on a webSocket (i.e. Thing.property_notify) must run on the loop, and must not
+block it.
+"""
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import ure as re
+except ImportError:
+    import re
+
+try:
+    from ubinascii import b2a_base64
+    from uhashlib import sha1
+except ImportError:
+    from binascii import b2a_base64
+    from hashlib import sha1
+
+import logging
+import struct
+
+log = logging.getLogger(__name__)
+
+_WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+_WS_OP_CONT = 0x0
+_WS_OP_TEXT = 0x1
+_WS_OP_BINARY = 0x2
+_WS_OP_CLOSE = 0x8
+_WS_OP_PING = 0x9
+_WS_OP_PONG = 0xA
+
+_REASONS = {
+    101: 'Switching Protocols',
+    200: 'OK',
+    201: 'Created',
+    204: 'No Content',
+    301: 'Moved Permanently',
+    302: 'Found',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+
+def _unquote(s):
+    """Decode a percent-encoded URL component."""
+    if '%' not in s and '+' not in s:
+        return s
+
+    s = s.replace('+', ' ')
+    parts = s.split('%')
+    out = bytearray(parts[0].encode())
+    for part in parts[1:]:
+        try:
+            out.append(int(part[:2], 16))
+            out.extend(part[2:].encode())
+        except ValueError:
+            out.extend(b'%' + part.encode())
+
+    return out.decode()
+
+
+async def _read_exactly(reader, size):
+    """Read exactly size bytes from a stream, or raise EOFError."""
+    data = b''
+    while len(data) < size:
+        chunk = await reader.read(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+
+    return data
+
+
+class _Route:
+    """A compiled route handler."""
+
+    def __init__(self, path, method, handler):
+        self.path = path
+        self.method = method.upper()
+        self.handler = handler
+        self.arg_names = []
+
+        regex = ''
+        for segment in path.split('/')[1:]:
+            if segment.startswith('<') and segment.endswith('>'):
+                self.arg_names.append(segment[1:-1])
+                regex += '/([^/]+)'
+            else:
+                regex += '/' + segment
+
+        self.regex = re.compile('^' + regex + '$')
+
+    def match(self, path):
+        """
+        Match a request path against this route.
+
+        Returns a dict of route arguments if matched, else None.
+        """
+        m = self.regex.match(path)
+        if m is None:
+            return None
+
+        args = {}
+        for idx, name in enumerate(self.arg_names):
+            args[name] = _unquote(m.group(idx + 1))
+
+        return args
+
+
+class AsyncWebSrv:
+    """HTTP and WebSocket server running on a (u)asyncio event loop."""
+
+    def __init__(self, routeHandlers=None, port=80, bindIP='0.0.0.0',
+                 webPath=None):
+        """
+        Initialize the server.
+
+        routeHandlers -- list of [path, method, handler] routes, in
+                         MicroWebSrv format
+        port -- port to listen on
+        bindIP -- address to listen on
+        webPath -- unused, for compatibility with MicroWebSrv
+        """
+        self.port = port
+        self.bindIP = bindIP
+        self.routes = [_Route(*r) for r in (routeHandlers or [])]
+        self.AcceptWebSocketCallback = None
+        self.MaxWebSocketRecvLen = 1024
+        self.WebSocketProtocols = []
+        self.MaxRequestContentLen = 4096
+        self.KeepAliveTimeout = 30
+        self.connections = 0
+        self._server = None
+        self._stop_event = None
+
+    def Start(self, threaded=False, stackSize=0):
+        """
+        Run the server until Stop() is called.
+
+        threaded and stackSize are accepted for compatibility with MicroWebSrv
+        and ignored -- the server runs on the calling thread's event loop.
+        """
+        asyncio.run(self.serve())
+
+    def Stop(self):
+        """Stop the server."""
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def IsStarted(self):
+        """Determine whether or not the server is running."""
+        return self._server is not None
+
+    async def serve(self):
+        """Coroutine which accepts connections until Stop() is called."""
+        self._stop_event = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle_connection,
+                                                  self.bindIP,
+                                                  self.port)
+        log.info('AsyncWebSrv listening on {}:{}'.format(self.bindIP,
+                                                         self.port))
+        try:
+            await self._stop_event.wait()
+        finally:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def get_route(self, path, method):
+        """
+        Find the route handler for a request.
+
+        Returns a (route, routeArgs) tuple, or (None, None).
+        """
+        if len(path) > 1 and path.endswith('/'):
+            path = path[:-1]
+
+        for route in self.routes:
+            if route.method != method:
+                continue
+
+            args = route.match(path)
+            if args is not None:
+                return route, args
+
+        return None, None
+
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    client = await asyncio.wait_for(
+                        self._read_request(reader, writer),
+                        self.KeepAliveTimeout)
+                except asyncio.TimeoutError:
+                    break
+
+                if client is None:
+                    break
+
+                if client.is_websocket_upgrade() and \
+                        self.AcceptWebSocketCallback is not None:
+                    await self._run_websocket(client, reader, writer)
+                    break
+
+                keep_alive = client.error is None and client.keep_alive()
+                response = _Response(writer, keep_alive)
+
+                if client.error is not None:
+                    response.WriteResponseError(client.error)
+                else:
+                    self._dispatch(client, response)
+
+                if response.deferred is not None:
+                    deferred = response.deferred
+                    response.deferred = None
+                    await deferred
+
+                if not response.written:
+                    response.WriteResponseInternalServerError()
+
+                await writer.drain()
+
+                if response.stream is not None:
+                    await response.write_stream()
+
+                if response.event_stream is not None:
+                    await response.event_stream.run(reader)
+                    break
+        except (OSError, EOFError):
+            pass
+        finally:
+            self.connections -= 1
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except (OSError, EOFError):
+                pass
+
+    def _dispatch(self, client, response):
+        route, args = self.get_route(client.path, client.method)
+        if route is None:
+            response.WriteResponseNotFound()
+            return
+
+        try:
+            if route.arg_names:
+                route.handler(client, response, args)
+            else:
+                route.handler(client, response)
+        except Exception as err:
+            log.error('Error in handler for {} {}: {}'.format(
+                client.method, client.path, err))
+
+    async def _read_request(self, reader, writer):
+        line = await reader.readline()
+        if not line:
+            return None
+
+        try:
+            method, target, version = line.decode().strip().split(' ', 2)
+        except ValueError:
+            return None
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                return None
+
+            line = line.decode().strip()
+            if not line:
+                break
+
+            idx = line.find(':')
+            if idx > 0:
+                headers[line[:idx].strip()] = line[idx + 1:].strip()
+
+        client = _Client(self, writer, method.upper(), target, version,
+                         headers)
+
+        length = client.GetRequestContentLength()
+        if length > self.MaxRequestContentLen:
+            client.error = 413
+        elif length > 0:
+            client.content = await _read_exactly(reader, length)
+
+        return client
+
+    async def _run_websocket(self, client, reader, writer):
+        key = client.get_header('sec-websocket-key')
+        if key is None:
+            response = _Response(writer, False)
+            response.WriteResponseBadRequest()
+            await writer.drain()
+            return
+
+        # Select the first subprotocol offered by the client which is
+        # supported -- the accept callback can then check ws.protocol.
+        protocol = None
+        offered = client.get_header('sec-websocket-protocol')
+        if offered:
+            for name in offered.split(','):
+                name = name.strip()
+                if name in self.WebSocketProtocols:
+                    protocol = name
+                    break
+
+        accept = b2a_base64(sha1(key.encode() + _WS_GUID).digest()).strip()
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\n'
+                     b'Upgrade: websocket\r\n'
+                     b'Connection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n')
+        if protocol is not None:
+            writer.write(b'Sec-WebSocket-Protocol: ' + protocol.encode() +
+                         b'\r\n')
+        writer.write(b'\r\n')
+        await writer.drain()
+
+        ws = _WebSocket(self, client, writer)
+        ws.protocol = protocol
+        self.AcceptWebSocketCallback(ws, client)
+
+        try:
+            await ws.run(reader)
+        except (OSError, EOFError):
+            pass
+        finally:
+            ws.closed = True
+            if ws.ClosedCallback is not None:
+                ws.ClosedCallback(ws)
+
+
+class _Client:
+    """An HTTP request, exposing the MicroWebSrv httpClient interface."""
+
+    def __init__(self, server, writer, method, target, version, headers):
+        self.server = server
+        self.writer = writer
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.content = None
+        self.error = None
+        self._lower_headers = None
+
+        idx = target.find('?')
+        if idx >= 0:
+            self.path = _unquote(target[:idx])
+            self.query_string = target[idx + 1:]
+        else:
+            self.path = _unquote(target)
+            self.query_string = ''
+
+    def get_header(self, name, default=None):
+        """Get a header by its lowercased name."""
+        if self._lower_headers is None:
+            self._lower_headers = {k.lower(): v
+                                   for k, v in self.headers.items()}
+
+        return self._lower_headers.get(name, default)
+
+    def keep_alive(self):
+        """Determine whether or not the connection should be kept open."""
+        connection = self.get_header('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+
+        return connection != 'close'
+
+    def is_websocket_upgrade(self):
+        """Determine whether or not this is a WebSocket upgrade request."""
+        return self.get_header('upgrade', '').lower() == 'websocket'
+
+    def GetServer(self):
+        return self.server
+
+    def GetAddr(self):
+        return self.writer.get_extra_info('peername')
+
+    def GetIPAddr(self):
+        return self.GetAddr()[0]
+
+    def GetPort(self):
+        return self.GetAddr()[1]
+
+    def GetRequestMethod(self):
+        return self.method
+
+    def GetRequestTotalPath(self):
+        if self.query_string:
+            return '{}?{}'.format(self.path, self.query_string)
+
+        return self.path
+
+    def GetRequestPath(self):
+        return self.path
+
+    def GetRequestQueryString(self):
+        return self.query_string
+
+    def GetRequestQueryParams(self):
+        params = {}
+        for param in self.query_string.split('&'):
+            if not param:
+                continue
+
+            idx = param.find('=')
+            if idx >= 0:
+                params[_unquote(param[:idx])] = _unquote(param[idx + 1:])
+            else:
+                params[_unquote(param)] = ''
+
+        return params
+
+    def GetRequestHeaders(self):
+        return self.headers
+
+    def GetRequestContentType(self):
+        return self.get_header('content-type')
+
+    def GetRequestContentLength(self):
+        try:
+            return int(self.get_header('content-length', 0))
+        except ValueError:
+            return 0
+
+    def ReadRequestContent(self, size=None):
+        if self.content is None:
+            return b''
+
+        if size is None:
+            return self.content
+
+        return self.content[:size]
+
+    def ReadRequestContentAsJSON(self):
+        try:
+            return json.loads(self.ReadRequestContent().decode())
+        except (ValueError, UnicodeError):
+            return None
+
+
+class _Response:
+    """An HTTP response, exposing the MicroWebSrv httpResponse interface."""
+
+    def __init__(self, writer, keep_alive):
+        self.writer = writer
+        self.keep_alive = keep_alive
+        self.written = False
+        self.stream = None
+        self.stream_chunked = False
+        self.event_stream = None
+        self.deferred = None
+
+    def _write_head(self, code, headers, contentType, contentCharset,
+                    length):
+        lines = ['HTTP/1.1 {} {}'.format(code, _REASONS.get(code, ''))]
+        if headers:
+            for name, value in headers.items():
+                lines.append('{}: {}'.format(name, value))
+
+        if contentType:
+            if contentCharset:
+                contentType = '{}; charset={}'.format(contentType,
+                                                      contentCharset)
+            lines.append('Content-Type: {}'.format(contentType))
+
+        if length is None:
+            lines.append('Transfer-Encoding: chunked')
+        else:
+            lines.append('Content-Length: {}'.format(length))
+        lines.append('Connection: {}'.format(
+            'keep-alive' if self.keep_alive else 'close'))
+        lines.append('\r\n')
+
+        self.writer.write('\r\n'.join(lines).encode())
+        self.written = True
+
+    async def write_stream(self):
+        """Write the chunks of a streamed response, draining after each."""
+        stream = self.stream
+        self.stream = None
+
+        for chunk in stream:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+
+            if not chunk:
+                continue
+
+            if self.stream_chunked:
+                self.writer.write('{:x}\r\n'.format(len(chunk)).encode())
+                self.writer.write(chunk)
+                self.writer.write(b'\r\n')
+            else:
+                self.writer.write(chunk)
+
+            await self.writer.drain()
+
+        if self.stream_chunked:
+            self.writer.write(b'0\r\n\r\n')
+            await self.writer.drain()
+
+    def WriteResponse(self, code, headers, contentType, contentCharset,
+                      content):
+        if isinstance(content, str):
+            content = content.encode()
+
+        self._write_head(code, headers, contentType, contentCharset,
+                         len(content) if content else 0)
+        if content:
+            self.writer.write(content)
+
+        return True
+
+    def WriteResponseChunks(self, code, headers, contentType, contentCharset,
+                            chunks, contentLength=None):
+        """
+        Write a response whose content is produced piece by piece.
+
+        The chunks are written, and the stream drained, one at a time after
+        the handler returns, so the content never has to be in memory at
+        once.
+
+        chunks -- iterable of strings or bytes
+        contentLength -- length of the content in bytes, if known -- else
+                         chunked transfer encoding is used
+        """
+        self._write_head(code, headers, contentType, contentCharset,
+                         contentLength)
+        self.stream = chunks
+        self.stream_chunked = contentLength is None
+        return True
+
+    def WriteResponseLater(self, awaitable):
+        """
+        Write the response once the handler has returned, i.e. when
+        something the request waits for has happened.
+
+        awaitable -- coroutine which writes the response, with the usual
+                     WriteResponse*() methods
+        """
+        self.deferred = awaitable
+
+    def WriteResponseEventStream(self, headers):
+        """
+        Start a Server-Sent Events response.
+
+        The connection is kept open, and closed rather than reused once the
+        stream is done.
+
+        headers -- dict of headers
+
+        Returns the stream, which has the SendText(), IsClosed() and Close()
+        methods and ClosedCallback of a webSocket.
+        """
+        self.keep_alive = False
+        self._write_head(200, headers, 'text/event-stream', 'UTF-8', None)
+        self.event_stream = _EventStream(self.writer)
+        return self.event_stream
+
+    def WriteResponseOk(self, headers=None, contentType=None,
+                        contentCharset=None, content=None):
+        return self.WriteResponse(200, headers, contentType, contentCharset,
+                                  content)
+
+    def WriteResponseJSONOk(self, obj=None, headers=None):
+        return self.WriteResponse(200, headers, 'application/json', 'UTF-8',
+                                  json.dumps(obj))
+
+    def WriteResponseRedirect(self, location):
+        return self.WriteResponse(302, {'Location': location}, None, None,
+                                  None)
+
+    def WriteResponseError(self, code):
+        reason = _REASONS.get(code, '')
+        return self.WriteResponse(code, None, 'text/plain', 'UTF-8',
+                                  '{} {}'.format(code, reason))
+
+    def WriteResponseBadRequest(self):
+        return self.WriteResponseError(400)
+
+    def WriteResponseForbidden(self):
+        return self.WriteResponseError(403)
+
+    def WriteResponseNotFound(self):
+        return self.WriteResponseError(404)
+
+    def WriteResponseMethodNotAllowed(self):
+        return self.WriteResponseError(405)
+
+    def WriteResponseInternalServerError(self):
+        return self.WriteResponseError(500)
+
+    def WriteResponseNotImplemented(self):
+        return self.WriteResponseError(501)
+
+
+class _Stream:
+    """A connection which messages are pushed on as they are sent."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.closed = False
+        self.ClosedCallback = None
+        self._draining = False
+
+    def _schedule_drain(self):
+        if not self._draining:
+            self._draining = True
+            asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            await self.writer.drain()
+        except (OSError, EOFError):
+            self.closed = True
+        finally:
+            self._draining = False
+
+    def IsClosed(self):
+        return self.closed
+
+
+class _EventStream(_Stream):
+    """
+    A Server-Sent Events stream, sent with chunked transfer encoding.
+
+    Events are sent already encoded as chunks, as bytes.
+    """
+
+    async def run(self, reader):
+        """Wait for the client, or Close(), to end the stream."""
+        try:
+            while not self.closed:
+                if not await reader.read(64):
+                    break
+        except (OSError, EOFError):
+            pass
+        finally:
+            self.closed = True
+            if self.ClosedCallback is not None:
+                self.ClosedCallback(self)
+
+    def SendText(self, msg):
+        if self.closed:
+            return False
+
+        try:
+            self.writer.write(msg)
+            self._schedule_drain()
+        except OSError:
+            self.closed = True
+            return False
+
+        return True
+
+    async def send_text(self, msg):
+        """
+        Send an event and wait for it to be flushed.
+
+        Returns a boolean indicating whether or not the event was sent.
+        """
+        if self.closed:
+            return False
+
+        try:
+            self.writer.write(msg)
+            await self.writer.drain()
+        except (OSError, EOFError):
+            self.closed = True
+            return False
+
+        return True
+
+    def Close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.writer.write(b'0\r\n\r\n')
+                # Closing the writer ends the pending read in run().
+                self.writer.close()
+            except OSError:
+                pass
+
+
+class _WebSocket(_Stream):
+    """A WebSocket connection, exposing the MicroWebSocket interface."""
+
+    def __init__(self, server, client, writer):
+        _Stream.__init__(self, writer)
+        self.server = server
+        self.client = client
+        self.RecvTextCallback = None
+        self.RecvBinaryCallback = None
+        self.protocol = None
+
+    async def run(self, reader):
+        """Receive frames until the connection is closed."""
+        fragments = None
+        fragments_op = None
+
+        while not self.closed:
+            op, fin, payload = await self._read_frame(reader)
+            if op is None:
+                break
+
+            if op == _WS_OP_CLOSE:
+                if not self.closed:
+                    self._send_frame(_WS_OP_CLOSE, payload[:2])
+                    await self.writer.drain()
+                break
+            elif op == _WS_OP_PING:
+                self._send_frame(_WS_OP_PONG, payload)
+                continue
+            elif op == _WS_OP_PONG:
+                continue
+
+            if op == _WS_OP_CONT:
+                if fragments is None:
+                    break
+                fragments += payload
+                if len(fragments) > self.server.MaxWebSocketRecvLen:
+                    self.Close()
+                    break
+                if not fin:
+                    continue
+                op = fragments_op
+                payload = bytes(fragments)
+                fragments = None
+            elif not fin:
+                fragments = bytearray(payload)
+                fragments_op = op
+                continue
+
+            if op == _WS_OP_TEXT:
+                try:
+                    msg = payload.decode()
+                except UnicodeError:
+                    # 1007: invalid frame payload data
+                    await self._fail(1007)
+                    break
+                if self.RecvTextCallback is not None:
+                    self.RecvTextCallback(self, msg)
+            elif op == _WS_OP_BINARY:
+                if self.RecvBinaryCallback is not None:
+                    self.RecvBinaryCallback(self, payload)
+
+            await self.writer.drain()
+
+    async def _read_frame(self, reader):
+        b0, b1 = struct.unpack('>BB', await _read_exactly(reader, 2))
+        fin = bool(b0 & 0x80)
+        op = b0 & 0x0F
+        masked = bool(b1 & 0x80)
+        length = b1 & 0x7F
+
+        if length == 126:
+            length = struct.unpack('>H', await _read_exactly(reader, 2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', await _read_exactly(reader, 8))[0]
+
+        if length > self.server.MaxWebSocketRecvLen:
+            # 1009: message too big
+            await self._fail(1009)
+            return None, None, None
+
+        mask = await _read_exactly(reader, 4) if masked else None
+        payload = await _read_exactly(reader, length) if length else b''
+
+        if mask is not None:
+            payload = bytearray(payload)
+            for i in range(length):
+                payload[i] ^= mask[i & 3]
+            payload = bytes(payload)
+
+        return op, fin, payload
+
+    async def _fail(self, code):
+        """Close the connection with a status code, without waiting."""
+        self._send_frame(_WS_OP_CLOSE, struct.pack('>H', code))
+        self.closed = True
+        await self.writer.drain()
+
+    def _write_frame(self, op, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('>BB', 0x80 | op, length)
+        elif length < 0x10000:
+            header = struct.pack('>BBH', 0x80 | op, 126, length)
+        else:
+            header = struct.pack('>BBQ', 0x80 | op, 127, length)
+
+        self.writer.write(header + payload)
+
+    def _send_frame(self, op, payload):
+        self._write_frame(op, payload)
+        self._schedule_drain()
+
+    def SendText(self, msg):
+        if self.closed:
+            return False
+
+        try:
+            self._send_frame(_WS_OP_TEXT, msg.encode())
+        except OSError:
+            self.closed = True
+            return False
+
+        return True
+
+    async def send_text(self, msg):
+        """
+        Send a text message and wait for it to be flushed.
+
+        Returns a boolean indicating whether or not the message was sent.
+        """
+        return await self._send_and_drain(_WS_OP_TEXT, msg.encode())
+
+    async def send_binary(self, data):
+        """
+        Send a binary message and wait for it to be flushed.
+
+        Returns a boolean indicating whether or not the message was sent.
+        """
+        return await self._send_and_drain(_WS_OP_BINARY, bytes(data))
+
+    async def _send_and_drain(self, op, payload):
+        if self.closed:
+            return False
+
+        try:
+            self._write_frame(op, payload)
+            await self.writer.drain()
+        except (OSError, EOFError):
+            self.closed = True
+            return False
+
+        return True
+
+    def SendBinary(self, data):
+        if self.closed:
+            return False
+
+        try:
+            self._send_frame(_WS_OP_BINARY, bytes(data))
+        except OSError:
+            self.closed = True
+            return False
+
+        return True
+
+    def Close(self):
+        if not self.closed:
+            try:
+                # 1000: normal closure
+                self._send_frame(_WS_OP_CLOSE, struct.pack('>H', 1000))
+            except OSError:
+                pass
+            self.closed = True
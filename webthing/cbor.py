@@ -0,0 +1,206 @@
+"""
+Compact binary encoding of JSON-like values, as CBOR (RFC 8949).
+
+Only the data model of JSON is supported: None, booleans, integers, floats,
+strings, lists and dictionaries. Byte strings are encoded and decoded as
+well, and tags are decoded as the value they tag.
+"""
+
+import struct
+
+# Major types, shifted into the initial byte
+_UINT = 0x00
+_NINT = 0x20
+_BYTES = 0x40
+_TEXT = 0x60
+_ARRAY = 0x80
+_MAP = 0xa0
+_TAG = 0xc0
+_SIMPLE = 0xe0
+
+_FALSE = b'\xf4'
+_TRUE = b'\xf5'
+_NULL = b'\xf6'
+
+# MicroPython's struct module raises ValueError
+_StructError = getattr(struct, 'error', ValueError)
+
+
+def _head(out, major, n):
+    if n < 24:
+        out.append(major | n)
+    elif n < 0x100:
+        out.append(major | 24)
+        out.append(n)
+    elif n < 0x10000:
+        out.append(major | 25)
+        out.extend(struct.pack('>H', n))
+    elif n < 0x100000000:
+        out.append(major | 26)
+        out.extend(struct.pack('>I', n))
+    else:
+        out.append(major | 27)
+        out.extend(struct.pack('>Q', n))
+
+
+def _encode(out, obj):
+    # The most common types in Thing messages are checked first.
+    if isinstance(obj, str):
+        data = obj.encode()
+        _head(out, _TEXT, len(data))
+        out.extend(data)
+    elif obj is True:
+        out.extend(_TRUE)
+    elif obj is False:
+        out.extend(_FALSE)
+    elif isinstance(obj, int):
+        if obj >= 0:
+            _head(out, _UINT, obj)
+        else:
+            _head(out, _NINT, -1 - obj)
+    elif isinstance(obj, float):
+        # Use single precision when no precision is lost.
+        try:
+            single = struct.pack('>f', obj)
+        except OverflowError:
+            single = None
+
+        if single is not None and \
+                (struct.unpack('>f', single)[0] == obj or obj != obj):
+            out.append(0xfa)
+            out.extend(single)
+        else:
+            out.append(0xfb)
+            out.extend(struct.pack('>d', obj))
+    elif isinstance(obj, dict):
+        _head(out, _MAP, len(obj))
+        for key, value in obj.items():
+            _encode(out, str(key))
+            _encode(out, value)
+    elif isinstance(obj, (list, tuple)):
+        _head(out, _ARRAY, len(obj))
+        for value in obj:
+            _encode(out, value)
+    elif obj is None:
+        out.extend(_NULL)
+    elif isinstance(obj, (bytes, bytearray)):
+        _head(out, _BYTES, len(obj))
+        out.extend(obj)
+    else:
+        raise TypeError('{!r} is not CBOR serializable'.format(obj))
+
+
+def dumps(obj):
+    """
+    Encode an object as CBOR.
+
+    obj -- the object to encode
+
+    Returns the encoded bytes.
+    """
+    out = bytearray()
+    _encode(out, obj)
+    return bytes(out)
+
+
+def _half(bits):
+    # Decode an IEEE 754 half precision float -- MicroPython's struct module
+    # has no 'e' format.
+    exp = (bits >> 10) & 0x1f
+    mant = bits & 0x3ff
+    if exp == 0:
+        value = mant * 2.0 ** -24
+    elif exp == 0x1f:
+        value = float('nan') if mant else float('inf')
+    else:
+        value = (mant + 1024) * 2.0 ** (exp - 25)
+
+    return -value if bits & 0x8000 else value
+
+
+def _decode(data, pos):
+    initial = data[pos]
+    major = initial & 0xe0
+    info = initial & 0x1f
+    pos += 1
+
+    if major == _SIMPLE:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info == 22 or info == 23:
+            return None, pos
+        if info == 25:
+            return _half(struct.unpack_from('>H', data, pos)[0]), pos + 2
+        if info == 26:
+            return struct.unpack_from('>f', data, pos)[0], pos + 4
+        if info == 27:
+            return struct.unpack_from('>d', data, pos)[0], pos + 8
+        raise ValueError('Unsupported CBOR simple value')
+
+    if info < 24:
+        n = info
+    elif info == 24:
+        n = data[pos]
+        pos += 1
+    elif info == 25:
+        n = struct.unpack_from('>H', data, pos)[0]
+        pos += 2
+    elif info == 26:
+        n = struct.unpack_from('>I', data, pos)[0]
+        pos += 4
+    elif info == 27:
+        n = struct.unpack_from('>Q', data, pos)[0]
+        pos += 8
+    else:
+        raise ValueError('Indefinite length CBOR items are not supported')
+
+    if major == _UINT:
+        return n, pos
+    if major == _NINT:
+        return -1 - n, pos
+    if major == _BYTES or major == _TEXT:
+        end = pos + n
+        if end > len(data):
+            raise ValueError('Truncated CBOR string')
+        value = bytes(data[pos:end])
+        if major == _TEXT:
+            value = value.decode()
+        return value, end
+    if major == _ARRAY:
+        value = []
+        for _ in range(n):
+            item, pos = _decode(data, pos)
+            value.append(item)
+        return value, pos
+    if major == _MAP:
+        value = {}
+        for _ in range(n):
+            key, pos = _decode(data, pos)
+            value[key], pos = _decode(data, pos)
+        return value, pos
+
+    # A tag -- return the tagged value as it is.
+    return _decode(data, pos)
+
+
+def loads(data):
+    """
+    Decode a CBOR encoded object.
+
+    data -- the encoded bytes
+
+    Returns the decoded object. Raises ValueError if the data is not valid
+    CBOR, or not entirely made of one item.
+    """
+    try:
+        obj, pos = _decode(data, 0)
+    except (IndexError, TypeError, RuntimeError, UnicodeError,
+            _StructError):
+        raise ValueError('Truncated or invalid CBOR')
+
+    if pos != len(data):
+        raise ValueError('Extra data after CBOR item')
+
+    return obj
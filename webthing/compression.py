@@ -0,0 +1,90 @@
+"""HTTP content compression."""
+
+try:
+    import zlib
+    zlib.compressobj
+except (ImportError, AttributeError):
+    # MicroPython's zlib can only decompress -- its deflate module compresses
+    # if the firmware was built with MICROPY_PY_DEFLATE_COMPRESS.
+    zlib = None
+
+try:
+    import deflate
+    import io
+except ImportError:
+    deflate = None
+
+# Content codings, in order of preference
+_ENCODINGS = ('gzip', 'deflate')
+
+# Window size of the encoder -- 2**12 bytes covers the repetition between the
+# properties of a description, and keeps the encoder small enough for a board.
+_WBITS = 12
+
+
+def is_available():
+    """Determine whether content can be compressed on this platform."""
+    return zlib is not None or deflate is not None
+
+
+def choose_encoding(accept):
+    """
+    Choose a content coding for a response.
+
+    accept -- value of the request's Accept-Encoding header, or None
+
+    Returns 'gzip', 'deflate', or None to send the content as it is.
+    """
+    if not accept:
+        return None
+
+    accepted = []
+    for item in accept.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    if float(value) <= 0:
+                        coding = None
+                except ValueError:
+                    coding = None
+
+        if coding is not None:
+            accepted.append(coding)
+
+    for coding in _ENCODINGS:
+        if coding in accepted:
+            return coding
+
+    return None
+
+
+def compress(data, encoding):
+    """
+    Compress content with a content coding.
+
+    data -- the content, as bytes
+    encoding -- 'gzip' or 'deflate'
+
+    Returns the compressed content, or None if it can't be compressed here.
+    """
+    if zlib is not None:
+        # The gzip container is selected by adding 16 to the window bits.
+        wbits = _WBITS + 16 if encoding == 'gzip' else _WBITS
+        encoder = zlib.compressobj(9, zlib.DEFLATED, wbits)
+        return encoder.compress(data) + encoder.flush()
+
+    if deflate is not None:
+        fmt = deflate.GZIP if encoding == 'gzip' else deflate.ZLIB
+        buf = io.BytesIO()
+        try:
+            with deflate.DeflateIO(buf, fmt, _WBITS) as encoder:
+                encoder.write(data)
+        except (OSError, NotImplementedError):
+            return None
+
+        return buf.getvalue()
+
+    return None
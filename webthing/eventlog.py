@@ -0,0 +1,157 @@
+"""Bounded, indexed log of events."""
+
+import time
+
+
+class EventLog:
+    """
+    A fixed-capacity ring of events, indexed by event name.
+
+    Once the log is full, adding an event overwrites the oldest one, so memory
+    use does not grow with the event history. Events can also be expired by
+    age. Every event gets a sequence number, which increases by one for every
+    event added.
+    """
+
+    def __init__(self, capacity=32, max_age=None):
+        """
+        Initialize the object.
+
+        capacity -- maximum number of events to keep
+        max_age -- optional maximum age of events to keep, in seconds
+        """
+        self.capacity = capacity
+        self.max_age = max_age
+        self.slots = [None] * capacity
+        self.times = [0] * capacity
+        self.by_name = {}
+        self.first_seq = 0
+        self.next_seq = 0
+
+    def __len__(self):
+        """Get the number of events in the log."""
+        return self.next_seq - self.first_seq
+
+    def add(self, event):
+        """
+        Add an event, evicting the oldest one if the log is full.
+
+        event -- the event to add
+
+        Returns the event's sequence number.
+        """
+        self.expire()
+
+        if len(self) == self.capacity:
+            self._evict_oldest()
+
+        seq = self.next_seq
+        idx = seq % self.capacity
+        self.slots[idx] = event
+        self.times[idx] = time.time()
+        self.next_seq += 1
+
+        name = event.get_name()
+        if name not in self.by_name:
+            self.by_name[name] = []
+        self.by_name[name].append(seq)
+
+        return seq
+
+    def expire(self):
+        """Evict events older than max_age, if set."""
+        if self.max_age is None:
+            return
+
+        cutoff = time.time() - self.max_age
+        while len(self) > 0 and \
+                self.times[self.first_seq % self.capacity] < cutoff:
+            self._evict_oldest()
+
+    def get(self, seq):
+        """
+        Get an event by its sequence number.
+
+        seq -- the sequence number
+
+        Returns the event, or None if it's not in the log.
+        """
+        if seq < self.first_seq or seq >= self.next_seq:
+            return None
+
+        return self.slots[seq % self.capacity]
+
+    def items(self, name=None, after=None):
+        """
+        Get the events in the log, oldest first.
+
+        name -- optional event name to filter by
+        after -- optional sequence number to only get later events
+
+        Returns a list of (sequence number, event) tuples.
+        """
+        self.expire()
+
+        if name is None:
+            start = self.first_seq
+            if after is not None and after + 1 > start:
+                start = after + 1
+
+            return [(seq, self.slots[seq % self.capacity])
+                    for seq in range(start, self.next_seq)]
+
+        seqs = self.by_name.get(name, [])
+        if after is not None:
+            # Sequence numbers are sorted, so skip from the end.
+            idx = len(seqs)
+            while idx > 0 and seqs[idx - 1] > after:
+                idx -= 1
+            seqs = seqs[idx:]
+
+        return [(seq, self.slots[seq % self.capacity]) for seq in seqs]
+
+    def events(self, name=None):
+        """
+        Get the events in the log, oldest first.
+
+        name -- optional event name to filter by
+
+        Returns a list of events.
+        """
+        return [event for _, event in self.items(name)]
+
+    def resize(self, capacity, max_age=None):
+        """
+        Change the retention of the log, keeping the newest events.
+
+        capacity -- maximum number of events to keep
+        max_age -- optional maximum age of events to keep, in seconds
+        """
+        kept = [(self.times[seq % self.capacity], event)
+                for seq, event in self.items()][-capacity:]
+        next_seq = self.next_seq
+
+        self.capacity = capacity
+        self.max_age = max_age
+        self.slots = [None] * capacity
+        self.times = [0] * capacity
+        self.by_name = {}
+        self.first_seq = next_seq - len(kept)
+        self.next_seq = self.first_seq
+
+        for t, event in kept:
+            self.add(event)
+            self.times[(self.next_seq - 1) % capacity] = t
+
+    def _evict_oldest(self):
+        idx = self.first_seq % self.capacity
+        event = self.slots[idx]
+        self.slots[idx] = None
+
+        seqs = self.by_name.get(event.get_name())
+        if seqs:
+            seqs.pop(0)
+            if not seqs:
+                del self.by_name[event.get_name()]
+
+        self.first_seq += 1
@@ -0,0 +1,145 @@
+"""Server-Sent Events streams on sockets taken over from MicroWebSrv."""
+
+
+class _StandIn:
+    """Stands in for a socket, or socket file, MicroWebSrv no longer owns."""
+
+    def close(self):
+        pass
+
+
+_STAND_IN = _StandIn()
+
+
+class DetachedSocket:
+    """
+    The socket of a request, taken over from MicroWebSrv.
+
+    MicroWebSrv writes responses to the client's _socketfile -- the socket
+    itself on MicroPython, a file made from it under CPython -- and closes
+    both once the route handler returns. Once detached, it closes stand-ins
+    instead, and the socket stays open without a thread of its own.
+    """
+
+    def __init__(self, httpClient, sock):
+        """
+        Initialize the object.
+
+        httpClient -- the MicroWebSrv client of the request
+        sock -- the client's socket
+        """
+        self.httpClient = httpClient
+        self.sock = sock
+        self.file = getattr(httpClient, '_socketfile', sock)
+        self.closed = False
+
+        # Headers already written may still be buffered in the file.
+        self.flush()
+        httpClient._socket = _STAND_IN
+        httpClient._socketfile = _STAND_IN
+
+    def write(self, data):
+        """
+        Write to the socket, through MicroWebSrv's socket file.
+
+        Raises OSError if the client went away.
+        """
+        try:
+            self.file.write(data)
+            self.flush()
+        except ValueError:
+            # The file was closed.
+            raise OSError('Socket closed')
+
+    def flush(self):
+        if hasattr(self.file, 'flush'):
+            self.file.flush()
+
+    def reattach(self):
+        """Give the socket back to the client, for a response to be written."""
+        self.httpClient._socket = self.sock
+        self.httpClient._socketfile = self.file
+
+    def close(self):
+        """Close the socket file and the socket."""
+        if self.closed:
+            return
+
+        self.closed = True
+        if self.file is not self.sock:
+            try:
+                self.file.close()
+            except (OSError, ValueError):
+                pass
+
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def detach(httpClient):
+    """
+    Take the socket of a request over from MicroWebSrv.
+
+    httpClient -- the MicroWebSrv client of the request
+
+    Returns the DetachedSocket, or None if it can't be taken over.
+    """
+    sock = getattr(httpClient, '_socket', None)
+    if sock is None:
+        return None
+
+    return DetachedSocket(httpClient, sock)
+
+
+class SocketEventStream:
+    """
+    A Server-Sent Events stream on a socket, sent with chunked transfer
+    encoding.
+
+    It has the SendText(), IsClosed() and Close() methods and ClosedCallback
+    of a webSocket, so a Subscriber can send on it -- events are sent already
+    encoded as chunks, as bytes. Nothing is ever read from the socket -- a
+    client going away is noticed when a send fails.
+    """
+
+    def __init__(self, sock):
+        """
+        Initialize the object.
+
+        sock -- the DetachedSocket, with the response headers already written
+        """
+        self.sock = sock
+        self.closed = False
+        self.ClosedCallback = None
+
+    def SendText(self, msg):
+        if self.closed:
+            return False
+
+        try:
+            self.sock.write(msg)
+        except OSError:
+            self.Close()
+            return False
+
+        return True
+
+    def IsClosed(self):
+        return self.closed
+
+    def Close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        try:
+            self.sock.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+        self.sock.close()
+
+        if self.ClosedCallback is not None:
+            self.ClosedCallback(self)
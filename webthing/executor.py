@@ -0,0 +1,210 @@
+"""Executors which run actions off the requesting thread."""
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import _thread
+import logging
+
+from utils import start_thread
+
+log = logging.getLogger(__name__)
+
+
+class Executor:
+    """
+    Base class for action executors.
+
+    Submitted actions are queued until a worker is free and fewer than the
+    limit of actions with the same name are running.
+    """
+
+    def __init__(self, workers=1, default_limit=1):
+        """
+        Initialize the object.
+
+        workers -- maximum number of actions to run at once
+        default_limit -- maximum number of actions with the same name to run
+                         at once, unless set with set_limit()
+        """
+        self.workers = workers
+        self.default_limit = default_limit
+        self.limits = {}
+        self.queue = []
+        self.running = {}
+        self.lock = _thread.allocate_lock()
+
+    def set_limit(self, action_name, limit):
+        """
+        Set how many actions with a given name may run at once.
+
+        action_name -- name of the action
+        limit -- maximum number of concurrently running actions
+        """
+        self.limits[action_name] = limit
+
+    def submit(self, action):
+        """
+        Queue an action to be performed.
+
+        action -- the action
+        """
+        action.executor = self
+        action.status = 'queued'
+        action.thing.action_notify(action)
+
+        self.lock.acquire()
+        self.queue.append(action)
+        self.lock.release()
+
+        self.dispatch()
+
+    def cancel(self, action):
+        """
+        Cancel a queued or running action.
+
+        action -- the action
+
+        Returns a boolean indicating whether the action was still queued.
+        """
+        self.lock.acquire()
+        try:
+            if action in self.queue:
+                self.queue.remove(action)
+                return True
+        finally:
+            self.lock.release()
+
+        return False
+
+    def dispatch(self):
+        """Start queued actions, as far as the limits allow."""
+        raise NotImplementedError()
+
+    def _next(self):
+        """Take the next runnable action off the queue, or return None."""
+        self.lock.acquire()
+        try:
+            for idx, action in enumerate(self.queue):
+                count = self.running.get(action.name, 0)
+                if count < self.limits.get(action.name, self.default_limit):
+                    self.running[action.name] = count + 1
+                    return self.queue.pop(idx)
+        finally:
+            self.lock.release()
+
+        return None
+
+    def _done(self, action):
+        """Release an action's slot."""
+        self.lock.acquire()
+        self.running[action.name] -= 1
+        self.lock.release()
+
+
+class ThreadedExecutor(Executor):
+    """Runs actions on a small pool of worker threads."""
+
+    def __init__(self, workers=1, default_limit=1):
+        """
+        Initialize the object.
+
+        workers -- number of worker threads
+        default_limit -- maximum number of actions with the same name to run
+                         at once, unless set with set_limit()
+        """
+        Executor.__init__(self, workers, default_limit)
+        self.started = 0
+        self.wakeup = _thread.allocate_lock()
+        self.wakeup.acquire()
+
+    def dispatch(self):
+        """Wake up a worker, starting one if needed."""
+        if self.started < self.workers:
+            self.started += 1
+            start_thread('action_worker', self._run)
+
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wakeup.release()
+        except RuntimeError:
+            # Already woken up.
+            pass
+
+    def _run(self):
+        while True:
+            self.wakeup.acquire()
+
+            action = self._next()
+            if action is None:
+                continue
+
+            if self.queue:
+                # Let another worker look at the rest of the queue.
+                self._wake()
+
+            try:
+                action.start()
+            except Exception as err:
+                log.error('Action {} failed: {}'.format(action.name, err))
+            finally:
+                self._done(action)
+                self._wake()
+
+
+class AsyncExecutor(Executor):
+    """Runs actions as (u)asyncio tasks."""
+
+    def __init__(self, workers=4, default_limit=1):
+        """
+        Initialize the object.
+
+        workers -- maximum number of actions to run at once
+        default_limit -- maximum number of actions with the same name to run
+                         at once, unless set with set_limit()
+        """
+        Executor.__init__(self, workers, default_limit)
+        self.tasks = {}
+
+    def cancel(self, action):
+        """
+        Cancel a queued or running action.
+
+        action -- the action
+
+        Returns a boolean indicating whether the action was still queued.
+        """
+        if Executor.cancel(self, action):
+            return True
+
+        task = self.tasks.get(action)
+        if task is not None:
+            task.cancel()
+
+        return False
+
+    def dispatch(self):
+        """Start tasks for queued actions, as far as the limits allow."""
+        while len(self.tasks) < self.workers:
+            action = self._next()
+            if action is None:
+                break
+
+            self.tasks[action] = asyncio.create_task(self._run(action))
+
+    async def _run(self, action):
+        try:
+            await action.start_async()
+        except asyncio.CancelledError:
+            # start_async() finished the action.
+            pass
+        except Exception as err:
+            log.error('Action {} failed: {}'.format(action.name, err))
+        finally:
+            del self.tasks[action]
+            self._done(action)
+            self.dispatch()
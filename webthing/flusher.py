@@ -0,0 +1,108 @@
+"""Delivery of coalesced and rate-limited property notifications."""
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import _thread
+import time
+
+from utils import start_thread
+
+
+class Flusher:
+    """
+    Periodically flushes the deferred property notifications of things.
+
+    The flusher only runs while some thing has deferred notifications, so a
+    server which doesn't use coalescing or rate limiting never pays for it.
+    Its thread is started on first use, and then waits for the next deferred
+    notification rather than exiting.
+    """
+
+    def __init__(self, things, tick_ms=20, use_asyncio=False):
+        """
+        Initialize the object.
+
+        things -- list of things to flush
+        tick_ms -- how often to check for due notifications, in milliseconds
+        use_asyncio -- whether to run as a (u)asyncio task, rather than as a
+                       thread
+        """
+        self.things = things
+        self.tick_ms = tick_ms
+        self.use_asyncio = use_asyncio
+        self.running = False
+        self.lock = _thread.allocate_lock()
+        self.started = False
+        self.wakeup = _thread.allocate_lock()
+        self.wakeup.acquire()
+
+        for thing in things:
+            thing.flusher = self
+
+    def wake(self):
+        """Make sure the flusher is running."""
+        self.lock.acquire()
+        try:
+            if self.running:
+                return
+
+            self.running = True
+        finally:
+            self.lock.release()
+
+        if self.use_asyncio:
+            asyncio.create_task(self._run_async())
+            return
+
+        if not self.started:
+            self.started = True
+            start_thread('flusher', self._run)
+
+        try:
+            self.wakeup.release()
+        except RuntimeError:
+            # Already woken up.
+            pass
+
+    def flush(self):
+        """
+        Flush all due notifications.
+
+        Returns a boolean indicating whether any notifications are still
+        pending.
+        """
+        pending = False
+        for thing in self.things:
+            if thing.flush_notifications():
+                pending = True
+
+        if not pending:
+            self.lock.acquire()
+            # Check again, a notification may have been deferred meanwhile.
+            for thing in self.things:
+                if thing.pending_properties:
+                    pending = True
+                    break
+
+            if not pending:
+                self.running = False
+            self.lock.release()
+
+        return pending
+
+    def _run(self):
+        while True:
+            self.wakeup.acquire()
+            while True:
+                time.sleep(self.tick_ms / 1000)
+                if not self.flush():
+                    break
+
+    async def _run_async(self):
+        while True:
+            await asyncio.sleep(self.tick_ms / 1000)
+            if not self.flush():
+                break
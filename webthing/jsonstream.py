@@ -0,0 +1,81 @@
+"""Incremental JSON encoding."""
+
+import json
+
+
+def iterencode(obj):
+    """
+    Encode an object as JSON, piece by piece.
+
+    Containers are walked here, scalars are encoded with json.dumps(), so no
+    piece is larger than the largest scalar.
+
+    obj -- the object to encode
+
+    Yields the encoded pieces, as strings.
+    """
+    if isinstance(obj, dict):
+        if not obj:
+            yield '{}'
+            return
+
+        first = True
+        for key, value in obj.items():
+            if first:
+                yield '{'
+                first = False
+            else:
+                yield ', '
+
+            yield json.dumps(str(key))
+            yield ': '
+            for piece in iterencode(value):
+                yield piece
+
+        yield '}'
+    elif isinstance(obj, (list, tuple)):
+        if not obj:
+            yield '[]'
+            return
+
+        first = True
+        for value in obj:
+            if first:
+                yield '['
+                first = False
+            else:
+                yield ', '
+
+            for piece in iterencode(value):
+                yield piece
+
+        yield ']'
+    else:
+        yield json.dumps(obj)
+
+
+def chunked(pieces, chunk_size=512):
+    """
+    Group encoded pieces into chunks.
+
+    pieces -- iterable of strings or bytes
+    chunk_size -- approximate size of each chunk, in bytes
+
+    Yields chunks of bytes.
+    """
+    buf = bytearray()
+    for piece in pieces:
+        if isinstance(piece, str):
+            piece = piece.encode()
+
+        if len(buf) + len(piece) > chunk_size and buf:
+            yield bytes(buf)
+            buf = bytearray()
+
+        if len(piece) >= chunk_size:
+            yield piece
+        else:
+            buf.extend(piece)
+
+    if buf:
+        yield bytes(buf)
@@ -0,0 +1,264 @@
+"""Request and notification instrumentation."""
+
+import _thread
+
+from utils import ticks_diff, ticks_us
+
+# Upper bounds of the latency buckets, in microseconds
+LATENCY_BUCKETS = (1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000,
+                   500000, 1000000, 2500000)
+
+# Upper bounds of the fan-out size buckets, in subscribers
+FANOUT_BUCKETS = (0, 1, 2, 4, 8, 16, 32)
+
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets.
+
+    The buckets are allocated up front, so observing a value only updates
+    counters.
+    """
+
+    def __init__(self, bounds):
+        """
+        Initialize the object.
+
+        bounds -- sorted upper bounds of the buckets -- values above the last
+                  bound go into an extra, unbounded bucket
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        """
+        Count an observation.
+
+        value -- the observed value
+        """
+        idx = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            idx += 1
+
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+
+    def render(self, lines, name, labels, scale=1):
+        """
+        Append the histogram in the Prometheus text format.
+
+        lines -- list to append lines to
+        name -- metric name
+        labels -- labels of the metric, as a 'key="value"' string
+        scale -- divisor converting values to the unit of the metric
+        """
+        sep = ',' if labels else ''
+        cumulative = 0
+        for idx, bound in enumerate(self.bounds):
+            cumulative += self.counts[idx]
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                name, labels, sep, bound / scale, cumulative))
+        lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(
+            name, labels, sep, self.count))
+
+        labels = '{' + labels + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.total / scale))
+        lines.append('{}_count{} {}'.format(name, labels, self.count))
+
+
+def _status_writer(httpResponse):
+    # The method every response writes its status line with, streamed or
+    # not: asyncsrv's _write_head(), MicroWebSrv's _writeFirstLine(), or
+    # else WriteResponse().
+    for name in ('_write_head', '_writeFirstLine'):
+        if hasattr(httpResponse, name):
+            return name
+
+    return 'WriteResponse'
+
+
+class RouteStats:
+    """Latency histogram and error counts of one route."""
+
+    def __init__(self):
+        """Initialize the object."""
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.client_errors = 0
+        self.errors = 0
+        # Responses written after their handler returned are counted on
+        # another thread.
+        self.lock = _thread.allocate_lock()
+
+    def observe(self, us, status):
+        """
+        Count a request.
+
+        us -- time spent in the handler, in microseconds
+        status -- HTTP status code of the response
+        """
+        self.latency.observe(us)
+        if status >= 500:
+            self.errors += 1
+        elif status >= 400:
+            self.client_errors += 1
+
+
+class NotifyStats:
+    """Fan-out sizes and durations of one kind of notification."""
+
+    def __init__(self):
+        """Initialize the object."""
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.refused = 0
+
+    def observe(self, subscribers, refused, us):
+        """
+        Count a notification.
+
+        subscribers -- number of subscribers it was sent to
+        refused -- number of subscribers which did not queue it
+        us -- time spent encoding and queueing it, in microseconds
+        """
+        self.fanout.observe(subscribers)
+        self.latency.observe(us)
+        self.refused += refused
+
+
+class Metrics:
+    """
+    Counters of a server's requests and of its things' notifications.
+
+    Route handlers are wrapped with wrap(), and things report their
+    notifications to observe_notify().
+    """
+
+    def __init__(self):
+        """Initialize the object."""
+        self.routes = {}
+        self.notify = {
+            'property': NotifyStats(),
+            'action': NotifyStats(),
+            'event': NotifyStats(),
+        }
+
+    def wrap(self, name, handler):
+        """
+        Wrap a route handler to record its requests.
+
+        name -- name of the route, i.e. 'GET /properties/<property>'
+        handler -- the handler, taking (httpClient, httpResponse, routeArgs)
+
+        Returns the wrapped handler.
+        """
+        if name not in self.routes:
+            self.routes[name] = RouteStats()
+        stats = self.routes[name]
+
+        def wrapper(httpClient, httpResponse, routeArgs=None):
+            # Catch the status code on its way out, from the status line. A
+            # response written after the handler returned, i.e. to a
+            # long-poll, is counted once it is written, and one never
+            # written is left out.
+            name = _status_writer(httpResponse)
+            write = getattr(httpResponse, name)
+            # The status, and the time spent in the handler once it returned
+            request = [0, None]
+
+            def record(code, *args):
+                setattr(httpResponse, name, write)
+                stats.lock.acquire()
+                if not request[0]:
+                    request[0] = code
+                    if request[1] is not None:
+                        stats.observe(request[1], code)
+                stats.lock.release()
+                return write(code, *args)
+
+            setattr(httpResponse, name, record)
+            start = ticks_us()
+            failed = True
+            try:
+                # The handler returns False if it failed, see print_exc().
+                failed = handler(httpClient, httpResponse, routeArgs) is False
+            finally:
+                us = ticks_diff(ticks_us(), start)
+                stats.lock.acquire()
+                if failed:
+                    request[0] = 500
+                if request[0]:
+                    stats.observe(us, request[0])
+                else:
+                    request[1] = us
+                stats.lock.release()
+
+        return wrapper
+
+    def observe_notify(self, kind, subscribers, refused, start):
+        """
+        Count a notification.
+
+        kind -- 'property', 'action' or 'event'
+        subscribers -- number of subscribers it was sent to
+        refused -- number of subscribers which did not queue it
+        start -- ticks_us() value from before it was encoded
+        """
+        self.notify[kind].observe(subscribers, refused,
+                                  ticks_diff(ticks_us(), start))
+
+    def render(self, subscriber_stats=None):
+        """
+        Render the metrics in the Prometheus text format.
+
+        subscriber_stats -- optional list of subscriber counters, as returned
+                            by WebThingServer.getSubscriberStats()
+
+        Returns the text.
+        """
+        lines = ['# TYPE webthing_request_seconds histogram']
+        for name, stats in self.routes.items():
+            stats.latency.render(lines, 'webthing_request_seconds',
+                                 'route="{}"'.format(name), 1000000)
+
+        lines.append('# TYPE webthing_request_errors_total counter')
+        for name, stats in self.routes.items():
+            lines.append(
+                'webthing_request_errors_total{{route="{}",class="4xx"}} {}'
+                .format(name, stats.client_errors))
+            lines.append(
+                'webthing_request_errors_total{{route="{}",class="5xx"}} {}'
+                .format(name, stats.errors))
+
+        lines.append('# TYPE webthing_notify_fanout histogram')
+        for kind, stats in self.notify.items():
+            stats.fanout.render(lines, 'webthing_notify_fanout',
+                                'kind="{}"'.format(kind))
+
+        lines.append('# TYPE webthing_notify_seconds histogram')
+        for kind, stats in self.notify.items():
+            stats.latency.render(lines, 'webthing_notify_seconds',
+                                 'kind="{}"'.format(kind), 1000000)
+
+        lines.append('# TYPE webthing_notify_refused_total counter')
+        for kind, stats in self.notify.items():
+            lines.append('webthing_notify_refused_total{{kind="{}"}} {}'
+                         .format(kind, stats.refused))
+
+        if subscriber_stats is not None:
+            lines.append('# TYPE webthing_subscribers gauge')
+            lines.append('webthing_subscribers {}'.format(
+                len(subscriber_stats)))
+            # Only connected subscribers are counted, so these can go down.
+            for counter in ('queued', 'sent', 'dropped', 'coalesced'):
+                lines.append('# TYPE webthing_subscriber_{} gauge'
+                             .format(counter))
+                lines.append('webthing_subscriber_{} {}'.format(
+                    counter, sum(s[counter] for s in subscriber_stats)))
+
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,207 @@
+"""Heap profiling of request handlers and notifications."""
+
+import gc
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class HeapProfiler:
+    """
+    Records the heap use of each profiled call in a fixed-size ring.
+
+    On MicroPython, every record holds gc.mem_free() before and after the
+    call, the bytes allocated, and whether the garbage collector ran. The
+    allocation count comes from gc.mem_alloc() and is only exact when no
+    collection ran during the call. Under CPython, tracemalloc is used
+    instead: the free figures are replaced by the traced bytes in use, and the
+    allocation count by the peak traced bytes above the starting point. Calls
+    on different threads which overlap blur each other's figures.
+    """
+
+    def __init__(self, capacity=64):
+        """
+        Initialize the object.
+
+        capacity -- number of records to keep
+        """
+        self.capacity = capacity
+        self.names = [None] * capacity
+        self.before = [0] * capacity
+        self.after = [0] * capacity
+        self.allocated = [0] * capacity
+        self.collections = [0] * capacity
+        self.next_idx = 0
+        self.count = 0
+        self.peaks = []
+
+        self.micropython = hasattr(gc, 'mem_free')
+        if not self.micropython and tracemalloc is not None and \
+                not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def wrap(self, name, func):
+        """
+        Wrap a function to profile every call.
+
+        name -- name of the calls in the records
+        func -- the function
+
+        Returns the wrapped function.
+        """
+        def wrapper(*args, **kwargs):
+            token = self.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.stop(name, token)
+
+        return wrapper
+
+    def start(self):
+        """
+        Take a sample before a call.
+
+        Returns a token to pass to stop().
+        """
+        if self.micropython:
+            return (gc.mem_free(), gc.mem_alloc())
+
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return (0, self._collections())
+
+        current, peak = tracemalloc.get_traced_memory()
+        if self.peaks:
+            # Keep the peak of the enclosing call before resetting it.
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        self.peaks.append(current)
+        tracemalloc.reset_peak()
+        return (current, self._collections())
+
+    def stop(self, name, token):
+        """
+        Take a sample after a call and record it.
+
+        name -- name of the call
+        token -- the token returned by start()
+        """
+        if self.micropython:
+            free_before, alloc_before = token
+            alloc_after = gc.mem_alloc()
+            ran = 1 if alloc_after < alloc_before else 0
+            self.add(name, free_before, gc.mem_free(),
+                     0 if ran else alloc_after - alloc_before, ran)
+            return
+
+        before, collections = token
+        if tracemalloc is None or not tracemalloc.is_tracing() or \
+                not self.peaks:
+            self.add(name, 0, 0, 0, self._collections() - collections)
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(self.peaks.pop(), peak)
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+
+        self.add(name, before, current, peak - before,
+                 self._collections() - collections)
+
+    def add(self, name, before, after, allocated, collections):
+        """
+        Add a record, overwriting the oldest one if the ring is full.
+
+        name -- name of the call
+        before -- free bytes before the call
+        after -- free bytes after the call
+        allocated -- bytes allocated during the call
+        collections -- number of garbage collections during the call
+        """
+        idx = self.next_idx
+        self.names[idx] = name
+        self.before[idx] = before
+        self.after[idx] = after
+        self.allocated[idx] = allocated
+        self.collections[idx] = collections
+        self.next_idx = (idx + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        """Drop all records."""
+        for idx in range(self.capacity):
+            self.names[idx] = None
+        self.next_idx = 0
+        self.count = 0
+
+    def records(self):
+        """
+        Get the records, oldest first.
+
+        Returns a list of dictionaries.
+        """
+        key = 'free' if self.micropython else 'traced'
+        records = []
+        start = (self.next_idx - self.count) % self.capacity
+        for n in range(self.count):
+            idx = (start + n) % self.capacity
+            records.append({
+                'name': self.names[idx],
+                key + 'Before': self.before[idx],
+                key + 'After': self.after[idx],
+                'allocated': self.allocated[idx],
+                'collections': self.collections[idx],
+            })
+
+        return records
+
+    def summary(self):
+        """
+        Summarize the records per call name.
+
+        Returns a dictionary of name -> totals.
+        """
+        summary = {}
+        for record in self.records():
+            totals = summary.get(record['name'])
+            if totals is None:
+                totals = {
+                    'count': 0,
+                    'allocated': 0,
+                    'maxAllocated': 0,
+                    'collections': 0,
+                }
+                summary[record['name']] = totals
+
+            totals['count'] += 1
+            totals['allocated'] += record['allocated']
+            totals['maxAllocated'] = max(totals['maxAllocated'],
+                                         record['allocated'])
+            totals['collections'] += record['collections']
+
+        return summary
+
+    def dump(self):
+        """
+        Get everything recorded.
+
+        Returns a dictionary with the records, oldest first, and the summary.
+        """
+        dump = {
+            'records': self.records(),
+            'summary': self.summary(),
+        }
+        if self.micropython:
+            dump['free'] = gc.mem_free()
+        elif tracemalloc is not None and tracemalloc.is_tracing():
+            dump['traced'] = tracemalloc.get_traced_memory()[0]
+
+        return dump
+
+    def _collections(self):
+        if hasattr(gc, 'get_stats'):
+            return sum(s['collections'] for s in gc.get_stats())
+
+        return 0
@@ -1,9 +1,105 @@
 """High-level Property base class implementation."""
 
-from copy import deepcopy
-
 from errors import PropertyError
 
+_TYPES = {
+    'boolean': ((bool,), 'Value must be a boolean'),
+    'object': ((dict,), 'Value must be an object'),
+    'array': ((list,), 'Value must be an array'),
+    'number': ((float, int), 'Value must be a number'),
+    'integer': ((int,), 'Value must be an integer'),
+    'string': ((str,), 'Value must be a string'),
+}
+
+
+def compile_validator(metadata):
+    """
+    Compile property metadata into a validator.
+
+    All metadata lookups happen here, so validating a value only tests the
+    constraints which are actually set.
+
+    metadata -- property metadata, as a dict
+
+    Returns a function which takes a value and raises PropertyError if it is
+    not valid.
+    """
+    t = metadata.get('type')
+    is_null = t == 'null'
+    types, type_error = _TYPES.get(t, (None, None))
+    read_only = bool(metadata.get('readOnly'))
+    minimum = metadata.get('minimum')
+    maximum = metadata.get('maximum')
+    multiple_of = metadata.get('multipleOf') or None
+    min_length = metadata.get('minLength')
+    max_length = metadata.get('maxLength')
+    check_length = min_length is not None or max_length is not None
+
+    enum = metadata.get('enum') or None
+    if enum is not None:
+        try:
+            enum = frozenset(enum)
+        except TypeError:
+            # Unhashable members, i.e. objects -- fall back to the list.
+            pass
+
+    if not (is_null or types or read_only or check_length) and \
+            minimum is None and maximum is None and multiple_of is None and \
+            enum is None:
+        def validator(value):
+            pass
+
+        return validator
+
+    def validator(value):
+        if is_null:
+            if value is not None:
+                raise PropertyError('Value must be null')
+        elif types is not None and type(value) not in types:
+            raise PropertyError(type_error)
+
+        if read_only:
+            raise PropertyError('Read-only property')
+
+        if minimum is not None and value < minimum:
+            raise PropertyError('Value less than minimum: {}'
+                                .format(minimum))
+
+        if maximum is not None and value > maximum:
+            raise PropertyError('Value greater than maximum: {}'
+                                .format(maximum))
+
+        if multiple_of is not None:
+            if type(value) is int and type(multiple_of) is int:
+                invalid = value % multiple_of != 0
+            else:
+                quotient = value / multiple_of
+                invalid = abs(quotient - round(quotient)) > 1e-9
+
+            if invalid:
+                raise PropertyError('Value not a multiple of: {}'
+                                    .format(multiple_of))
+
+        if check_length and type(value) is str:
+            if min_length is not None and len(value) < min_length:
+                raise PropertyError('String shorter than minLength: {}'
+                                    .format(min_length))
+
+            if max_length is not None and len(value) > max_length:
+                raise PropertyError('String longer than maxLength: {}'
+                                    .format(max_length))
+
+        if enum is not None:
+            try:
+                valid = value in enum
+            except TypeError:
+                valid = False
+
+            if not valid:
+                raise PropertyError('Invalid enum value')
+
+    return validator
+
 
 class Property:
     """A Property represents an individual state value of a thing."""
@@ -24,6 +120,12 @@ class Property:
         self.href_prefix = ''
         self.href = '/properties/{}'.format(self.name)
         self.metadata = metadata if metadata is not None else {}
+        self.validator = compile_validator(self.metadata)
+        self.description = None
+        self.assemble_description()
+        self.notify_window = None
+        self.last_notify = None
+        self.changed_version = 0
 
         # Add the property change observer to notify the Thing about a property
         # change.
@@ -35,64 +137,37 @@ class Property:
 
         value -- New value
         """
-        if 'type' in self.metadata:
-            t = self.metadata['type']
-
-            if t == 'null':
-                if t is not None:
-                    raise PropertyError('Value must be null')
-            elif t == 'boolean':
-                if type(value) is not bool:
-                    raise PropertyError('Value must be a boolean')
-            elif t == 'object':
-                if type(value) is not dict:
-                    raise PropertyError('Value must be an object')
-            elif t == 'array':
-                if type(value) is not list:
-                    raise PropertyError('Value must be an array')
-            elif t == 'number':
-                if type(value) not in [float, int]:
-                    raise PropertyError('Value must be a number')
-            elif t == 'integer':
-                if type(value) is not int:
-                    raise PropertyError('Value must be an integer')
-            elif t == 'string':
-                if type(value) is not str:
-                    raise PropertyError('Value must be a string')
-
-        if 'readOnly' in self.metadata and self.metadata['readOnly']:
-            raise PropertyError('Read-only property')
-
-        if 'minimum' in self.metadata and value < self.metadata['minimum']:
-            raise PropertyError('Value less than minimum: {}'
-                                .format(self.metadata['minimum']))
-
-        if 'maximum' in self.metadata and value > self.metadata['maximum']:
-            raise PropertyError('Value greater than maximum: {}'
-                                .format(self.metadata['maximum']))
-
-        if 'enum' in self.metadata and len(self.metadata['enum']) > 0 and \
-                value not in self.metadata['enum']:
-            raise PropertyError('Invalid enum value')
+        self.validator(value)
 
     def as_property_description(self):
         """
         Get the property description.
 
+        The description is assembled in advance. This returns a copy of it,
+        with its own links list, which the caller may modify.
+
         Returns a dictionary describing the property.
         """
-        description = deepcopy(self.metadata)
+        description = dict(self.description)
+        description['links'] = list(description['links'])
+        return description
 
-        if 'links' not in description:
-            description['links'] = []
+    def assemble_description(self):
+        """
+        Assemble the property description from the metadata and the href.
 
-        description['links'].append(
-            {
-                'rel': 'property',
-                'href': self.href_prefix + self.href,
-            }
-        )
-        return description
+        The metadata is copied one level deep, and the links are a new list
+        overlaying the metadata's own links with the property link. Anything
+        nested deeper is shared with the metadata.
+        """
+        description = dict(self.metadata)
+        links = list(self.metadata.get('links', ()))
+        links.append({
+            'rel': 'property',
+            'href': self.href_prefix + self.href,
+        })
+        description['links'] = links
+        self.description = description
 
     def set_href_prefix(self, prefix):
         """
@@ -101,6 +176,7 @@ class Property:
         prefix -- the prefix
         """
         self.href_prefix = prefix
+        self.assemble_description()
 
     def get_href(self):
         """
@@ -142,3 +218,50 @@ class Property:
     def get_metadata(self):
         """Get the metadata associated with this property."""
         return self.metadata
+
+    def set_metadata(self, metadata):
+        """
+        Replace the metadata associated with this property.
+
+        The metadata is compiled into a validator and a description here, so
+        changes must be made through this method rather than by modifying the
+        dict.
+
+        metadata -- property metadata, as a dict
+        """
+        self.metadata = metadata if metadata is not None else {}
+        self.validator = compile_validator(self.metadata)
+        self.assemble_description()
+        self.thing.structure_changed()
+
+    def get_notify_window(self):
+        """
+        Get the notification coalescing window of this property.
+
+        Returns the window in milliseconds, or None to use the thing's.
+        """
+        return self.notify_window
+
+    def set_notify_window(self, window):
+        """
+        Set the notification coalescing window of this property.
+
+        window -- the window in milliseconds, 0 to notify immediately, or None
+                  to use the thing's
+        """
+        self.notify_window = window
+
+    def get_notify_interval(self):
+        """
+        Get the minimum interval between notifications of this property.
+
+        The interval is derived from the 'maxRate' metadata, in notifications
+        per second.
+
+        Returns the interval in milliseconds, or 0 if not rate limited.
+        """
+        max_rate = self.metadata.get('maxRate')
+        if not max_rate:
+            return 0
+
+        return int(1000 / max_rate)
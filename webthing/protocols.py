@@ -0,0 +1,78 @@
+"""WebSocket subprotocols, i.e. the encodings of WebSocket messages."""
+
+import json
+
+import cbor
+
+
+class Protocol:
+    """An encoding of WebSocket messages."""
+
+    def __init__(self, name, binary, dumps, loads):
+        """
+        Initialize the object.
+
+        name -- name of the subprotocol, as sent in Sec-WebSocket-Protocol
+        binary -- whether messages are sent as binary frames, rather than
+                  as text frames
+        dumps -- function encoding a message
+        loads -- function decoding a message, raising ValueError if it is
+                 not valid
+        """
+        self.name = name
+        self.binary = binary
+        self.dumps = dumps
+        self.loads = loads
+
+
+JSON = Protocol('webthing', False, json.dumps, json.loads)
+CBOR = Protocol('webthing+cbor', True, cbor.dumps, cbor.loads)
+
+
+def _event_dumps(message):
+    # json.dumps() never emits a newline, so the message fits on one data
+    # line.
+    event = 'data: {}\n\n'.format(json.dumps(message)).encode()
+    return '{:x}\r\n'.format(len(event)).encode() + event + b'\r\n'
+
+
+# Server-Sent Events streams carry the JSON messages as events -- they are
+# not a WebSocket subprotocol, and receive nothing. Each event is encoded as
+# a whole chunk of the chunked response, ready to be written.
+SSE = Protocol('sse', False, _event_dumps, None)
+
+# Supported subprotocols, by name
+PROTOCOLS = {
+    JSON.name: JSON,
+    CBOR.name: CBOR,
+}
+
+
+def choose(offered):
+    """
+    Choose a subprotocol from the ones a client offered.
+
+    offered -- value of the Sec-WebSocket-Protocol header, or None
+
+    Returns the name of the first supported subprotocol, or None.
+    """
+    if not offered:
+        return None
+
+    for name in offered.split(','):
+        name = name.strip()
+        if name in PROTOCOLS:
+            return name
+
+    return None
+
+
+def get(name):
+    """
+    Get a subprotocol by name.
+
+    name -- name of the subprotocol, or None
+
+    Returns the subprotocol -- JSON if none or an unknown one was named.
+    """
+    return PROTOCOLS.get(name, JSON)
@@ -0,0 +1,143 @@
+"""Path-segment trie router."""
+
+
+class _Node:
+    """A node of the routing trie."""
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.param_child = None
+        self.handlers = {}
+
+
+class Router:
+    """
+    Routes requests by walking a trie of path segments.
+
+    Route paths use the MicroWebSrv format, i.e. '/<thing>/properties/<name>'.
+    Parameters can have a resolver, which turns the path segment into an
+    object, i.e. a thing index into the Thing itself. Handlers then get the
+    resolved objects in routeArgs. Dispatch cost depends on the depth of the
+    path, not on the number of routes or things.
+    """
+
+    def __init__(self, prefix=''):
+        """
+        Initialize the router.
+
+        prefix -- path prefix to strip before routing, i.e. the base path
+        """
+        self.prefix = prefix.rstrip('/')
+        self.root = _Node()
+        self.resolvers = {}
+        self.fallbacks = {}
+
+    def add_resolver(self, param, resolver):
+        """
+        Add a resolver for a route parameter.
+
+        param -- name of the parameter
+        resolver -- function taking the path segment and the route arguments
+                    resolved so far, and returning the resolved object, or
+                    None if there is no such object
+        """
+        self.resolvers[param] = resolver
+
+    def add_route(self, path, method, handler, args=None):
+        """
+        Add a route.
+
+        path -- route path, relative to the prefix
+        method -- HTTP method
+        handler -- function taking (httpClient, httpResponse, routeArgs)
+        args -- optional fixed route arguments to pass to the handler
+        """
+        node = self.root
+        for segment in path.strip('/').split('/'):
+            if not segment:
+                continue
+
+            if segment.startswith('<') and segment.endswith('>'):
+                param = segment[1:-1]
+                if node.param_child is None:
+                    node.param = param
+                    node.param_child = _Node()
+                elif node.param != param:
+                    raise ValueError(
+                        'Conflicting route parameters: {} and {}'.format(
+                            node.param, param))
+
+                node = node.param_child
+            else:
+                if segment not in node.children:
+                    node.children[segment] = _Node()
+
+                node = node.children[segment]
+
+        node.handlers[method.upper()] = (handler, args)
+
+    def set_fallback(self, method, handler):
+        """
+        Set the handler for requests with no matching route.
+
+        method -- HTTP method
+        handler -- function taking (httpClient, httpResponse, routeArgs)
+        """
+        self.fallbacks[method.upper()] = handler
+
+    def resolve(self, path, method):
+        """
+        Find the handler for a request.
+
+        path -- the request path
+        method -- the HTTP method
+
+        Returns a (handler, routeArgs) tuple. If nothing matches, the handler
+        is the fallback for the method, or None.
+        """
+        method = method.upper()
+
+        if self.prefix:
+            size = len(self.prefix)
+            if not path.startswith(self.prefix) or \
+                    (len(path) > size and path[size] != '/'):
+                return self.fallbacks.get(method), {}
+
+            path = path[len(self.prefix):]
+
+        node = self.root
+        args = {}
+        for segment in path.split('/'):
+            if not segment:
+                continue
+
+            child = node.children.get(segment)
+            if child is not None:
+                node = child
+                continue
+
+            if node.param_child is None:
+                return self.fallbacks.get(method), {}
+
+            resolver = self.resolvers.get(node.param)
+            if resolver is None:
+                args[node.param] = segment
+            else:
+                value = resolver(segment, args)
+                if value is None:
+                    return self.fallbacks.get(method), {}
+
+                args[node.param] = value
+
+            node = node.param_child
+
+        handler = node.handlers.get(method)
+        if handler is None:
+            return self.fallbacks.get(method), {}
+
+        if handler[1]:
+            for k, v in handler[1].items():
+                args.setdefault(k, v)
+
+        return handler[0], args
@@ -0,0 +1,384 @@
+"""Periodic sampling of sensor values on a shared timer wheel."""
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import random
+except ImportError:
+    import urandom as random
+
+import _thread
+import logging
+import time
+
+from utils import start_thread, ticks_add, ticks_diff, ticks_ms
+
+log = logging.getLogger(__name__)
+
+# Fraction of the period between the phases of consecutive timers with the
+# same period -- the golden ratio spreads any number of them evenly.
+_PHASE_STEP = 0.6180339887
+
+
+class Timer:
+    """A periodic callback on a Scheduler, with its overrun counters."""
+
+    def __init__(self, func, period, jitter, name):
+        """
+        Initialize the object.
+
+        func -- function to call, taking no arguments
+        period -- period in ticks
+        jitter -- maximum random offset of each run, in ticks
+        name -- name of the timer in the statistics
+        """
+        self.func = func
+        self.period = period
+        self.jitter = jitter
+        self.name = name
+        self.nominal = 0
+        self.deadline = 0
+        self.cancelled = False
+
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.overruns = 0
+        self.max_late_ms = 0
+        self.max_duration_ms = 0
+
+    def get_stats(self):
+        """
+        Get the timer's counters.
+
+        runs -- number of runs
+        errors -- number of runs which raised an exception
+        skipped -- number of periods skipped because a run was too late
+        overruns -- number of runs which took longer than the period
+        max_late_ms -- longest delay of a run past its deadline
+        max_duration_ms -- longest run
+
+        Returns a dictionary of counter name -> value.
+        """
+        return {
+            'name': self.name,
+            'runs': self.runs,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'overruns': self.overruns,
+            'max_late_ms': self.max_late_ms,
+            'max_duration_ms': self.max_duration_ms,
+        }
+
+
+class Scheduler:
+    """
+    Runs periodic callbacks, i.e. sensor sampling, for all things.
+
+    Timers are kept on a hashed timer wheel, so a tick only looks at the
+    timers in one slot, however many there are. Runs are spread over their
+    period, and can be jittered, so that sensors don't all fire on the same
+    tick. Callbacks run on the scheduler's thread, or as part of its
+    (u)asyncio task, so they should be short -- a run which takes longer
+    than its period is counted as an overrun.
+    """
+
+    def __init__(self, things=(), tick_ms=10, slots=64, use_asyncio=False):
+        """
+        Initialize the object.
+
+        things -- things whose samplers to run, see Thing.add_sampler()
+        tick_ms -- resolution of the wheel, in milliseconds
+        slots -- number of slots of the wheel
+        use_asyncio -- whether to run as a (u)asyncio task, rather than as a
+                       thread
+        """
+        self.tick_ms = tick_ms
+        self.slots = [[] for _ in range(slots)]
+        self.use_asyncio = use_asyncio
+        self.timers = []
+        self.lock = _thread.allocate_lock()
+        self.tick = 0
+        self.start_ms = ticks_ms()
+        self.started = False
+        self.running = False
+
+        self.late_ticks = 0
+        self.max_tick_late_ms = 0
+
+        for thing in things:
+            thing.scheduler = self
+            for args in thing.samplers:
+                self.bind(*args)
+
+    def schedule(self, func, period_ms, jitter_ms=0, phase_ms=None,
+                 name=None):
+        """
+        Call a function periodically.
+
+        func -- function to call, taking no arguments -- with use_asyncio, it
+                may return a coroutine, which is awaited
+        period_ms -- period in milliseconds
+        jitter_ms -- maximum random offset of each run, in milliseconds
+        phase_ms -- offset of the first run, in milliseconds -- by default,
+                    timers with the same period are spread over it
+        name -- name of the timer in the statistics
+
+        Returns the Timer.
+        """
+        period = max(1, period_ms // self.tick_ms)
+        jitter = min(jitter_ms // self.tick_ms, period // 2)
+        timer = Timer(func, period, jitter,
+                      name if name is not None else getattr(
+                          func, '__name__', 'timer'))
+
+        self.lock.acquire()
+        try:
+            if phase_ms is None:
+                peers = sum(1 for t in self.timers if t.period == period)
+                phase = int(peers * _PHASE_STEP * period) % period
+            else:
+                phase = (phase_ms // self.tick_ms) % period
+
+            timer.nominal = self.tick + phase + 1
+            self.timers.append(timer)
+            self._insert(timer)
+        finally:
+            self.lock.release()
+
+        if self.started:
+            self._start_driver()
+
+        return timer
+
+    def bind(self, value, sample, period_ms, jitter_ms=0, phase_ms=None):
+        """
+        Update a value periodically from a sampling function.
+
+        value -- the Value to update
+        sample -- function taking no arguments and returning the new value,
+                  or None to leave the value as it is
+        period_ms -- sampling period in milliseconds
+        jitter_ms -- maximum random offset of each sample, in milliseconds
+        phase_ms -- offset of the first sample, in milliseconds
+
+        Returns the Timer.
+        """
+        def update():
+            reading = sample()
+            if reading is not None:
+                value.notify_of_external_update(reading)
+
+        return self.schedule(update, period_ms, jitter_ms, phase_ms,
+                             getattr(sample, '__name__', 'sample'))
+
+    def cancel(self, timer):
+        """
+        Stop calling a timer's function.
+
+        timer -- the Timer
+        """
+        self.lock.acquire()
+        try:
+            timer.cancelled = True
+            if timer in self.timers:
+                self.timers.remove(timer)
+            slot = self.slots[timer.deadline % len(self.slots)]
+            if timer in slot:
+                slot.remove(timer)
+        finally:
+            self.lock.release()
+
+    def start(self):
+        """
+        Start running timers.
+
+        The thread or task is only started once there is a timer.
+        """
+        self.started = True
+        if self.timers:
+            self._start_driver()
+
+    def stop(self):
+        """Stop running timers."""
+        self.started = False
+        self.running = False
+
+    def get_stats(self):
+        """
+        Get the counters of the scheduler and of its timers.
+
+        Returns a dictionary, with the counters of each timer under 'timers'.
+        """
+        return {
+            'ticks': self.tick,
+            'late_ticks': self.late_ticks,
+            'max_tick_late_ms': self.max_tick_late_ms,
+            'timers': [t.get_stats() for t in self.timers],
+        }
+
+    def advance(self, tick):
+        """
+        Advance the wheel to a tick.
+
+        tick -- the tick to advance to -- when the driver is late, this is
+                more than one tick ahead, and the ticks in between are
+                skipped
+
+        Returns a list of the timers which are due.
+        """
+        self.lock.acquire()
+        try:
+            steps = tick - self.tick
+            if steps <= 0:
+                return []
+
+            if steps >= len(self.slots):
+                slots = self.slots
+            else:
+                slots = [self.slots[t % len(self.slots)]
+                         for t in range(self.tick + 1, tick + 1)]
+            self.tick = tick
+
+            due = []
+            for slot in slots:
+                for timer in slot:
+                    if timer.deadline <= tick:
+                        due.append(timer)
+                if due:
+                    slot[:] = [t for t in slot if t.deadline > tick]
+            return due
+        finally:
+            self.lock.release()
+
+    def finish(self, timer, started_ms, duration_ms):
+        """
+        Record a run of a timer and put it back on the wheel.
+
+        timer -- the Timer
+        started_ms -- ticks_ms() value from when the run started
+        duration_ms -- duration of the run, in milliseconds
+        """
+        planned_ms = ticks_add(self.start_ms, timer.deadline * self.tick_ms)
+        late_ms = ticks_diff(started_ms, planned_ms)
+
+        timer.runs += 1
+        if late_ms > timer.max_late_ms:
+            timer.max_late_ms = late_ms
+        if duration_ms > timer.max_duration_ms:
+            timer.max_duration_ms = duration_ms
+        if duration_ms > timer.period * self.tick_ms:
+            timer.overruns += 1
+
+        self.lock.acquire()
+        try:
+            if timer.cancelled:
+                return
+
+            timer.nominal += timer.period
+            if timer.nominal <= self.tick:
+                # Too late for the next period(s) -- skip rather than
+                # running them back to back.
+                missed = (self.tick - timer.nominal) // timer.period + 1
+                timer.nominal += missed * timer.period
+                timer.skipped += missed
+
+            self._insert(timer)
+        finally:
+            self.lock.release()
+
+    def _insert(self, timer):
+        deadline = timer.nominal
+        if timer.jitter:
+            deadline += random.getrandbits(16) % (2 * timer.jitter + 1) - \
+                timer.jitter
+        timer.deadline = max(deadline, self.tick + 1)
+        self.slots[timer.deadline % len(self.slots)].append(timer)
+
+    def _start_driver(self):
+        self.lock.acquire()
+        try:
+            if self.running:
+                return
+
+            self.running = True
+            # Carry on from the current time, rather than catching up on the
+            # ticks missed while stopped.
+            self.start_ms = ticks_add(ticks_ms(), -self.tick * self.tick_ms)
+        finally:
+            self.lock.release()
+
+        if self.use_asyncio:
+            asyncio.create_task(self._run_async())
+        else:
+            start_thread('scheduler', self._run)
+
+    def _idle(self):
+        """Stop the driver if stopped or out of timers, and say so."""
+        if self.running and self.timers:
+            return False
+
+        self.lock.acquire()
+        try:
+            if self.running and self.timers:
+                return False
+
+            self.running = False
+            return True
+        finally:
+            self.lock.release()
+
+    def _wait(self):
+        """Get the number of milliseconds until the next tick is due."""
+        due_ms = ticks_add(self.start_ms, (self.tick + 1) * self.tick_ms)
+        return max(0, ticks_diff(due_ms, ticks_ms()))
+
+    def _now(self):
+        """Get the current tick, counting any ticks the driver was late."""
+        tick = ticks_diff(ticks_ms(), self.start_ms) // self.tick_ms
+        if tick > self.tick + 1:
+            self.late_ticks += tick - self.tick - 1
+            late_ms = (tick - self.tick - 1) * self.tick_ms
+            if late_ms > self.max_tick_late_ms:
+                self.max_tick_late_ms = late_ms
+        return max(tick, self.tick + 1)
+
+    def _run_timers(self):
+        """Run the due timers, and get those returning a coroutine."""
+        pending = []
+        for timer in self.advance(self._now()):
+            start = ticks_ms()
+            try:
+                result = timer.func()
+                if hasattr(result, 'send'):
+                    pending.append((timer, start, result))
+                    continue
+            except Exception as err:
+                timer.errors += 1
+                log.error('Timer {} failed: {}'.format(timer.name, err))
+            self.finish(timer, start, ticks_diff(ticks_ms(), start))
+
+        return pending
+
+    def _run(self):
+        while not self._idle():
+            delay = self._wait()
+            if delay:
+                time.sleep(delay / 1000)
+
+            self._run_timers()
+
+    async def _run_async(self):
+        while not self._idle():
+            await asyncio.sleep(self._wait() / 1000)
+
+            for timer, start, coro in self._run_timers():
+                try:
+                    await coro
+                except Exception as err:
+                    timer.errors += 1
+                    log.error('Timer {} failed: {}'.format(timer.name, err))
+                self.finish(timer, start, ticks_diff(ticks_ms(), start))
@@ -1,12 +1,37 @@
 """Python Web Thing server implementation."""
 
-from microWebSrv import MicroWebSrv
 import _thread
+import json
 import logging
 import sys
-import network
 
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    import random
+except ImportError:
+    import urandom as random
+
+try:
+    import network
+except ImportError:
+    network = None
+
+import compression
+import eventstream
 from errors import PropertyError
+from router import Router
+from executor import AsyncExecutor, ThreadedExecutor
+from flusher import Flusher
+from jsonstream import chunked, iterencode
+from metrics import Metrics
+from profiler import HeapProfiler
+import protocols
+from scheduler import Scheduler
+from subscriber import AsyncSender, DROP_OLDEST, Subscriber, ThreadedSender
 from utils import get_addresses
 
 log = logging.getLogger(__name__)
@@ -27,13 +52,35 @@ ws_run_in_thread = False
 _CORS_HEADERS = {
     'Access-Control-Allow-Origin': '*',
     'Access-Control-Allow-Headers':
-        'Origin, X-Requested-With, Content-Type, Accept',
+        'Origin, X-Requested-With, Content-Type, Accept, If-None-Match',
     'Access-Control-Allow-Methods': 'GET, HEAD, PUT, POST, DELETE',
 }
 
+# Methods dispatched by the router -- HEAD requests are routed as GET
+_ROUTED_METHODS = ['GET', 'HEAD', 'PUT', 'POST', 'DELETE', 'OPTIONS']
+
+# Longest a GET /properties?wait=<ms> request is held, in milliseconds
+_MAX_WAIT_MS = 60000
+
+# Headers of responses with an ETag
+_ETAG_HEADERS = dict(_CORS_HEADERS)
+_ETAG_HEADERS['Access-Control-Expose-Headers'] = 'ETag'
+
+# Headers of paginated responses
+_PAGE_HEADERS = dict(_CORS_HEADERS)
+_PAGE_HEADERS['Access-Control-Expose-Headers'] = 'Link'
+
+# Maximum number of Host header values to keep encoded descriptions for, per
+# thing.
+_MAX_CACHED_HOSTS = 4
+
 
 def print_exc(func):
-    """Wrap a function and print an exception, if encountered."""
+    """
+    Wrap a function and print an exception, if encountered.
+
+    The wrapper returns False if an exception was caught.
+    """
     def wrapper(*args, **kwargs):
         try:
             # log.debug('Calling {}'.format(func.__name__))
@@ -41,10 +88,20 @@ def print_exc(func):
             # log.debug('Back from {}'.format(func.__name__))
             return ret
         except Exception as err:
-            sys.print_exception(err)
+            print_exception(err)
+            return False
     return wrapper
 
 
+def print_exception(err):
+    """Print an exception and its traceback."""
+    if hasattr(sys, 'print_exception'):
+        sys.print_exception(err)
+    else:
+        import traceback
+        traceback.print_exception(type(err), err, err.__traceback__)
+
+
 class SingleThing:
     """A container for a single thing."""
 
@@ -107,12 +164,84 @@ class MultipleThings:
         return self.name
 
 
+class RequestContext:
+    """Per-request state, derived once from the request headers."""
+
+    def __init__(self, server, httpClient):
+        """
+        Initialize the context.
+
+        server -- the WebThingServer handling the request
+        httpClient -- the MicroWebSrv client of the request
+        """
+        self.server = server
+        self.raw_headers = httpClient.GetRequestHeaders()
+        self.headers = None
+
+        host = self.raw_headers.get('Host')
+        if host is None:
+            host = self.get_header('host')
+
+        self.host = host if host is not None else ''
+        self.host_valid = server.isValidHost(host)
+
+    def get_header(self, name, default=None):
+        """
+        Get a request header.
+
+        The lowercased copy of the headers is made on first use, so requests
+        which only need the Host header never make it.
+
+        name -- the lowercased header name
+        default -- value to return if the header is missing
+        """
+        if self.headers is None:
+            self.headers = {k.lower(): v for k, v in self.raw_headers.items()}
+
+        return self.headers.get(name, default)
+
+    def get_optional_header(self, name, canonical):
+        """
+        Get a request header which most requests don't send, i.e.
+        If-None-Match.
+
+        The header is looked up as browsers send it, then by scanning the
+        headers, without making the lowercased copy of them.
+
+        name -- the lowercased header name
+        canonical -- the header name as browsers send it
+
+        Returns the header value, or None if it is missing.
+        """
+        if self.headers is not None:
+            return self.headers.get(name)
+
+        value = self.raw_headers.get(canonical)
+        if value is not None:
+            return value
+
+        size = len(name)
+        for key, value in self.raw_headers.items():
+            if len(key) == size and key.lower() == name:
+                return value
+
+        return None
+
+    def get_base_hrefs(self):
+        """Get the (http base href, ws base href) tuple for this request."""
+        return self.server.getBaseHrefs(self.host)
+
+
 class WebThingServer:
     """Server to represent a Web Thing over HTTP."""
 
     def __init__(self, things, port=80, hostname=None, ssl_options=None,
                  additional_routes=None, base_path='',
-                 disable_host_validation=False):
+                 disable_host_validation=False, use_asyncio=False,
+                 subscriber_queue_size=16, subscriber_policy=DROP_OLDEST,
+                 action_workers=None, cache_descriptions=True,
+                 chunk_size=512, metrics=False, profile=False,
+                 preflight_max_age=600, compress_descriptions=True):
         """
         Initialize the WebThingServer.
 
@@ -129,6 +258,32 @@ class WebThingServer:
         disable_host_validation -- whether or not to disable host validation --
                                    note that this can lead to DNS rebinding
                                    attacks
+        use_asyncio -- whether to serve requests from a single (u)asyncio
+                       event loop, rather than from MicroWebSrv threads
+        subscriber_queue_size -- maximum number of outbound messages queued
+                                 per WebSocket subscriber
+        subscriber_policy -- what to do when a subscriber's queue is full --
+                             one of subscriber.DROP_OLDEST,
+                             subscriber.COALESCE or subscriber.DISCONNECT
+        action_workers -- maximum number of actions to perform at once --
+                          defaults to 1 worker thread with MicroWebSrv, and
+                          to 4 tasks with use_asyncio
+        cache_descriptions -- whether to keep encoded Thing Descriptions in
+                              memory -- if not, they are encoded and sent
+                              piece by piece on every request, which bounds
+                              peak memory use by chunk_size
+        chunk_size -- size of the chunks Thing Descriptions are sent in when
+                      not cached, in bytes
+        metrics -- whether to record request and notification metrics and
+                   serve them on /metrics
+        profile -- whether to record the heap use of every request and
+                   notification and serve it on /profile
+        preflight_max_age -- how long browsers may cache the answer to a
+                             CORS preflight request, in seconds, or None to
+                             not say
+        compress_descriptions -- whether to send cached Thing Descriptions
+                                 gzip or deflate compressed to clients which
+                                 accept it
         """
         self.ssl_suffix = '' if ssl_options is None else 's'
 
@@ -138,11 +293,60 @@ class WebThingServer:
         self.hostname = hostname
         self.base_path = base_path.rstrip('/')
         self.disable_host_validation = disable_host_validation
-
-        station = network.WLAN()
-        mac = station.config('mac')
-        self.system_hostname = 'esp32-upy-{:02x}{:02x}{:02x}'.format(
-          mac[3], mac[4], mac[5])
+        self.use_asyncio = use_asyncio
+        self.subscriber_queue_size = subscriber_queue_size
+        self.subscriber_policy = subscriber_policy
+        self.sender = AsyncSender() if use_asyncio else ThreadedSender()
+        if use_asyncio:
+            self.executor = AsyncExecutor(action_workers or 4)
+        else:
+            self.executor = ThreadedExecutor(action_workers or 1)
+        self.flusher = Flusher(self.things.get_things(),
+                               use_asyncio=use_asyncio)
+        self.scheduler = Scheduler(self.things.get_things(),
+                                   use_asyncio=use_asyncio)
+        self.metrics = Metrics() if metrics else None
+        if self.metrics is not None:
+            for thing in self.things.get_things():
+                thing.metrics = self.metrics
+
+        self.profiler = HeapProfiler() if profile else None
+        if self.profiler is not None:
+            for thing in self.things.get_things():
+                for name in ('property_notify', 'action_notify',
+                             'event_notify'):
+                    setattr(thing, name,
+                            self.profiler.wrap(name, getattr(thing, name)))
+
+        # Encoded Thing Descriptions:
+        #   (thing, include_href) -> {host: [structure_version, encoded,
+        #                                    {encoding: compressed}]}
+        # The list of things is kept compressed only, under (None, True).
+        self.cache_descriptions = cache_descriptions
+        self.compress_descriptions = \
+            compress_descriptions and compression.is_available()
+        self.chunk_size = chunk_size
+        self.description_cache = {}
+
+        # ETags are made from version counters, which start over on every
+        # boot -- the prefix keeps them from matching ETags of an earlier
+        # boot.
+        self.etag_prefix = '{:06x}'.format(random.getrandbits(24))
+
+        self.options_headers = _CORS_HEADERS
+        if preflight_max_age is not None:
+            self.options_headers = dict(_CORS_HEADERS)
+            self.options_headers['Access-Control-Max-Age'] = \
+                str(preflight_max_age)
+
+        if network is not None:
+            station = network.WLAN()
+            mac = station.config('mac')
+            self.system_hostname = 'esp32-upy-{:02x}{:02x}{:02x}'.format(
+              mac[3], mac[4], mac[5])
+        else:
+            import socket
+            self.system_hostname = socket.gethostname().lower()
 
         self.hosts = [
             'localhost',
@@ -164,109 +368,215 @@ class WebThingServer:
                 '{}:{}'.format(self.hostname, self.port),
             ])
 
+        if self.port == 80 and self.ssl_suffix == '':
+            default_port = 80
+        elif self.port == 443 and self.ssl_suffix == 's':
+            default_port = 443
+        else:
+            default_port = None
+
+        # A client may or may not include the default port, so accept
+        # either way.
+        if default_port is not None:
+            suffix = ':{}'.format(default_port)
+            self.hosts.extend([h[:-len(suffix)] for h in self.hosts
+                               if h.endswith(suffix)])
+
+        self.hosts = frozenset(self.hosts)
+
+        # Host -> (http base href, ws base href)
+        self.base_hrefs = {}
+
+        self.router = Router(self.base_path)
+        self.router.set_fallback('OPTIONS',
+                                 self.instrument('OPTIONS *',
+                                                 self.optionsHandler))
+
         if isinstance(self.things, MultipleThings):
+            thing_ids = {}
             for idx, thing in enumerate(self.things.get_things()):
                 thing.set_href_prefix('{}/{}'.format(self.base_path, idx))
-
-            handlers = [
-                [
-                    '/.*',
-                    'OPTIONS',
-                    self.optionsHandler
-                ],
-                [
-                    '/',
-                    'GET',
-                    self.thingsGetHandler
-                ],
-                [
-                    '/<thing_id>',
-                    'GET',
-                    self.thingGetHandler
-                ],
-                [
-                    '/<thing_id>/properties',
-                    'GET',
-                    self.propertiesGetHandler
-                ],
-                [
-                    '/<thing_id>/properties/<property_name>',
-                    'GET',
-                    self.propertyGetHandler
-                ],
-                [
-                    '/<thing_id>/properties/<property_name>',
-                    'PUT',
-                    self.propertyPutHandler
-                ],
-            ]
+                thing_ids[str(idx)] = thing
+
+            self.router.add_resolver(
+                'thing', lambda segment, _: thing_ids.get(segment))
+            self.router.add_resolver(
+                'property',
+                lambda segment, args: args['thing'].find_property(segment))
+
+            self.router.add_route(
+                '/', 'GET', self.instrument('GET /', self.thingsGetHandler))
+            thing_path = '/<thing>'
+            thing_args = None
         else:
-            self.things.get_thing().set_href_prefix(self.base_path)
-            handlers = [
-                [
-                    '/.*',
-                    'OPTIONS',
-                    self.optionsHandler
-                ],
-                [
-                    '/',
-                    'GET',
-                    self.thingGetHandler
-                ],
-                [
-                    '/properties',
-                    'GET',
-                    self.propertiesGetHandler
-                ],
-                [
-                    '/properties/<property_name>',
-                    'GET',
-                    self.propertyGetHandler
-                ],
-                [
-                    '/properties/<property_name>',
-                    'PUT',
-                    self.propertyPutHandler
-                ],
-            ]
+            thing = self.things.get_thing()
+            thing.set_href_prefix(self.base_path)
+
+            self.router.add_resolver(
+                'property', lambda segment, _: thing.find_property(segment))
+
+            thing_path = ''
+            thing_args = {'thing': thing}
+
+        routes = [
+            ['/', 'GET', self.thingGetHandler],
+            ['/properties', 'GET', self.propertiesGetHandler],
+            ['/properties', 'PUT', self.propertiesPutHandler],
+            ['/properties/<property>', 'GET', self.propertyGetHandler],
+            ['/properties/<property>', 'PUT', self.propertyPutHandler],
+            ['/actions', 'GET', self.actionsGetHandler],
+            ['/actions', 'POST', self.actionsPostHandler],
+            ['/actions/<action_name>', 'GET', self.actionsGetHandler],
+            ['/actions/<action_name>', 'POST', self.actionsPostHandler],
+            ['/actions/<action_name>/<action_id>', 'GET',
+             self.actionIDGetHandler],
+            ['/actions/<action_name>/<action_id>', 'DELETE',
+             self.actionIDDeleteHandler],
+            ['/events', 'GET', self.eventsGetHandler],
+            ['/events/stream', 'GET', self.eventStreamHandler],
+            ['/events/<event_name>', 'GET', self.eventsGetHandler],
+        ]
 
+        for path, method, handler in routes:
+            path = (thing_path + path).rstrip('/') or '/'
+            self.router.add_route(
+                path, method,
+                self.instrument('{} {}'.format(method, path), handler),
+                thing_args)
+
+        if self.metrics is not None:
+            self.router.add_route(
+                '/metrics', 'GET',
+                self.instrument('GET /metrics', self.metricsGetHandler))
+
+        if self.profiler is not None:
+            self.router.add_route('/profile', 'GET', self.profileGetHandler)
+            self.router.add_route('/profile', 'DELETE',
+                                  self.profileDeleteHandler)
+
+        # The server itself only routes additional routes -- everything else
+        # is dispatched by the router.
+        handlers = []
         if isinstance(additional_routes, list):
-            handlers = additional_routes + handlers
+            handlers.extend(additional_routes)
+
+        for method in _ROUTED_METHODS:
+            handlers.append(['/.*', method, self.routeHandler])
 
         if self.base_path:
             for h in handlers:
                 h[0] = self.base_path + h[0]
 
-        self.server = MicroWebSrv(webPath='/flash/www',
-                                  routeHandlers=handlers,
-                                  port=port)
+        # MicroWebSrv strips the trailing slash off the request path, which
+        # the catch-all route then no longer matches.
+        for method in _ROUTED_METHODS:
+            handlers.append([self.base_path or '/', method, self.routeHandler])
+
+        if self.use_asyncio:
+            from asyncsrv import AsyncWebSrv
+            self.server = AsyncWebSrv(routeHandlers=handlers, port=port)
+        else:
+            from microWebSrv import MicroWebSrv
+            self.server = MicroWebSrv(webPath='/flash/www',
+                                      routeHandlers=handlers,
+                                      port=port)
         self.server.MaxWebSocketRecvLen = 256
         self.WebSocketThreaded = ws_run_in_thread
         self.server.WebSocketStackSize = 8 * 1024
         self.server.AcceptWebSocketCallback = self._acceptWebSocketCallback
+        self.server.WebSocketProtocols = list(protocols.PROTOCOLS)
 
     def start(self):
-        """Start listening for incoming connections."""
+        """
+        Start listening for incoming connections.
+
+        With use_asyncio, this runs the event loop and only returns once the
+        server is stopped. Use serve() to run the server as a task on an
+        existing event loop instead.
+        """
+        if network is not None and hasattr(network, 'mDNS'):
+            mdns = network.mDNS()
+            mdns.start(self.system_hostname, 'MicroPython with mDNS')
+            mdns.addService('_webthing', '_tcp', 80, self.system_hostname,
+                            {
+                              'board': 'ESP32',
+                              'path': '/',
+                            })
+
         # If WebSocketS used and NOT running in thread, and WebServer IS
         # running in thread make shure WebServer has enough stack size to
         # handle also the WebSocket requests.
         log.info('Starting Web Server on port {}'.format(self.port))
+        if self.use_asyncio:
+            try:
+                import uasyncio as asyncio
+            except ImportError:
+                import asyncio
+
+            # The scheduler's task has to be started on the loop.
+            asyncio.run(self.serve())
+            return
+
+        self.sender.start()
+        self.scheduler.start()
         self.server.Start(threaded=srv_run_in_thread, stackSize=12*1024)
 
-        mdns = network.mDNS()
-        mdns.start(self.system_hostname, 'MicroPython with mDNS')
-        mdns.addService('_webthing', '_tcp', 80, self.system_hostname,
-                        {
-                          'board': 'ESP32',
-                          'path': '/',
-                        })
+    def serve(self):
+        """
+        Get a coroutine which serves requests until the server is stopped.
+
+        Only available with use_asyncio.
+        """
+        self.sender.start()
+        return self._serve()
+
+    async def _serve(self):
+        self.scheduler.start()
+        await self.server.serve()
+
+    def getSubscriberStats(self):
+        """
+        Get the outbound queue counters of all WebSocket subscribers.
+
+        Returns a list of dictionaries, one per subscriber.
+        """
+        stats = []
+        for thing in self.things.get_things():
+            for subscriber in thing.subscribers:
+                stat = subscriber.get_stats()
+                stat['thing'] = thing.get_href()
+                stats.append(stat)
+
+        return stats
 
     def stop(self):
         """Stop listening."""
         self.server.Stop()
+        self.sender.stop()
+        self.scheduler.stop()
+
+    def instrument(self, name, handler):
+        """
+        Wrap a route handler to record metrics and heap use, if enabled.
+
+        name -- name of the route in the metrics and heap records
+        handler -- the handler
+
+        Returns the handler to route to.
+        """
+        if self.profiler is not None:
+            handler = self.profiler.wrap(name, handler)
+
+        if self.metrics is not None:
+            handler = self.metrics.wrap(name, handler)
+
+        return handler
 
     def getThing(self, routeArgs):
-        """Get the thing ID based on the route."""
+        """Get the thing based on the route."""
+        if routeArgs and 'thing' in routeArgs:
+            return routeArgs['thing']
+
         if not routeArgs or 'thing_id' not in routeArgs:
             thing_id = None
         else:
@@ -275,7 +585,10 @@ class WebThingServer:
         return self.things.get_thing(thing_id)
 
     def getProperty(self, routeArgs):
-        """Get the property name based on the route."""
+        """Get the thing and property based on the route."""
+        if routeArgs and 'property' in routeArgs:
+            return routeArgs['thing'], routeArgs['property']
+
         thing = self.getThing(routeArgs)
         if thing:
             property_name = routeArgs['property_name']
@@ -283,71 +596,523 @@ class WebThingServer:
                 return thing, thing.find_property(property_name)
         return None, None
 
+    def routeHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Dispatch a request through the router."""
+        method = httpClient.GetRequestMethod()
+        if method == 'HEAD':
+            method = 'GET'
+            self.omitBody(httpResponse)
+
+        handler, args = self.router.resolve(httpClient.GetRequestPath(),
+                                            method)
+        if handler is not None:
+            handler(httpClient, httpResponse, args)
+        elif not self.writeStaticFile(httpClient, httpResponse):
+            httpResponse.WriteResponseNotFound()
+
+    def omitBody(self, httpResponse):
+        """
+        Make a response leave out its content, to answer a HEAD request.
+
+        The headers are written as they would be for a GET request.
+
+        httpResponse -- the response
+        """
+        def write(code, headers, contentType, contentCharset, content):
+            if isinstance(content, str):
+                content = content.encode()
+
+            self.writeHead(httpResponse, code, headers, contentType,
+                           contentCharset, len(content) if content else 0)
+            return True
+
+        httpResponse.head_only = True
+        httpResponse.WriteResponse = write
+
+    def writeHead(self, httpResponse, code, headers, contentType,
+                  contentCharset, length):
+        """
+        Write the status line and headers of a response.
+
+        httpResponse -- the response to write to
+        code -- HTTP status code
+        headers -- dict of headers
+        contentType -- content type, or None
+        contentCharset -- charset of the content, or None
+        length -- length of the content in bytes, or None for chunked
+                  transfer encoding
+        """
+        if hasattr(httpResponse, '_write_head'):
+            httpResponse._write_head(code, headers, contentType,
+                                     contentCharset, length)
+            return
+
+        if not hasattr(httpResponse, '_writeFirstLine'):
+            type(httpResponse).WriteResponse(httpResponse, code, headers,
+                                             contentType, contentCharset,
+                                             None)
+            return
+
+        # MicroWebSrv has no public API for this, so write it the same way
+        # its WriteResponse() does.
+        httpResponse._writeFirstLine(code)
+        if headers:
+            for name, value in headers.items():
+                httpResponse._writeHeader(name, value)
+        if contentType:
+            httpResponse._writeContentTypeHeader(contentType, contentCharset)
+        if length is None:
+            httpResponse._writeHeader('Transfer-Encoding', 'chunked')
+        else:
+            httpResponse._writeHeader('Content-Length', length)
+        httpResponse._writeHeader('Connection', 'close')
+        httpResponse._writeEndHeader()
+
+    def checkETag(self, httpClient, httpResponse, etag):
+        """
+        Answer a conditional request with 304 if the client's copy is current.
+
+        httpClient -- the MicroWebSrv client of the request
+        httpResponse -- the response to write to
+        etag -- the current ETag of the resource
+
+        Returns the headers to send with a full response, or None if a 304
+        response was written.
+        """
+        headers = dict(_ETAG_HEADERS)
+        headers['ETag'] = etag
+
+        match = self.getContext(httpClient).get_optional_header(
+            'if-none-match', 'If-None-Match')
+        if match is not None:
+            for tag in match.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+
+                if tag == etag or tag == '*':
+                    httpResponse.WriteResponse(304, headers, None, None,
+                                               None)
+                    return None
+
+        return headers
+
+    def getDescriptionETag(self, things, host):
+        """
+        Get the ETag of the description of one or more things.
+
+        The links in a description are built from the Host header, so the
+        ETag depends on it.
+
+        things -- a thing, or a list of things
+        host -- the Host header of the request
+
+        Returns the ETag.
+        """
+        if isinstance(things, list):
+            version = '{}.{}'.format(
+                len(things), sum(t.get_structure_version() for t in things))
+        else:
+            version = things.get_structure_version()
+
+        return '"{}-d{}-{:x}"'.format(self.etag_prefix, version,
+                                      hash(host) & 0xffffffff)
+
+    def getValuesETag(self, thing):
+        """
+        Get the ETag of the property values of a thing.
+
+        thing -- the thing
+
+        Returns the ETag.
+        """
+        return '"{}-v{}.{}"'.format(self.etag_prefix,
+                                    thing.get_structure_version(),
+                                    thing.get_value_version())
+
+    def writeStaticFile(self, httpClient, httpResponse):
+        """
+        Serve a file from MicroWebSrv's web path, if there is one.
+
+        Returns a boolean indicating whether a file was served.
+        """
+        if httpClient.GetRequestMethod() != 'GET' or \
+                not hasattr(self.server, '_physPathFromURLPath'):
+            return False
+
+        path = self.server._physPathFromURLPath(httpClient.GetRequestPath())
+        if path is None:
+            return False
+
+        httpResponse.WriteResponseFile(
+            path, self.server.GetMimeTypeFromFilename(path), _CORS_HEADERS)
+        return True
+
+    def getContext(self, httpClient):
+        """
+        Get the context of the current request.
+
+        The context is created on first use and then kept on the client, so
+        the request headers are only normalized once.
+
+        httpClient -- the MicroWebSrv client of the request
+
+        Returns a RequestContext.
+        """
+        try:
+            return httpClient.webthing_context
+        except AttributeError:
+            ctx = RequestContext(self, httpClient)
+            httpClient.webthing_context = ctx
+            return ctx
+
     def getHeader(self, headers, key, default=None):
-        standardized = {k.lower(): v for k, v in headers.items()}
-        return standardized.get(key, default)
+        """
+        Get a header, ignoring the case of its name.
+
+        Handlers should use getContext(httpClient).get_header() instead, which
+        doesn't copy the headers on every call.
+        """
+        for k, v in headers.items():
+            if k.lower() == key:
+                return v
+
+        return default
 
     def validateHost(self, headers):
         """Validate the Host header in the request."""
-        host = self.getHeader(headers, 'host')
-        if self.disable_host_validation or (
-                host is not None and host.lower() in self.hosts):
+        return self.isValidHost(self.getHeader(headers, 'host'))
+
+    def isValidHost(self, host):
+        """
+        Validate a Host header value.
+
+        host -- the value, or None if there was no Host header
+
+        Returns a boolean.
+        """
+        if self.disable_host_validation:
             return True
 
-        return False
+        if host is None:
+            return False
+
+        return host in self.hosts or host.lower() in self.hosts
+
+    def getBaseHrefs(self, host):
+        """
+        Get the base URLs for a Host header value.
+
+        host -- the value
+
+        Returns a (http base href, ws base href) tuple.
+        """
+        hrefs = self.base_hrefs.get(host)
+        if hrefs is None:
+            hrefs = (
+                'http{}://{}'.format(self.ssl_suffix, host),
+                'ws{}://{}'.format(self.ssl_suffix, host),
+            )
+
+            if len(self.base_hrefs) >= len(self.hosts) + _MAX_CACHED_HOSTS:
+                self.base_hrefs.clear()
+            self.base_hrefs[host] = hrefs
+
+        return hrefs
 
     @print_exc
     def optionsHandler(self, httpClient, httpResponse, routeArgs=None):
         """Handle an OPTIONS request to any path."""
-        if not self.validateHost(httpClient.GetRequestHeaders()):
+        if not self.getContext(httpClient).host_valid:
             httpResponse.WriteResponseError(403)
             return
 
-        httpResponse.WriteResponse(204, _CORS_HEADERS, None, None, None)
+        httpResponse.WriteResponse(204, self.options_headers, None, None,
+                                   None)
+
+    def buildThingDescription(self, thing, host, include_href=False):
+        """
+        Build the Thing Description of a thing, as seen from a host.
+
+        thing -- the thing to describe
+        host -- the Host header of the request
+        include_href -- whether or not to include the thing's href
+
+        Returns the description as a dictionary.
+        """
+        base_href, ws_href = self.getBaseHrefs(host)
+
+        description = thing.as_thing_description()
+        description['links'].append({
+            'rel': 'alternate',
+            'href': '{}{}'.format(ws_href, thing.get_href()),
+        })
+        if include_href:
+            description['href'] = thing.get_href()
+        description['base'] = '{}{}'.format(base_href, thing.get_href())
+        description['securityDefinitions'] = {
+            'nosec_sc': {
+                'scheme': 'nosec',
+            },
+        }
+        description['security'] = 'nosec_sc'
+        return description
+
+    def getThingDescription(self, thing, host, include_href=False):
+        """
+        Get the encoded Thing Description of a thing, as seen from a host.
+
+        The encoded description is cached per (thing, host) pair and is only
+        rebuilt when the thing's structure version changes.
+
+        thing -- the thing to describe
+        host -- the Host header of the request
+        include_href -- whether or not to include the thing's href
+
+        Returns the description as UTF-8 encoded JSON.
+        """
+        return self.getDescriptionEntry(thing, host, include_href)[1]
+
+    def getDescriptionEntry(self, thing, host, include_href):
+        """
+        Get the description cache entry of a thing, as seen from a host.
+
+        The entry is rebuilt if the thing's structure version changed.
+
+        thing -- the thing to describe, or None for the list of things
+        host -- the Host header of the request
+        include_href -- whether or not to include the thing's href
+
+        Returns the entry.
+        """
+        key = (thing, include_href)
+        if thing is None:
+            version = self.getDescriptionETag(self.things.get_things(),
+                                              host)
+        else:
+            version = thing.get_structure_version()
+
+        cache = self.description_cache.get(key)
+        if cache is None:
+            cache = {}
+            self.description_cache[key] = cache
+
+        entry = cache.get(host)
+        if entry is not None and entry[0] == version:
+            return entry
+
+        encoded = None
+        if thing is not None:
+            encoded = json.dumps(
+                self.buildThingDescription(thing, host, include_href)
+            ).encode()
+
+        if host not in cache and len(cache) >= _MAX_CACHED_HOSTS:
+            cache.clear()
+        entry = [version, encoded, {}]
+        cache[host] = entry
+        return entry
+
+    def writeCompressed(self, httpClient, httpResponse, headers, entry,
+                        pieces):
+        """
+        Write a cached description compressed, if the client accepts it.
+
+        The compressed content is kept in the cache entry, so each
+        description is only compressed once per structure version.
+
+        httpClient -- the MicroWebSrv client of the request
+        httpResponse -- the response to write to
+        headers -- dict of headers, including the ETag
+        entry -- the description cache entry
+        pieces -- list of bytes making up the uncompressed content
+
+        Returns True if the response was written, else False.
+        """
+        if not self.compress_descriptions:
+            return False
+
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = compression.choose_encoding(
+            self.getContext(httpClient).get_header('accept-encoding'))
+        if encoding is None:
+            return False
+
+        compressed = entry[2].get(encoding)
+        if compressed is None:
+            compressed = compression.compress(b''.join(pieces), encoding)
+            if compressed is None:
+                # Compression isn't supported by this firmware.
+                self.compress_descriptions = False
+                return False
+
+            if len(compressed) >= sum(len(p) for p in pieces):
+                compressed = False
+            entry[2][encoding] = compressed
+
+        if compressed is False:
+            return False
+
+        # The compressed content is a different representation, so it gets
+        # a weak ETag -- which still matches the same If-None-Match.
+        headers['ETag'] = 'W/' + headers['ETag']
+        headers['Content-Encoding'] = encoding
+        httpResponse.WriteResponse(200, headers, 'application/json', 'UTF-8',
+                                   compressed)
+        return True
+
+    def streamThingDescriptions(self, things, host, include_href):
+        """
+        Encode Thing Descriptions piece by piece, without caching them.
+
+        Only one thing's description dictionary exists at a time.
+
+        things -- list of things to describe, or a single thing
+        host -- the Host header of the request
+        include_href -- whether or not to include the things' hrefs
+
+        Yields the encoded pieces.
+        """
+        if not isinstance(things, list):
+            description = self.buildThingDescription(things, host,
+                                                     include_href)
+            for piece in iterencode(description):
+                yield piece
+            return
+
+        yield '['
+        for idx, thing in enumerate(things):
+            if idx > 0:
+                yield ', '
+
+            description = self.buildThingDescription(thing, host,
+                                                     include_href)
+            for piece in iterencode(description):
+                yield piece
+
+            description = None
+        yield ']'
+
+    def writeJSONChunks(self, httpResponse, chunks, length=None,
+                        headers=_CORS_HEADERS):
+        """
+        Write a 200 JSON response whose content is produced piece by piece.
+
+        httpResponse -- the response to write to
+        chunks -- iterable of bytes
+        length -- length of the content in bytes, if known -- else chunked
+                  transfer encoding is used
+        headers -- dict of headers
+        """
+        if getattr(httpResponse, 'head_only', False):
+            self.writeHead(httpResponse, 200, headers, 'application/json',
+                           'UTF-8', length)
+            return
+
+        if hasattr(httpResponse, 'WriteResponseChunks'):
+            httpResponse.WriteResponseChunks(200, headers,
+                                             'application/json', 'UTF-8',
+                                             chunks, length)
+            return
+
+        if not hasattr(httpResponse, '_writeFirstLine'):
+            httpResponse.WriteResponse(200, headers, 'application/json',
+                                       'UTF-8', b''.join(chunks))
+            return
+
+        # MicroWebSrv has no public API for streamed responses.
+        self.writeHead(httpResponse, 200, headers, 'application/json',
+                       'UTF-8', length)
+
+        for chunk in chunks:
+            if length is None:
+                httpResponse._write('{:x}\r\n'.format(len(chunk)))
+                httpResponse._write(chunk)
+                httpResponse._write('\r\n')
+            else:
+                httpResponse._write(chunk)
+
+        if length is None:
+            httpResponse._write('0\r\n\r\n')
 
     @print_exc
-    def thingsGetHandler(self, httpClient, httpResponse):
-        """Handle a request to / when the server manages multiple things."""
-        if not self.validateHost(httpClient.GetRequestHeaders()):
+    def metricsGetHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a GET request for the metrics."""
+        if not self.getContext(httpClient).host_valid:
             httpResponse.WriteResponseError(403)
             return
 
-        headers = httpClient.GetRequestHeaders()
-        base_href = 'http{}://{}'.format(
-            self.ssl_suffix,
-            self.getHeader(headers, 'host', '')
-        )
-        ws_href = 'ws{}://{}'.format(
-            self.ssl_suffix,
-            self.getHeader(headers, 'host', '')
-        )
+        httpResponse.WriteResponse(
+            200, _CORS_HEADERS, 'text/plain; version=0.0.4', 'UTF-8',
+            self.metrics.render(self.getSubscriberStats()))
 
-        descriptions = []
-        for thing in self.things.get_things():
-            description = thing.as_thing_description()
-            description['links'].append({
-                'rel': 'alternate',
-                'href': '{}{}'.format(ws_href, thing.get_href()),
-            })
-            description['href'] = thing.get_href()
-            description['base'] = '{}{}'.format(base_href, thing.get_href())
-            description['securityDefinitions'] = {
-                'nosec_sc': {
-                    'scheme': 'nosec',
-                },
-            }
-            description['security'] = 'nosec_sc'
-            descriptions.append(description)
+    @print_exc
+    def profileGetHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a GET request for the heap profile."""
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
 
         httpResponse.WriteResponseJSONOk(
-            obj=descriptions,
+            obj=self.profiler.dump(),
             headers=_CORS_HEADERS,
         )
 
+    @print_exc
+    def profileDeleteHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a DELETE request to clear the heap profile."""
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        self.profiler.clear()
+        httpResponse.WriteResponse(204, _CORS_HEADERS, None, None, None)
+
+    @print_exc
+    def thingsGetHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a request to / when the server manages multiple things."""
+        ctx = self.getContext(httpClient)
+        if not ctx.host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        things = self.things.get_things()
+        headers = self.checkETag(httpClient, httpResponse,
+                                 self.getDescriptionETag(things, ctx.host))
+        if headers is None:
+            return
+
+        if not self.cache_descriptions:
+            self.writeJSONChunks(
+                httpResponse,
+                chunked(self.streamThingDescriptions(things, ctx.host, True),
+                        self.chunk_size),
+                headers=headers)
+            return
+
+        # Write the cached descriptions one after the other, rather than
+        # joining them into one big string.
+        pieces = [b'[']
+        for thing in things:
+            if len(pieces) > 1:
+                pieces.append(b', ')
+            pieces.append(self.getThingDescription(thing, ctx.host,
+                                                   include_href=True))
+        pieces.append(b']')
+
+        entry = self.getDescriptionEntry(None, ctx.host, True)
+        if self.writeCompressed(httpClient, httpResponse, headers, entry,
+                                pieces):
+            return
+
+        self.writeJSONChunks(httpResponse, pieces,
+                             sum(len(p) for p in pieces), headers)
+
     @print_exc
     def thingGetHandler(self, httpClient, httpResponse, routeArgs=None):
         """Handle a GET request for an individual thing."""
-        if not self.validateHost(httpClient.GetRequestHeaders()):
+        ctx = self.getContext(httpClient)
+        if not ctx.host_valid:
             httpResponse.WriteResponseError(403)
             return
 
@@ -356,47 +1121,214 @@ class WebThingServer:
             httpResponse.WriteResponseNotFound()
             return
 
-        headers = httpClient.GetRequestHeaders()
-        base_href = 'http{}://{}'.format(
-            self.ssl_suffix,
-            self.getHeader(headers, 'host', '')
-        )
-        ws_href = 'ws{}://{}'.format(
-            self.ssl_suffix,
-            self.getHeader(headers, 'host', '')
-        )
+        headers = self.checkETag(httpClient, httpResponse,
+                                 self.getDescriptionETag(thing, ctx.host))
+        if headers is None:
+            return
 
-        description = thing.as_thing_description()
-        description['links'].append({
-            'rel': 'alternate',
-            'href': '{}{}'.format(ws_href, thing.get_href()),
-        })
-        description['base'] = '{}{}'.format(base_href, thing.get_href())
-        description['securityDefinitions'] = {
-            'nosec_sc': {
-                'scheme': 'nosec',
-            },
-        }
-        description['security'] = 'nosec_sc'
+        if not self.cache_descriptions:
+            self.writeJSONChunks(
+                httpResponse,
+                chunked(self.streamThingDescriptions(thing, ctx.host, False),
+                        self.chunk_size),
+                headers=headers)
+            return
 
-        httpResponse.WriteResponseJSONOk(
-            obj=description,
-            headers=_CORS_HEADERS,
-        )
+        entry = self.getDescriptionEntry(thing, ctx.host, False)
+        encoded = entry[1]
+        if self.writeCompressed(httpClient, httpResponse, headers, entry,
+                                [encoded]):
+            return
+
+        httpResponse.WriteResponse(200, headers, 'application/json',
+                                   'UTF-8', encoded)
 
     @print_exc
     def propertiesGetHandler(self, httpClient, httpResponse, routeArgs=None):
         """Handle a GET request for a property."""
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
         thing = self.getThing(routeArgs)
         if thing is None:
             httpResponse.WriteResponseNotFound()
             return
-        httpResponse.WriteResponseJSONOk(thing.get_properties())
+
+        params = {}
+        if hasattr(httpClient, 'GetRequestQueryParams'):
+            params = httpClient.GetRequestQueryParams()
+
+        if 'since' in params:
+            try:
+                since = int(params['since'])
+                wait = int(params.get('wait', 0))
+                if since < 0 or wait < 0:
+                    raise ValueError
+            except ValueError:
+                httpResponse.WriteResponseBadRequest()
+                return
+
+            self.changesGetHandler(httpClient, httpResponse, thing, since,
+                                   min(wait, _MAX_WAIT_MS))
+            return
+
+        headers = self.checkETag(httpClient, httpResponse,
+                                 self.getValuesETag(thing))
+        if headers is None:
+            return
+
+        httpResponse.WriteResponseJSONOk(obj=thing.get_properties(),
+                                         headers=headers)
+
+    def changesGetHandler(self, httpClient, httpResponse, thing, since,
+                          wait):
+        """
+        Handle a GET request for the properties changed since a version.
+
+        The response holds the thing's current value version and the
+        properties changed after the given one -- all of them, right away,
+        for version 0. With wait, the response is held until a value changes,
+        or for that many milliseconds.
+
+        httpClient -- the MicroWebSrv client of the request
+        httpResponse -- the response to write to
+        thing -- the thing
+        since -- the value version the client has seen
+        wait -- how long to wait for a change, in milliseconds
+        """
+        # A version ahead of the thing's is from before a restart, so the
+        # client gets everything, as for version 0.
+        changed_since = since
+        if since == 0 or since > thing.get_value_version():
+            changed_since = -1
+
+        def respond():
+            httpResponse.WriteResponseJSONOk(
+                obj={
+                    'version': thing.get_value_version(),
+                    'properties': thing.get_changed_properties(changed_since),
+                },
+                headers=_CORS_HEADERS,
+            )
+
+        if wait and since and thing.get_value_version() == since:
+            self.waitForChange(httpClient, httpResponse, thing, since, wait,
+                               respond)
+        else:
+            respond()
+
+    def waitForChange(self, httpClient, httpResponse, thing, version, wait,
+                      respond):
+        """
+        Respond to a request once a value of a thing changes, or on timeout.
+
+        The handler returns right away, so neither the event loop nor
+        MicroWebSrv's thread is held up -- with MicroWebSrv, the socket is
+        taken over until the response is written, from the sender thread
+        rather than from the thread which changed the value.
+
+        httpClient -- the MicroWebSrv client of the request
+        httpResponse -- the response to write to
+        thing -- the thing
+        version -- the value version to wait for a change from
+        wait -- how long to wait, in milliseconds
+        respond -- function writing the response
+        """
+        if hasattr(httpResponse, 'WriteResponseLater'):
+            event = asyncio.Event()
+            # Keep the one bound method, to remove the same object it added.
+            wake = event.set
+            thing.add_version_waiter(wake)
+
+            async def later():
+                try:
+                    await asyncio.wait_for(event.wait(), wait / 1000)
+                except asyncio.TimeoutError:
+                    thing.remove_version_waiter(wake)
+                respond()
+
+            httpResponse.WriteResponseLater(later())
+            return
+
+        sock = eventstream.detach(httpClient)
+        if sock is None:
+            respond()
+            return
+
+        lock = _thread.allocate_lock()
+        timer = []
+        done = []
+
+        def finish():
+            # Runs once, on whichever comes first of the value change and the
+            # timeout.
+            lock.acquire()
+            finished = bool(done)
+            done.append(True)
+            lock.release()
+            if finished:
+                return
+
+            thing.remove_version_waiter(finish)
+            if timer:
+                self.scheduler.cancel(timer[0])
+
+            self.sender.call(write)
+
+        def write():
+            sock.reattach()
+            try:
+                respond()
+            finally:
+                sock.close()
+
+        timer.append(self.scheduler.schedule(
+            finish, wait, phase_ms=wait - self.scheduler.tick_ms,
+            name='wait_for_change'))
+        thing.add_version_waiter(finish)
+
+        # A value may have changed on another thread in the meantime.
+        if thing.get_value_version() != version:
+            finish()
+
+    @print_exc
+    def propertiesPutHandler(self, httpClient, httpResponse, routeArgs=None):
+        """
+        Handle a PUT request for several properties at once.
+
+        The values are validated and applied as one transaction, see
+        Thing.set_properties().
+        """
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        thing = self.getThing(routeArgs)
+        if thing is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        args = httpClient.ReadRequestContentAsJSON()
+        if not isinstance(args, dict) or not args:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        try:
+            thing.set_properties(args)
+        except PropertyError:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        httpResponse.WriteResponseJSONOk(
+            obj={name: thing.get_property(name) for name in args},
+            headers=_CORS_HEADERS,
+        )
 
     @print_exc
     def propertyGetHandler(self, httpClient, httpResponse, routeArgs=None):
         """Handle a GET request for a property."""
-        if not self.validateHost(httpClient.GetRequestHeaders()):
+        if not self.getContext(httpClient).host_valid:
             httpResponse.WriteResponseError(403)
             return
 
@@ -404,15 +1336,23 @@ class WebThingServer:
         if thing is None or prop is None:
             httpResponse.WriteResponseNotFound()
             return
+
+        # The ETag covers all of the thing's values, which is coarser than
+        # needed but costs nothing to keep.
+        headers = self.checkETag(httpClient, httpResponse,
+                                 self.getValuesETag(thing))
+        if headers is None:
+            return
+
         httpResponse.WriteResponseJSONOk(
             obj={prop.get_name(): prop.get_value()},
-            headers=_CORS_HEADERS,
+            headers=headers,
         )
 
     @print_exc
     def propertyPutHandler(self, httpClient, httpResponse, routeArgs=None):
         """Handle a PUT request for a property."""
-        if not self.validateHost(httpClient.GetRequestHeaders()):
+        if not self.getContext(httpClient).host_valid:
             httpResponse.WriteResponseError(403)
             return
 
@@ -434,6 +1374,272 @@ class WebThingServer:
             headers=_CORS_HEADERS,
         )
 
+    def getPageParams(self, httpClient):
+        """
+        Parse the pagination parameters of a request.
+
+        The query parameters are 'after', to only return items with a higher
+        sequence number, 'since', to only return items with at least this
+        sequence number or from at least this timestamp, i.e.
+        2018-01-01T00:00:00+00:00, and 'limit', the maximum number of items
+        to return.
+
+        httpClient -- the MicroWebSrv client of the request
+
+        Returns an (after, since, limit) tuple, with None for missing
+        parameters. Raises ValueError if a parameter is invalid.
+        """
+        params = {}
+        if hasattr(httpClient, 'GetRequestQueryParams'):
+            params = httpClient.GetRequestQueryParams()
+
+        after = params.get('after')
+        if after is not None:
+            after = int(after)
+
+        since = params.get('since')
+        if since is not None and since.isdigit():
+            since = int(since)
+
+        limit = params.get('limit')
+        if limit is not None:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError('limit must be positive')
+
+        return after, since, limit
+
+    def writePage(self, httpClient, httpResponse, items, last_seq, since,
+                  limit):
+        """
+        Write one page of a paginated collection.
+
+        The body is an array of descriptions, as without pagination. The Link
+        header points at the next page, which pollers follow to get only what
+        is new.
+
+        httpClient -- the MicroWebSrv client of the request
+        httpResponse -- the response to write to
+        items -- list of (sequence number, timestamp, object) tuples, oldest
+                 first, already filtered by the after parameter
+        last_seq -- last sequence number handed out so far
+        since -- the since parameter, see getPageParams()
+        limit -- the limit parameter, see getPageParams()
+        """
+        if since is not None:
+            # Timestamps share one fixed format, so they compare as strings.
+            idx = 0 if isinstance(since, int) else 1
+            items = [i for i in items if i[idx] >= since]
+
+        if limit is not None and len(items) > limit:
+            items = items[:limit]
+
+        cursor = items[-1][0] if items else last_seq
+        link = '{}?after={}'.format(httpClient.GetRequestPath(), cursor)
+        if limit is not None:
+            link += '&limit={}'.format(limit)
+
+        headers = dict(_PAGE_HEADERS)
+        headers['Link'] = '<{}>; rel="next"'.format(link)
+
+        httpResponse.WriteResponseJSONOk(
+            obj=[describe() for _, _, describe in items],
+            headers=headers,
+        )
+
+    @print_exc
+    def actionsGetHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a GET request for the actions of a thing, or of one name."""
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        thing = self.getThing(routeArgs)
+        if thing is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        action_name = routeArgs.get('action_name') if routeArgs else None
+        if action_name is not None and \
+                action_name not in thing.available_actions:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        try:
+            after, since, limit = self.getPageParams(httpClient)
+        except ValueError:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        items = [(a.seq, a.time_requested, a.as_action_description)
+                 for a in thing.actions.actions(action_name, after)]
+        self.writePage(httpClient, httpResponse, items,
+                       thing.actions.next_seq - 1, since, limit)
+
+    @print_exc
+    def actionsPostHandler(self, httpClient, httpResponse, routeArgs=None):
+        """
+        Handle a POST request to create an action.
+
+        The body is {"<action name>": {"input": ...}}. When posted to
+        /actions/<action name>, the name must match.
+        """
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        thing = self.getThing(routeArgs)
+        if thing is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        message = httpClient.ReadRequestContentAsJSON()
+        if not isinstance(message, dict) or len(message) != 1:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        action_name, action_params = list(message.items())[0]
+        if routeArgs and 'action_name' in routeArgs and \
+                routeArgs['action_name'] != action_name:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        input_ = None
+        if isinstance(action_params, dict):
+            input_ = action_params.get('input')
+
+        action = thing.perform_action(action_name, input_)
+        if action is None:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        self.startAction(action)
+        httpResponse.WriteResponse(
+            201, _CORS_HEADERS, 'application/json', 'UTF-8',
+            json.dumps(action.as_action_description()))
+
+    @print_exc
+    def actionIDGetHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a GET request for an individual action."""
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        thing = self.getThing(routeArgs)
+        if thing is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        action = thing.get_action(routeArgs['action_name'],
+                                  routeArgs['action_id'])
+        if action is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        httpResponse.WriteResponseJSONOk(
+            obj=action.as_action_description(),
+            headers=_CORS_HEADERS,
+        )
+
+    @print_exc
+    def actionIDDeleteHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a DELETE request for an individual action."""
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        thing = self.getThing(routeArgs)
+        if thing is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        if thing.remove_action(routeArgs['action_name'],
+                               routeArgs['action_id']):
+            httpResponse.WriteResponse(204, _CORS_HEADERS, None, None, None)
+        else:
+            httpResponse.WriteResponseNotFound()
+
+    @print_exc
+    def eventsGetHandler(self, httpClient, httpResponse, routeArgs=None):
+        """Handle a GET request for the events of a thing, or of one name."""
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        thing = self.getThing(routeArgs)
+        if thing is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        event_name = routeArgs.get('event_name') if routeArgs else None
+        if event_name is not None and \
+                event_name not in thing.available_events:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        try:
+            after, since, limit = self.getPageParams(httpClient)
+        except ValueError:
+            httpResponse.WriteResponseBadRequest()
+            return
+
+        items = [(seq, e.get_time(), e.as_event_description)
+                 for seq, e in thing.events.items(event_name, after)]
+        self.writePage(httpClient, httpResponse, items,
+                       thing.events.next_seq - 1, since, limit)
+
+    @print_exc
+    def eventStreamHandler(self, httpClient, httpResponse, routeArgs=None):
+        """
+        Handle a GET request for a thing's Server-Sent Events stream.
+
+        The stream carries the same propertyStatus, actionStatus and event
+        messages as a WebSocket, for all of the thing's events.
+        """
+        if not self.getContext(httpClient).host_valid:
+            httpResponse.WriteResponseError(403)
+            return
+
+        thing = self.getThing(routeArgs)
+        if thing is None:
+            httpResponse.WriteResponseNotFound()
+            return
+
+        headers = dict(_CORS_HEADERS)
+        headers['Cache-Control'] = 'no-cache'
+
+        if getattr(httpResponse, 'head_only', False):
+            httpResponse.WriteResponse(200, headers, 'text/event-stream',
+                                       'UTF-8', None)
+            return
+
+        if hasattr(httpResponse, 'WriteResponseEventStream'):
+            stream = httpResponse.WriteResponseEventStream(headers)
+        else:
+            # MicroWebSrv would close the connection once this returns, so
+            # the socket is taken over from it instead.
+            self.writeHead(httpResponse, 200, headers, 'text/event-stream',
+                           'UTF-8', None)
+            sock = eventstream.detach(httpClient)
+            if sock is None:
+                return
+            stream = eventstream.SocketEventStream(sock)
+
+        stream.thing = thing
+        stream.subscriber = Subscriber(stream,
+                                       max_queue=self.subscriber_queue_size,
+                                       policy=self.subscriber_policy,
+                                       protocol=protocols.SSE)
+        stream.ClosedCallback = self._streamClosedCallback
+        self.sender.add(stream.subscriber)
+        thing.add_subscriber(stream.subscriber)
+        for name in thing.available_events:
+            thing.add_event_subscriber(name, stream.subscriber)
+
+    def _streamClosedCallback(self, stream):
+        stream.thing.remove_subscriber(stream.subscriber)
+        self.sender.remove(stream.subscriber)
+
     # === MicroWebSocket callbacks ===
 
     @print_exc
@@ -441,35 +1647,162 @@ class WebThingServer:
         reqPath = httpClient.GetRequestPath()
         if WS_messages:
             print('WS ACCEPT reqPath =', reqPath)
-            if ws_run_in_thread or srv_run_in_thread:
+            if not self.use_asyncio and \
+                    (ws_run_in_thread or srv_run_in_thread):
                 # Print thread list so that we can monitor maximum stack size
                 # of WebServer thread and WebSocket thread if any is used
                 _thread.list()
         webSocket.RecvTextCallback = self._recvTextCallback
         webSocket.RecvBinaryCallback = self._recvBinaryCallback
         webSocket.ClosedCallback = self._closedCallback
-        things = self.things.get_things()
-        if len(things) == 1:
-            thing_id = 0
-        else:
-            thing_id = int(reqPath.split('/')[1])
-        thing = things[thing_id]
+        _, args = self.router.resolve(reqPath, 'GET')
+        thing = args.get('thing') if args else None
+        if thing is None:
+            webSocket.thing = None
+            webSocket.Close()
+            return
+
+        # AsyncWebSrv negotiates the subprotocol in its handshake.
+        # MicroWebSrv's handshake selects none, so its clients get the
+        # default protocol.
+        name = getattr(webSocket, 'protocol', None)
+
         webSocket.thing = thing
-        thing.add_subscriber(webSocket)
+        webSocket.subscriber = Subscriber(webSocket,
+                                          max_queue=self.subscriber_queue_size,
+                                          policy=self.subscriber_policy,
+                                          protocol=protocols.get(name))
+        self.sender.add(webSocket.subscriber)
+        thing.add_subscriber(webSocket.subscriber)
 
     @print_exc
     def _recvTextCallback(self, webSocket, msg):
         if WS_messages:
             print('WS RECV TEXT : %s' % msg)
 
+        if getattr(webSocket, 'subscriber', None) is None:
+            # The WebSocket was rejected.
+            return
+
+        try:
+            message = json.loads(msg)
+        except ValueError:
+            self._sendError(webSocket, 'Parsing request failed')
+            return
+
+        self._handleMessage(webSocket, message)
+
     @print_exc
     def _recvBinaryCallback(self, webSocket, data):
         if WS_messages:
             print('WS RECV DATA : %s' % data)
 
+        subscriber = getattr(webSocket, 'subscriber', None)
+        if subscriber is None:
+            # The WebSocket was rejected.
+            return
+
+        protocol = subscriber.protocol
+        if not protocol.binary:
+            self._sendError(webSocket, 'Binary messages are not supported')
+            return
+
+        try:
+            message = protocol.loads(data)
+        except ValueError:
+            self._sendError(webSocket, 'Parsing request failed')
+            return
+
+        self._handleMessage(webSocket, message)
+
+    def _handleMessage(self, webSocket, message):
+        """
+        Handle a decoded message received over a WebSocket.
+
+        webSocket -- the WebSocket the message was received on
+        message -- the decoded message
+        """
+        if not isinstance(message, dict) or \
+                'messageType' not in message or 'data' not in message or \
+                not isinstance(message['data'], dict):
+            self._sendError(webSocket, 'Invalid message')
+            return
+
+        thing = webSocket.thing
+        msg_type = message['messageType']
+        if msg_type == 'setProperty':
+            try:
+                thing.set_properties(message['data'])
+            except PropertyError as e:
+                self._sendError(webSocket, str(e))
+        elif msg_type == 'requestAction':
+            for action_name, action_params in message['data'].items():
+                input_ = None
+                if isinstance(action_params, dict) and \
+                        'input' in action_params:
+                    input_ = action_params['input']
+
+                action = thing.perform_action(action_name, input_)
+                if action:
+                    self.startAction(action)
+                else:
+                    self._sendError(webSocket, 'Invalid action request',
+                                    message)
+        elif msg_type == 'addEventSubscription':
+            for event_name in message['data'].keys():
+                if event_name in thing.available_events:
+                    thing.add_event_subscriber(event_name,
+                                               webSocket.subscriber)
+                else:
+                    self._sendError(webSocket, 'Invalid event subscription',
+                                    message)
+        else:
+            self._sendError(webSocket,
+                            'Unknown messageType: {}'.format(msg_type),
+                            message)
+
     @print_exc
     def _closedCallback(self, webSocket):
         if WS_messages:
-            if ws_run_in_thread or srv_run_in_thread:
+            if not self.use_asyncio and \
+                    (ws_run_in_thread or srv_run_in_thread):
                 _thread.list()
             print('WS CLOSED')
+
+        subscriber = getattr(webSocket, 'subscriber', None)
+        if subscriber is not None:
+            webSocket.thing.remove_subscriber(subscriber)
+            self.sender.remove(subscriber)
+
+    def _sendError(self, webSocket, message, request=None):
+        """
+        Send an error message over a WebSocket.
+
+        webSocket -- the WebSocket to send on
+        message -- the error message
+        request -- optional request which caused the error
+        """
+        data = {
+            'status': '400 Bad Request',
+            'message': message,
+        }
+
+        if request is not None:
+            data['request'] = request
+
+        subscriber = webSocket.subscriber
+        subscriber.send(subscriber.protocol.dumps({
+            'messageType': 'error',
+            'data': data,
+        }))
+
+    def startAction(self, action):
+        """
+        Queue an action on the server's executor.
+
+        Use executor.set_limit() to limit how many actions with a given name
+        run at once.
+
+        action -- the action to start
+        """
+        self.executor.submit(action)
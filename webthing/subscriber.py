@@ -0,0 +1,321 @@
+"""Queued WebSocket subscribers and the senders that drain them."""
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+import _thread
+import logging
+
+from protocols import JSON
+from utils import start_thread
+
+log = logging.getLogger(__name__)
+
+# Overflow policies, applied when a message is sent to a full queue.
+#   DROP_OLDEST -- drop the oldest queued message
+#   COALESCE -- replace any queued message with the same key (i.e. an older
+#               status of the same property) as soon as a new one is sent,
+#               and drop the oldest message when still full
+#   DISCONNECT -- drop the whole queue and disconnect the subscriber
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+
+
+class Subscriber:
+    """
+    A WebSocket subscriber with a bounded outbound queue.
+
+    Producers, i.e. Thing.property_notify, only ever append to the queue, so
+    they never block on the network. A sender drains the queue onto the
+    WebSocket.
+    """
+
+    def __init__(self, ws, max_queue=16, policy=DROP_OLDEST, protocol=JSON):
+        """
+        Initialize the object.
+
+        ws -- the WebSocket to send on
+        max_queue -- maximum number of queued messages
+        policy -- overflow policy, one of DROP_OLDEST, COALESCE or DISCONNECT
+        protocol -- the subprotocol messages are encoded with
+        """
+        self.ws = ws
+        self.protocol = protocol
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue = []
+        self.keys = []
+        self.lock = _thread.allocate_lock()
+        self.on_ready = None
+        self.evicted = False
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+
+    def send(self, message, key=None):
+        """
+        Queue a message for sending.
+
+        message -- the message, encoded with the subscriber's protocol
+        key -- optional key identifying what the message is about, so that
+               the COALESCE policy can replace an older message with it
+
+        Returns a boolean indicating whether or not the message was queued.
+        """
+        if self.closed or self.evicted:
+            return False
+
+        self.lock.acquire()
+        try:
+            if key is not None and self.policy == COALESCE:
+                for idx in range(len(self.keys)):
+                    if self.keys[idx] == key:
+                        self.queue[idx] = message
+                        self.coalesced += 1
+                        return True
+
+            if len(self.queue) >= self.max_queue:
+                if self.policy == DISCONNECT:
+                    self.dropped += len(self.queue) + 1
+                    self.queue = []
+                    self.keys = []
+                    self.evicted = True
+                    log.info('Evicting slow subscriber')
+                else:
+                    self.queue.pop(0)
+                    self.keys.pop(0)
+                    self.dropped += 1
+
+            if not self.evicted:
+                self.queue.append(message)
+                self.keys.append(key)
+                if len(self.queue) > self.high_water:
+                    self.high_water = len(self.queue)
+
+            ready = len(self.queue) == 1 or self.evicted
+        finally:
+            self.lock.release()
+
+        if ready and self.on_ready is not None:
+            self.on_ready(self)
+
+        return not self.evicted
+
+    def pop(self):
+        """
+        Take the next message off the queue.
+
+        Returns the message, or None if the queue is empty.
+        """
+        self.lock.acquire()
+        try:
+            if not self.queue:
+                return None
+
+            self.keys.pop(0)
+            return self.queue.pop(0)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Mark the subscriber closed and drop anything still queued."""
+        self.lock.acquire()
+        self.closed = True
+        self.queue = []
+        self.keys = []
+        self.lock.release()
+
+    def get_stats(self):
+        """
+        Get the subscriber's counters.
+
+        Returns a dictionary of counter name -> value.
+        """
+        return {
+            'queued': len(self.queue),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'highWater': self.high_water,
+            'evicted': self.evicted,
+        }
+
+
+class ThreadedSender:
+    """Drains subscriber queues from a single dedicated thread."""
+
+    def __init__(self):
+        """Initialize the object."""
+        self.ready = []
+        self.calls = []
+        self.lock = _thread.allocate_lock()
+        self.wakeup = _thread.allocate_lock()
+        self.wakeup.acquire()
+        self.running = False
+
+    def add(self, subscriber):
+        """
+        Start draining a subscriber's queue.
+
+        subscriber -- the subscriber
+        """
+        subscriber.on_ready = self._ready
+
+    def remove(self, subscriber):
+        """
+        Stop draining a subscriber's queue.
+
+        subscriber -- the subscriber
+        """
+        subscriber.close()
+
+    def start(self):
+        """Start the sender thread."""
+        if not self.running:
+            self.running = True
+            start_thread('ws_sender', self._run)
+
+    def stop(self):
+        """Stop the sender thread."""
+        self.running = False
+        self._wake()
+
+    def call(self, func):
+        """
+        Call a function on the sender thread, i.e. to write to a socket
+        without holding up the thread which has something to write.
+
+        func -- function taking no arguments
+        """
+        self.lock.acquire()
+        self.calls.append(func)
+        self.lock.release()
+        self._wake()
+
+    def _ready(self, subscriber):
+        self.lock.acquire()
+        if subscriber not in self.ready:
+            self.ready.append(subscriber)
+        self.lock.release()
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wakeup.release()
+        except RuntimeError:
+            # Already woken up.
+            pass
+
+    def _run(self):
+        while self.running:
+            self.wakeup.acquire()
+
+            self.lock.acquire()
+            ready = self.ready
+            self.ready = []
+            calls = self.calls
+            self.calls = []
+            self.lock.release()
+
+            for subscriber in ready:
+                self._flush(subscriber)
+
+            for func in calls:
+                try:
+                    func()
+                except Exception as err:
+                    log.error('Sender call failed: {}'.format(err))
+
+    def _flush(self, subscriber):
+        if subscriber.evicted:
+            subscriber.ws.Close()
+            return
+
+        while True:
+            message = subscriber.pop()
+            if message is None:
+                break
+
+            if subscriber.protocol.binary:
+                sent = subscriber.ws.SendBinary(message)
+            else:
+                sent = subscriber.ws.SendText(message)
+
+            if sent is False:
+                subscriber.close()
+                break
+
+            subscriber.sent += 1
+
+
+class AsyncSender:
+    """Drains each subscriber's queue from its own (u)asyncio task."""
+
+    def __init__(self):
+        """Initialize the object."""
+        self.events = {}
+
+    def add(self, subscriber):
+        """
+        Start draining a subscriber's queue.
+
+        subscriber -- the subscriber
+        """
+        event = asyncio.Event()
+        self.events[subscriber] = event
+        subscriber.on_ready = lambda _: event.set()
+        asyncio.create_task(self._run(subscriber, event))
+
+    def remove(self, subscriber):
+        """
+        Stop draining a subscriber's queue.
+
+        subscriber -- the subscriber
+        """
+        subscriber.close()
+        event = self.events.pop(subscriber, None)
+        if event is not None:
+            event.set()
+
+    def start(self):
+        """Nothing to do -- tasks are started as subscribers are added."""
+        pass
+
+    def stop(self):
+        """Stop draining all subscribers."""
+        for subscriber in list(self.events.keys()):
+            self.remove(subscriber)
+
+    async def _run(self, subscriber, event):
+        while not subscriber.closed:
+            await event.wait()
+            event.clear()
+
+            if subscriber.evicted:
+                subscriber.ws.Close()
+                break
+
+            while True:
+                message = subscriber.pop()
+                if message is None:
+                    break
+
+                # Wait for the message to be flushed, so that a slow client
+                # backs up into its bounded queue rather than into the
+                # stream's buffer.
+                if subscriber.protocol.binary:
+                    sent = await subscriber.ws.send_binary(message)
+                else:
+                    sent = await subscriber.ws.send_text(message)
+
+                if not sent:
+                    subscriber.close()
+                    break
+
+                subscriber.sent += 1
@@ -1,6 +1,11 @@
 """High-level Thing base class implementation."""
 
-import json
+import _thread
+
+from actionregistry import ActionRegistry
+from errors import PropertyError
+from eventlog import EventLog
+from utils import ticks_add, ticks_diff, ticks_ms, ticks_us
 
 
 class Thing:
@@ -26,16 +31,33 @@ class Thing:
         self.properties = {}
         self.available_actions = {}
         self.available_events = {}
-        self.actions = {}
-        self.events = []
+        self.actions = ActionRegistry()
+        self.events = EventLog()
         self.subscribers = set()
         self.href_prefix = ''
         self.ui_href = None
+        self.structure_version = 0
+        self.value_version = 0
+        self.version_waiters = []
+        self.notify_window = 0
+        self.pending_properties = {}
+        self.pending_lock = _thread.allocate_lock()
+        self.flusher = None
+        self.group_forwarder = None
+        self.batch = None
+        self.batch_lock = _thread.allocate_lock()
+        self.metrics = None
+        self.samplers = []
+        self.scheduler = None
 
     def as_thing_description(self):
         """
         Return the thing state as a Thing Description.
 
+        The property descriptions in it are shared with the properties, so
+        that building a description doesn't copy them -- they must not be
+        modified.
+
         Returns the state as a dictionary.
         """
         thing = {
@@ -43,7 +65,8 @@ class Thing:
             'title': self.title,
             '@context': self.context,
             '@type': self.type,
-            'properties': self.get_property_descriptions(),
+            'properties': {k: v.description
+                           for k, v in self.properties.items()},
             'actions': {},
             'events': {},
             'links': [
@@ -109,14 +132,16 @@ class Thing:
 
         prefix -- the prefix
         """
+        if prefix != self.href_prefix:
+            self.structure_changed()
+
         self.href_prefix = prefix
 
         for property_ in self.properties.values():
             property_.set_href_prefix(prefix)
 
-        for action_name in self.actions.keys():
-            for action in self.actions[action_name]:
-                action.set_href_prefix(prefix)
+        for action in self.actions.actions():
+            action.set_href_prefix(prefix)
 
     def set_ui_href(self, href):
         """
@@ -124,8 +149,78 @@ class Thing:
 
         href -- the href
         """
+        if href != self.ui_href:
+            self.structure_changed()
+
         self.ui_href = href
 
+    def get_structure_version(self):
+        """
+        Get the structure version of the thing.
+
+        The version is bumped whenever the Thing Description changes shape,
+        i.e. properties, actions or events are added or removed, or the hrefs
+        change. It can be used to cache the encoded description.
+
+        Returns the version as an integer.
+        """
+        return self.structure_version
+
+    def structure_changed(self):
+        """Mark the Thing Description as changed."""
+        self.structure_version += 1
+
+    def get_value_version(self):
+        """
+        Get the value version of the thing.
+
+        The version is bumped whenever a property value changes. It can be
+        used to tell whether the values have changed since they were last
+        read.
+
+        Returns the version as an integer.
+        """
+        return self.value_version
+
+    def get_changed_properties(self, since):
+        """
+        Get the properties whose value changed after a value version.
+
+        since -- the value version
+
+        Returns a dictionary of property_name -> value.
+        """
+        return {prop.get_name(): prop.get_value()
+                for prop in self.properties.values()
+                if prop.changed_version > since}
+
+    def add_version_waiter(self, waiter):
+        """
+        Call a function once, the next time a property value changes.
+
+        waiter -- function taking no arguments
+        """
+        self.version_waiters.append(waiter)
+
+    def remove_version_waiter(self, waiter):
+        """
+        Stop waiting for a property value change.
+
+        waiter -- function passed to add_version_waiter()
+        """
+        if waiter in self.version_waiters:
+            self.version_waiters.remove(waiter)
+
+    def wake_version_waiters(self):
+        """Call, and forget, the functions waiting for a value change."""
+        if not self.version_waiters:
+            return
+
+        waiters = self.version_waiters
+        self.version_waiters = []
+        for waiter in waiters:
+            waiter()
+
     def get_id(self):
         """
         Get the ID of the thing.
@@ -183,17 +278,18 @@ class Thing:
 
         Returns the action descriptions.
         """
-        descriptions = []
+        return [action.as_action_description()
+                for action in self.actions.actions(action_name)]
 
-        if action_name is None:
-            for name in self.actions:
-                for action in self.actions[name]:
-                    descriptions.append(action.as_action_description())
-        elif action_name in self.actions:
-            for action in self.actions[action_name]:
-                descriptions.append(action.as_action_description())
+    def set_action_retention(self, count, max_age=None):
+        """
+        Set how many completed actions to keep.
 
-        return descriptions
+        count -- maximum number of completed actions to keep, or None to keep
+                 them all
+        max_age -- optional number of seconds to keep completed actions for
+        """
+        self.actions.set_retention(count, max_age)
 
     def get_event_descriptions(self, event_name=None):
         """
@@ -203,11 +299,17 @@ class Thing:
 
         Returns the event descriptions.
         """
-        if event_name is None:
-            return [e.as_event_description() for e in self.events]
-        else:
-            return [e.as_event_description()
-                    for e in self.events if e.get_name() == event_name]
+        return [e.as_event_description()
+                for e in self.events.events(event_name)]
+
+    def set_event_retention(self, count, max_age=None):
+        """
+        Set how many past events to keep.
+
+        count -- maximum number of events to keep
+        max_age -- optional maximum age of events to keep, in seconds
+        """
+        self.events.resize(count, max_age)
 
     def add_property(self, property_):
         """
@@ -217,6 +319,7 @@ class Thing:
         """
         property_.set_href_prefix(self.href_prefix)
         self.properties[property_.name] = property_
+        self.structure_changed()
 
     def remove_property(self, property_):
         """
@@ -226,6 +329,7 @@ class Thing:
         """
         if property_.name in self.properties:
             del self.properties[property_.name]
+            self.structure_changed()
 
     def find_property(self, property_name):
         """
@@ -284,6 +388,89 @@ class Thing:
 
         prop.set_value(value)
 
+    def set_properties(self, values):
+        """
+        Set several property values as one transaction.
+
+        All values are validated before any of them is applied. If a group
+        forwarder is set, it gets all changed values at once, rather than
+        each property's value forwarder being called. Subscribers get a
+        single propertyStatus message for all changed properties, except
+        those deferred by their notify window or maxRate.
+
+        values -- dictionary of property_name -> value
+
+        Raises PropertyError, without applying anything, if a property does
+        not exist or a value is invalid.
+        """
+        props = []
+        for name, value in values.items():
+            prop = self.find_property(name)
+            if prop is None:
+                raise PropertyError('Unknown property: {}'.format(name))
+
+            prop.validate_value(value)
+            props.append((prop, value))
+
+        self.batch_lock.acquire()
+        self.batch = []
+        try:
+            if self.group_forwarder is not None:
+                changed = {}
+                for prop, value in props:
+                    if value != prop.get_value():
+                        changed[prop.name] = value
+
+                if changed:
+                    self.group_forwarder(changed)
+
+                for prop, value in props:
+                    prop.value.notify_of_external_update(value)
+            else:
+                for prop, value in props:
+                    prop.value.set(value)
+
+            batch = self.batch
+        finally:
+            self.batch = None
+            self.batch_lock.release()
+
+        if batch:
+            self.wake_version_waiters()
+            self.deliver_property_status(batch)
+
+    def add_sampler(self, value, sample, period_ms, jitter_ms=0,
+                    phase_ms=None):
+        """
+        Update a value periodically from a sampling function.
+
+        The sampler runs on the server's scheduler, see Scheduler.bind().
+
+        value -- the Value to update
+        sample -- function taking no arguments and returning the new value,
+                  or None to leave the value as it is
+        period_ms -- sampling period in milliseconds
+        jitter_ms -- maximum random offset of each sample, in milliseconds
+        phase_ms -- offset of the first sample, in milliseconds
+
+        Returns the Timer if the thing is already on a scheduler, else None.
+        """
+        args = (value, sample, period_ms, jitter_ms, phase_ms)
+        self.samplers.append(args)
+        if self.scheduler is not None:
+            return self.scheduler.bind(*args)
+
+        return None
+
+    def set_group_forwarder(self, forwarder):
+        """
+        Set the method which updates several values on the thing at once.
+
+        forwarder -- function taking a dictionary of property_name -> value,
+                     or None to use each property's value forwarder
+        """
+        self.group_forwarder = forwarder
+
     def get_action(self, action_name, action_id):
         """
         Get an action.
@@ -293,14 +480,7 @@ class Thing:
 
         Returns the requested action if found, else None.
         """
-        if action_name not in self.actions:
-            return None
-
-        for action in self.actions[action_name]:
-            if action.id == action_id:
-                return action
-
-        return None
+        return self.actions.get(action_id, action_name)
 
     def add_event(self, event):
         """
@@ -308,7 +488,7 @@ class Thing:
 
         event -- the event that occurred
         """
-        self.events.append(event)
+        self.events.add(event)
         self.event_notify(event)
 
     def add_available_event(self, name, metadata):
@@ -317,7 +497,13 @@ class Thing:
 
         name -- name of the event
         metadata -- event metadata, i.e. type, description, etc., as a dict
+
+        Raises ValueError if the name is 'stream', which names the thing's
+        Server-Sent Events stream under /events.
         """
+        if name == 'stream':
+            raise ValueError('Reserved event name: stream')
+
         if metadata is None:
             metadata = {}
 
@@ -325,6 +511,7 @@ class Thing:
             'metadata': metadata,
             'subscribers': set(),
         }
+        self.structure_changed()
 
     def perform_action(self, action_name, input_=None):
         """
@@ -349,7 +536,7 @@ class Thing:
         action = action_type['class'](self, input_=input_)
         action.set_href_prefix(self.href_prefix)
         self.action_notify(action)
-        self.actions[action_name].append(action)
+        self.actions.add(action)
         return action
 
     def remove_action(self, action_name, action_id):
@@ -366,7 +553,7 @@ class Thing:
             return False
 
         action.cancel()
-        self.actions[action_name].remove(action)
+        self.actions.remove(action_id)
         return True
 
     def add_available_action(self, name, metadata, cls):
@@ -384,66 +571,186 @@ class Thing:
             'metadata': metadata,
             'class': cls,
         }
-        self.actions[name] = []
+        self.actions.add_name(name)
+        self.structure_changed()
 
-    def add_subscriber(self, ws):
+    def add_subscriber(self, subscriber):
         """
         Add a new websocket subscriber.
 
-        ws -- the websocket
+        subscriber -- the Subscriber wrapping the websocket
         """
-        self.subscribers.add(ws)
+        self.subscribers.add(subscriber)
 
-    def remove_subscriber(self, ws):
+    def remove_subscriber(self, subscriber):
         """
         Remove a websocket subscriber.
 
-        ws -- the websocket
+        subscriber -- the Subscriber wrapping the websocket
         """
-        if ws in self.subscribers:
-            self.subscribers.remove(ws)
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
 
-        for name in self.available_events:
-            self.remove_event_subscriber(name, ws)
+        for event in self.available_events.values():
+            event['subscribers'].discard(subscriber)
 
-    def add_event_subscriber(self, name, ws):
+    def add_event_subscriber(self, name, subscriber):
         """
         Add a new websocket subscriber to an event.
 
         name -- name of the event
-        ws -- the websocket
+        subscriber -- the Subscriber wrapping the websocket
         """
         print('add_event_subscriber:', name)
         if name in self.available_events:
-            self.available_events[name]['subscribers'].add(ws)
+            self.available_events[name]['subscribers'].add(subscriber)
 
-    def remove_event_subscriber(self, name, ws):
+    def remove_event_subscriber(self, name, subscriber):
         """
         Remove a websocket subscriber from an event.
 
         name -- name of the event
-        ws -- the websocket
+        subscriber -- the Subscriber wrapping the websocket
         """
         print('remove_event_subscriber:', name)
         if name in self.available_events and \
-                ws in self.available_events[name]['subscribers']:
-            self.available_events[name]['subscribers'].remove(ws)
+                subscriber in self.available_events[name]['subscribers']:
+            self.available_events[name]['subscribers'].remove(subscriber)
+
+    def set_notify_window(self, window):
+        """
+        Set the default property notification coalescing window.
+
+        Property changes within the window are sent as a single
+        propertyStatus message, carrying the latest value of each changed
+        property. Properties can override this with their own window.
+
+        window -- the window in milliseconds, 0 to notify immediately
+        """
+        self.notify_window = window
 
     def property_notify(self, property_):
         """
         Notify all subscribers of a property change.
 
+        The notification is deferred if the property is coalesced or rate
+        limited, and there is a flusher to deliver it later.
+
         property_ -- the property that changed
         """
-        message = json.dumps({
+        self.value_version += 1
+        property_.changed_version = self.value_version
+
+        if self.batch is not None:
+            if property_ not in self.batch:
+                self.batch.append(property_)
+            return
+
+        self.wake_version_waiters()
+        self.deliver_property_status([property_])
+
+    def deliver_property_status(self, properties):
+        """
+        Send a propertyStatus message for changed properties, or defer it.
+
+        Properties which are coalesced or rate limited are deferred, if there
+        is a flusher to deliver them later. The rest are sent together, in a
+        single message.
+
+        properties -- list of properties which changed
+        """
+        if self.flusher is None:
+            self.send_property_status(properties)
+            return
+
+        now = ticks_ms()
+        due = []
+        deferred = False
+        for property_ in properties:
+            window = property_.get_notify_window()
+            if window is None:
+                window = self.notify_window
+
+            interval = property_.get_notify_interval()
+
+            delay = window
+            if interval and property_.last_notify is not None:
+                delay = max(delay,
+                            interval - ticks_diff(now, property_.last_notify))
+
+            if delay <= 0 and property_.name not in self.pending_properties:
+                if interval:
+                    property_.last_notify = now
+                due.append(property_)
+                continue
+
+            self.pending_lock.acquire()
+            if property_.name not in self.pending_properties:
+                self.pending_properties[property_.name] = \
+                    (property_, ticks_add(now, max(delay, 0)))
+            self.pending_lock.release()
+            deferred = True
+
+        if due:
+            self.send_property_status(due)
+
+        if deferred:
+            self.flusher.wake()
+
+    def flush_notifications(self):
+        """
+        Send all deferred property notifications which are due.
+
+        Returns a boolean indicating whether any notifications are still
+        deferred.
+        """
+        if not self.pending_properties:
+            return False
+
+        now = ticks_ms()
+        due = []
+
+        self.pending_lock.acquire()
+        for name, (property_, deadline) in \
+                list(self.pending_properties.items()):
+            if ticks_diff(now, deadline) >= 0:
+                due.append(property_)
+                del self.pending_properties[name]
+        pending = len(self.pending_properties) > 0
+        self.pending_lock.release()
+
+        if due:
+            for property_ in due:
+                if property_.get_notify_interval():
+                    property_.last_notify = now
+
+            self.send_property_status(due)
+
+        return pending
+
+    def send_property_status(self, properties):
+        """
+        Send a single propertyStatus message to all subscribers.
+
+        properties -- list of properties to include
+        """
+        start = ticks_us() if self.metrics is not None else 0
+
+        data = {}
+        for property_ in properties:
+            data[property_.name] = property_.get_value()
+
+        message = {
             'messageType': 'propertyStatus',
-            'data': {
-                property_.name: property_.get_value(),
-            }
-        })
+            'data': data,
+        }
 
-        for subscriber in self.subscribers:
-            subscriber.SendText(message)
+        if len(properties) == 1:
+            key = properties[0].name
+        else:
+            key = ','.join(sorted(data.keys()))
+
+        self.send_message('property', self.subscribers, message, key, start)
 
     def action_notify(self, action):
         """
@@ -451,13 +758,18 @@ class Thing:
 
         action -- the action whose status changed
         """
-        message = json.dumps({
+        if action.status in ('completed', 'cancelled'):
+            self.actions.retire(action)
+
+        start = ticks_us() if self.metrics is not None else 0
+
+        message = {
             'messageType': 'actionStatus',
             'data': action.as_action_description(),
-        })
+        }
 
-        for subscriber in self.subscribers:
-            subscriber.SendText(message)
+        self.send_message('action', self.subscribers, message, action.href,
+                          start)
 
     def event_notify(self, event):
         """
@@ -468,10 +780,51 @@ class Thing:
         if event.name not in self.available_events:
             return
 
-        message = json.dumps({
+        start = ticks_us() if self.metrics is not None else 0
+
+        message = {
             'messageType': 'event',
             'data': event.as_event_description(),
-        })
+        }
 
-        for subscriber in self.available_events[event.name]['subscribers']:
-            subscriber.SendText(message)
+        self.send_message('event',
+                          self.available_events[event.name]['subscribers'],
+                          message, None, start)
+
+    def send_message(self, kind, subscribers, message, key, start):
+        """
+        Encode a message and queue it on subscribers.
+
+        The message is encoded once for each subscriber protocol in use,
+        rather than once per subscriber.
+
+        kind -- 'property', 'action' or 'event', for the metrics
+        subscribers -- the subscribers to send to
+        message -- the message
+        key -- key of the message, see Subscriber.send()
+        start -- ticks_us() value from before the message was built
+        """
+        refused = 0
+        protocol = None
+        encoded = None
+        others = None
+        for subscriber in subscribers:
+            if subscriber.protocol is not protocol:
+                # Subscribers rarely mix protocols, so the other encodings
+                # are only kept once a second protocol shows up.
+                if protocol is not None:
+                    if others is None:
+                        others = {}
+                    others[protocol] = encoded
+
+                protocol = subscriber.protocol
+                encoded = others.get(protocol) if others else None
+                if encoded is None:
+                    encoded = protocol.dumps(message)
+
+            if not subscriber.send(encoded, key):
+                refused += 1
+
+        if self.metrics is not None:
+            self.metrics.observe_notify(kind, len(subscribers), refused,
+                                        start)
@@ -1,7 +1,12 @@
 """Utility functions."""
 
+import _thread
 import time
-import network
+
+try:
+    import network
+except ImportError:
+    network = None
 
 
 def timestamp():
@@ -14,6 +19,65 @@ def timestamp():
     return '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}+00:00'.format(*now[:6])
 
 
+def ticks_ms():
+    """
+    Get a millisecond counter.
+
+    Returns the counter value, which may wrap around -- use ticks_diff() to
+    compare values.
+    """
+    if hasattr(time, 'ticks_ms'):
+        return time.ticks_ms()
+
+    return int(time.time() * 1000)
+
+
+def ticks_us():
+    """
+    Get a microsecond counter.
+
+    Returns the counter value, which may wrap around -- use ticks_diff() to
+    compare values.
+    """
+    if hasattr(time, 'ticks_us'):
+        return time.ticks_us()
+
+    if hasattr(time, 'perf_counter'):
+        return int(time.perf_counter() * 1000000)
+
+    return int(time.time() * 1000000)
+
+
+def ticks_diff(end, start):
+    """
+    Get the difference between two ticks_ms() or two ticks_us() values.
+
+    end -- the later value
+    start -- the earlier value
+
+    Returns the difference in the unit of the values.
+    """
+    if hasattr(time, 'ticks_diff'):
+        return time.ticks_diff(end, start)
+
+    return end - start
+
+
+def ticks_add(ticks, delta):
+    """
+    Offset a ticks_ms() value.
+
+    ticks -- the value
+    delta -- the offset in milliseconds
+
+    Returns the new value.
+    """
+    if hasattr(time, 'ticks_add'):
+        return time.ticks_add(ticks, delta)
+
+    return ticks + delta
+
+
 def get_addresses():
     """
     Get all IP addresses.
@@ -22,8 +86,28 @@ def get_addresses():
     """
     addresses = ['127.0.0.1']
 
+    if network is None:
+        return addresses
+
     station = network.WLAN(network.STA_IF)
     if station.isconnected():
         addresses.append(station.ifconfig()[0])
 
     return addresses
+
+
+def start_thread(name, func, args=()):
+    """
+    Start a new thread.
+
+    The loboris port takes the thread's name as the first argument, other
+    ports don't.
+
+    name -- name of the thread
+    func -- function to run
+    args -- arguments to pass to the function
+    """
+    try:
+        return _thread.start_new_thread(name, func, args)
+    except TypeError:
+        return _thread.start_new_thread(func, args)